@@ -14,16 +14,55 @@
 '''
 # TODO: Add a cli script for generating JWT tokens
 
+import asyncio
 import os
+import threading
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
-from core.job_runner import router as job_router
-from dotenv import load_dotenv
+from core.api import pipeline_router, router as job_router
+from core.worker_api import router as worker_router
+from core import config_store, control, dispatcher, queue, spool
+from core.environment_manager import getenv
 
-load_dotenv()
+# `.env` isn't loaded into os.environ, runs read it through core/environment_manager.py
+PORT = int(getenv("PORT", 8000))
+# Server processes, they share the job queue and the config through the disk
+WORKERS = int(getenv("WORKERS", 1))
 
-PORT = int(os.getenv("PORT", 8000))
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+  # Config changes are picked up in place instead of restarting the server
+  config_store.reload()
+  stop_watching = threading.Event()
+  watcher = config_store.watch(stop_watching)
+  # CLI commands are sent here while the server runs, see core/control.py
+  control_server = await control.serve()
+  # Fire-and-forget triggers left in the spool by a dead worker are queued
+  # first, see core/spool.py
+  stop_spooling = threading.Event()
+  spool_thread = spool.start(stop_spooling)
+  # Runs queued by any worker, see core/queue.py
+  stop_dispatching = threading.Event()
+  dispatch_threads = dispatcher.start(stop_dispatching)
+  yield
+  # Triggers accepted before shutdown are queued, for this worker or the next
+  stop_spooling.set()
+  spool.notify()
+  await asyncio.to_thread(spool_thread.join)
+  # Runs already claimed are finished, like background tasks were before.
+  # If the worker is killed instead, their lease runs out and another worker
+  # runs them again
+  stop_dispatching.set()
+  dispatcher.notify()
+  for thread in dispatch_threads:
+    await asyncio.to_thread(thread.join)
+  await control.close(control_server)
+  stop_watching.set()
+  # The inotify watcher can't be torn down mid-call at interpreter exit
+  await asyncio.to_thread(watcher.join, 5)
 
 app = FastAPI(
+  lifespan=lifespan,
   title="TheCist's webhook",
   description="Trigger any background or sync job via HTTP",
   version="0.0.1",
@@ -35,15 +74,23 @@ app = FastAPI(
 )
 
 app.include_router(job_router)
+app.include_router(pipeline_router)
+app.include_router(worker_router)
 
 # health check
 @app.get("/")
 def root():
   return {"status": "ok"}
+
+# Runs per status in the shared queue, sampled by `python -m cli loadtest`
+@app.get("/stats")
+def stats():
+  # The spool is per worker, like the pid
+  return {"queue": queue.depth(), "spool": spool.backlog(), "pid": os.getpid()}
   
 if __name__ == "__main__":
   import uvicorn
 
-  # reload=true messes with the venv creation logic and
-  # reload_excludes=[".venv/*", ".venvs/*"] doesn't fix it
-  uvicorn.run("app:app", host="0.0.0.0", reload=True, port=PORT, reload_includes=["configs.toml", "defaults.toml"], reload_excludes=["*"])
+  # No reload=True: configs.toml/defaults.toml are watched by core/config_store.py,
+  # restarting would drop in-flight background jobs
+  uvicorn.run("app:app", host="0.0.0.0", port=PORT, workers=WORKERS)
@@ -1,11 +1,14 @@
+import time
+_STARTED = time.perf_counter()
+
 import typer
-import re
 from pathlib import Path
-from core.config_utils import save_configs, merge_defaults_into_config, load_config
-from core.job_runner import run_job as core_run_job
-from core.cron import update_cron
 # Should I update cron the moment a setting changes?
 
+# Commands import what they need when they run, `run-job` is triggered by cron
+# on every tick and shouldn't pay for FastAPI, the crontab or other commands.
+# Check with `python -X importtime -m cli <command>` before adding imports here
+
 # TODO: Add custom logging
 # TODO: Support system level task scheduling on Windows
 
@@ -13,88 +16,208 @@ CONFIGS_PATH = Path("configs.toml")
 
 app = typer.Typer()
 
-def _toggle_job(job_name: str, toggle: bool):
-  config = load_config()
-  if job_name not in config or not isinstance(config[job_name], dict):
-    raise typer.Exit(f"Configuration for job '{job_name}' not found or invalid (has to be a dictionary)")
-  config[job_name]["enabled"] = toggle
-  save_configs(config)
+@app.callback()
+def main(
+  ctx: typer.Context,
+  timings: bool = typer.Option(False, "--timings", help="Print startup and total time to stderr"),
+  local: bool = typer.Option(False, "--local", help="Run in this process even if a server is running"),
+):
+  ctx.obj = {"local": local}
+  if not timings:
+    return
+  startup = (time.perf_counter() - _STARTED) * 1000
+  typer.echo(f"Startup: {startup:.1f}ms", err=True)
+  ctx.call_on_close(lambda: typer.echo(f"Total: {(time.perf_counter() - _STARTED) * 1000:.1f}ms", err=True))
+
+def _remote(ctx: typer.Context, command: str, **args):
+  """Sends the command to a running server, returns None to run it locally."""
+  if ctx.obj and ctx.obj.get("local"):
+    return None
+  from core.control import ControlError, request
+  try:
+    return request(command, **args)
+  except ControlError as e:
+    typer.echo(f"Error: {e}", err=True)
+    raise typer.Exit(1)
+
+def _toggle_job(ctx: typer.Context, job_name: str, toggle: bool):
+  if _remote(ctx, "enable" if toggle else "disable", job_name=job_name) is not None:
+    return
+  from core.commands import toggle_job
+  from core.config_utils import ConfigError
+  try:
+    toggle_job(job_name, toggle)
+  except ConfigError as e:
+    typer.echo(f"Error: {e}", err=True)
+    raise typer.Exit(1)
 
 @app.command()
-def enable(job_name: str):
-  _toggle_job(job_name, True)
+def enable(ctx: typer.Context, job_name: str):
+  _toggle_job(ctx, job_name, True)
   typer.echo(f"Enabled job: {job_name}")
 
+@app.command("jobs")
+def list_jobs(rebuild: bool = typer.Option(False, "--rebuild", help="Describe every job again, even if its files didn't change")):
+  """Lists the jobs and their editable settings, without importing job code."""
+  from core.config_utils import load_config
+  from core.default_settings import DefaultSettings
+  from core.registry import RegistryError, get_entry, list_jobs as registry_jobs
+  config = load_config()
+  # Every job has these, only the job's own keys are listed
+  common = set(DefaultSettings.model_fields) - {"defaults"}
+  for job_name in registry_jobs():
+    try:
+      entry = get_entry(job_name, rebuild=rebuild)
+    except RegistryError as e:
+      typer.echo(f"{job_name}: {e}", err=True)
+      continue
+    job_config = config.get(job_name)
+    status = "not configured" if not isinstance(job_config, dict) else "enabled" if job_config.get("enabled") else "disabled"
+    typer.echo(f"{job_name} ({status})")
+    for path in entry["editable"]:
+      if path.split(".")[0] not in common:
+        typer.echo(f"  {path}")
+
 @app.command()
 def create_config():
+  from core.config_utils import merge_defaults_into_config
   merge_defaults_into_config()
   typer.echo(f"Created config file: {CONFIGS_PATH}")
 
 @app.command()
-def disable(job_name: str):
-  _toggle_job(job_name, False)
+def disable(ctx: typer.Context, job_name: str):
+  _toggle_job(ctx, job_name, False)
   typer.echo(f"Disabled job: {job_name}")
 
-def _set_nested_value(data: dict, dotted_key: str, value):
-  keys = dotted_key.split(".")
-  current = data
-  for key in keys[:-1]:
-    current = current.setdefault(key, {})
-  if value is None:
-    del current[keys[-1]]
-  else:
-    current[keys[-1]] = value
-
-
 @app.command("set")
-def set_config(kv_pairs: list[str]):
-  # Sanity check
-  merge_defaults_into_config()
-
+def set_config(ctx: typer.Context, kv_pairs: list[str]):
   typer.echo("Note: If a key is not defined in the job's settings model, it will be ignored.", color=True)
 
-  config = load_config()
+  response = _remote(ctx, "set", kv_pairs=kv_pairs)
+  if response is not None:
+    messages = response["result"]
+  else:
+    from core.commands import set_values
+    messages = set_values(kv_pairs)
 
-  for pair in kv_pairs:
-    match = re.match(r"^([\w\.]+)=(.*)$", pair)
-    if not match:
-      typer.echo(f"Invalid format: {pair} (expected key=value)")
-      continue
-    key, raw_value = match.groups()
-
-    # Parse value to other supported styles
-    value = raw_value.strip()
-    if value.lower() == "true":
-      value = True
-    elif value.lower() == "false":
-      value = False
-    elif re.fullmatch(r"-?\d+", value):
-      value = int(value)
-    elif re.fullmatch(r"-?\d+\.\d+", value):
-      value = float(value)
-    elif value.startswith('"') and value.endswith('"'):
-      value = value[1:-1]
-    elif value.startswith("'") and value.endswith("'"):
-      value = value[1:-1]
-    elif value.lower() == "none":
-      value = None
-
-    _set_nested_value(config, key, value)
-    typer.echo(f"Set {key} = {value!r}")
-  save_configs(config)
+  for message in messages:
+    typer.echo(message)
 
 # maybe implement the acknowledgement logic here too?
 @app.command()
-def run_job(job_name: str):
+def run_job(ctx: typer.Context, job_name: str):
   typer.echo(f"Running job: {job_name}")
-  result = core_run_job(job_name)
+  response = _remote(ctx, "run-job", job_name=job_name)
+  if response is not None:
+    result = response["result"]
+  else:
+    from core.job_runner import run_job as core_run_job
+    result = core_run_job(job_name)
   typer.echo(f"Job finished: {job_name}\nResult: {result}")
 
 @app.command()
-def setup_scheduler():
-  config = load_config()
-  for job_name, data in config.items():
-    update_cron(job_name, data)
+def run_batch(
+  ctx: typer.Context,
+  path: Path = typer.Argument(..., help="JSONL file of {\"job\": ..., \"payload\": {...}} items, - for stdin"),
+  parallelism: int = typer.Option(4, "--parallelism", min=1, help="Runs of a job going at the same time"),
+):
+  """Runs many payloads, one job process per job. Prints one JSON result per line."""
+  import json
+  import sys
+  text = sys.stdin.read() if str(path) == "-" else path.read_text(encoding="utf-8")
+  items = []
+  for number, line in enumerate(text.splitlines(), 1):
+    if not line.strip():
+      continue
+    try:
+      item = json.loads(line)
+      items.append((item["job"], item.get("payload", {})))
+    except (json.JSONDecodeError, KeyError, TypeError) as e:
+      typer.echo(f"Error: line {number} isn't a {{\"job\": ..., \"payload\": ...}} object: {e}", err=True)
+      raise typer.Exit(1)
+
+  response = _remote(ctx, "run-batch", items=items, parallelism=parallelism)
+  if response is not None:
+    results = response["result"]
+  else:
+    from core.job_runner import run_items
+    results = run_items(items, parallelism)
+  for result in results:
+    typer.echo(json.dumps(result, default=str))
+
+@app.command()
+def run_pipeline(
+  ctx: typer.Context,
+  pipeline_name: str,
+  payload: str = typer.Option("{}", "--payload", help="JSON payload of the first stages"),
+):
+  import json
+  typer.echo(f"Running pipeline: {pipeline_name}")
+  response = _remote(ctx, "run-pipeline", pipeline_name=pipeline_name, payload=json.loads(payload))
+  if response is not None:
+    report = response["result"]
+  else:
+    from core.pipelines import run_pipeline as core_run_pipeline
+    report = core_run_pipeline(pipeline_name, json.loads(payload))
+
+  for stage_name, stage in report["stages"].items():
+    if stage.get("skipped"):
+      typer.echo(f"{stage_name} ({stage['job']}): skipped, {stage['error']}")
+    else:
+      status = "ok" if stage["ok"] else f"failed, {stage['error']}"
+      typer.echo(f"{stage_name} ({stage['job']}): {status} [{stage['started_at']}s +{stage['duration_seconds']}s]")
+  typer.echo(f"Pipeline finished in {report['duration_seconds']}s")
+  if not report["ok"]:
+    raise typer.Exit(1)
+
+@app.command()
+def loadtest(
+  url: str = typer.Option(None, "--url", help="Server to load, defaults to the local one on PORT"),
+  job: str = typer.Option("noop", "--job", help="Job to trigger, the bundled no-op job by default"),
+  requests: int = typer.Option(200, "--requests", min=1, help="Triggers to send"),
+  concurrency: int = typer.Option(10, "--concurrency", min=1, help="Requests in flight at once"),
+  rate: float = typer.Option(None, "--rate", min=0, help="Requests per second, as fast as possible if not set"),
+  payload_size: int = typer.Option(0, "--payload-size", min=0, help="Bytes of padding in each payload"),
+  ack: bool = typer.Option(False, "--ack", help="Wait for each run instead of fire-and-forget"),
+  drain_timeout: float = typer.Option(60, "--drain-timeout", help="Seconds to wait for queued runs to finish"),
+):
+  """Drives the API with triggers and prints throughput, latency and queue depth as JSON."""
+  import asyncio
+  import json
+  from core.environment_manager import getenv
+  from core.loadtest import run_loadtest
+  # Same lookup as the server's, PORT may come from .env
+  url = url or f"http://127.0.0.1:{getenv('PORT', 8000)}"
+  report = asyncio.run(run_loadtest(url, job, requests, concurrency, rate or None, payload_size, ack, drain_timeout))
+  typer.echo(json.dumps(report, indent=2))
+
+@app.command()
+def worker(
+  server: str = typer.Option(..., "--server", help="URL of the API server, e.g. http://localhost:8000"),
+  threads: int = typer.Option(1, "--threads", min=1, help="Runs leased at the same time"),
+  token: str = typer.Option(None, "--token", help="Must match the server's WORKER_TOKEN, read like the server does (environment, then .env) if not given"),
+):
+  """Runs jobs queued on a server, on this machine."""
+  from core.environment_manager import getenv
+  from core.worker import Worker
+  typer.echo(f"Leasing runs from {server}")
+  Worker(server, token or getenv("WORKER_TOKEN")).run(threads)
+
+@app.command()
+def setup_scheduler(ctx: typer.Context, dry_run: bool = typer.Option(False, "--dry-run", help="Only print the crontab changes")):
+  from core.cron import CronChange, format_changes
+  response = _remote(ctx, "setup-scheduler", dry_run=dry_run)
+  if response is not None:
+    changes = [CronChange(**change) for change in response["result"]]
+  else:
+    from core.commands import setup_scheduler as core_setup_scheduler
+    changes = core_setup_scheduler(dry_run)
+  if not changes:
+    typer.echo("Crontab is up to date")
+    return
+  typer.echo(format_changes(changes))
+  if dry_run:
+    typer.echo(f"Dry run, {len(changes)} change(s) not applied")
 
 if __name__ == "__main__":
   app()
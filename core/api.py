@@ -0,0 +1,176 @@
+import json
+from typing import Any, Dict, Optional, Union
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field
+from fastapi.responses import JSONResponse, Response
+from . import config_store, result_cache, spool, tracing
+from .default_settings import DefaultSettings
+from .job_runner import run_items, run_job
+from .limits import JobTimeoutError
+from .payload import PayloadFile, PayloadTooLargeError, read_body
+
+def _payload_limits(job_name: str) -> tuple[Optional[int], Optional[int]]:
+  snapshot = config_store.current()
+  if snapshot is not None and job_name in snapshot.settings:
+    settings = snapshot.settings[job_name]
+    return settings.payload_spool_threshold, settings.max_payload_size
+
+  from .config_utils import load_config
+  job_config = load_config().get(job_name, {})
+  if not isinstance(job_config, dict):
+    job_config = {}
+  return tuple(
+    job_config.get(name, DefaultSettings.model_fields[name].default)
+    for name in ("payload_spool_threshold", "max_payload_size")
+  )
+
+async def _extract_payload(request: Request) -> Union[Dict[str, Any], PayloadFile]:
+  spool_threshold, max_size = _payload_limits(request.path_params["job_name"])
+
+  content_length = request.headers.get("content-length")
+  if max_size is not None and content_length and int(content_length) > max_size:
+    raise HTTPException(
+      status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+      detail=f"Payload is over the {max_size} bytes limit",
+    )
+
+  try:
+    body = await read_body(request.stream(), spool_threshold, max_size, request.headers.get("content-type"))
+  except PayloadTooLargeError as exc:
+    raise HTTPException(
+      status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+      detail=str(exc),
+    ) from exc
+
+  payload: Dict[str, Any] = {}
+
+  if isinstance(body, bytes) and body:
+    try:
+      decoded = json.loads(body)
+    except json.JSONDecodeError as exc:
+      raise HTTPException(
+        status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+        detail=f"Payload has to be a JSON object: {exc}",
+      ) from exc
+    if not isinstance(decoded, dict):
+      raise HTTPException(
+        status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+        detail="Payload has to be a JSON object",
+      )
+    payload.update(decoded)
+
+  # `request.query_params` is ImmutableMultiDict ‑> cast to plain dict
+  if request.query_params:
+    payload.update(request.query_params.multi_items())
+
+  # normalise booleans that came in as strings
+  for k, v in payload.items():
+    if isinstance(v, str) and v.lower() in {"true", "false"}:
+      payload[k] = v.lower() == "true"
+
+  # Spooled bodies go to the job as a file, with the query params alongside
+  if isinstance(body, PayloadFile):
+    body.params = payload
+    return body
+
+  return payload
+
+def _is_exclusive(job_name: str) -> bool:
+  snapshot = config_store.current()
+  return snapshot is not None and job_name in snapshot.settings and snapshot.settings[job_name].exclusive
+
+def _cached_settings(job_name: str) -> Optional[DefaultSettings]:
+  snapshot = config_store.current()
+  if snapshot is None or job_name not in snapshot.settings:
+    return None
+  settings = snapshot.settings[job_name]
+  return settings if settings.cache_ttl else None
+
+def _run_job_and_release(job_name: str, payload: Union[Dict[str, Any], PayloadFile]) -> dict:
+  try:
+    return run_job(job_name, payload=payload)
+  finally:
+    if isinstance(payload, PayloadFile):
+      payload.unlink()
+
+class BatchItem(BaseModel):
+  job: str
+  payload: Dict[str, Any] = {}
+
+class BatchRequest(BaseModel):
+  items: list[BatchItem]
+  parallelism: int = Field(4, ge=1, description="Runs of a job going at the same time")
+
+router = APIRouter(prefix="/run", tags=["jobs"])
+
+# Registered before `/{job_name}`, which would match it too
+@router.post("/batch", status_code=status.HTTP_200_OK)
+async def run_batch_endpoint(batch: BatchRequest):
+  items = [(item.job, item.payload) for item in batch.items]
+  results = await run_in_threadpool(run_items, items, batch.parallelism)
+  return {"results": results}
+
+@router.api_route(
+  "/{job_name}",
+  methods=["GET", "POST", "PUT", "PATCH", "DELETE"],
+  status_code=status.HTTP_200_OK,
+)
+async def run_job_endpoint(
+  job_name: str,
+  request: Request,
+  payload: Union[Dict[str, Any], PayloadFile] = Depends(_extract_payload),
+):
+  # The run's spans (and the job process') are children of this one
+  with tracing.span("http.run_job", job=job_name, method=request.method) as span:
+    params = payload.params if isinstance(payload, PayloadFile) else payload
+    ack = bool(params.pop("acknowledgment", False))
+    no_cache = bool(params.pop("no_cache", False)) or "no-cache" in request.headers.get("cache-control", "")
+
+    if not ack:
+      # fire‑and‑forget, spooled to disk before answering, then queued for
+      # any server worker to pick up
+      trigger_id = await run_in_threadpool(spool.append, job_name, payload, _is_exclusive(job_name), tracing.traceparent())
+      span.set_attribute("trigger_id", trigger_id)
+      return Response(status_code=status.HTTP_200_OK, headers={"X-Trigger-Id": trigger_id})
+    else:
+      settings = _cached_settings(job_name)
+      age = None
+      try:
+        # Spooled bodies are too large to be worth keying a cache on
+        if settings is not None and not isinstance(payload, PayloadFile):
+          result, age = await run_in_threadpool(
+            result_cache.cached_run, job_name, payload, settings,
+            lambda: _run_job_and_release(job_name, payload), no_cache,
+          )
+        else:
+          result = await run_in_threadpool(_run_job_and_release, job_name, payload)
+      except JobTimeoutError as exc:
+        raise HTTPException(
+          status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+          detail=str(exc),
+        ) from exc
+      except Exception as exc:
+        raise HTTPException(
+          status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+          detail=str(exc),
+        ) from exc
+
+      headers = {}
+      if settings is not None:
+        span.set_attribute("cache", "MISS" if age is None else "HIT")
+        headers["X-Cache"] = "MISS" if age is None else "HIT"
+        if age is not None:
+          headers["Age"] = str(int(age))
+      return JSONResponse(content={"acknowledgment": "completed", "result": result}, headers=headers)
+
+pipeline_router = APIRouter(prefix="/pipelines", tags=["pipelines"])
+@pipeline_router.post("/{pipeline_name}", status_code=status.HTTP_200_OK)
+async def run_pipeline_endpoint(pipeline_name: str, payload: Optional[Dict[str, Any]] = None):
+  from .pipelines import run_pipeline
+  try:
+    return await run_in_threadpool(run_pipeline, pipeline_name, payload)
+  except KeyError as exc:
+    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(exc)) from exc
+  except Exception as exc:
+    raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(exc)) from exc
@@ -0,0 +1,69 @@
+import re
+from typing import Any
+from .config_utils import ConfigError, merge_defaults_into_config, load_config, update_configs
+
+# Shared by the CLI and the server's control socket, so both apply a command
+# exactly the same way
+
+def toggle_job(job_name: str, toggle: bool) -> None:
+  def set_enabled(config: dict) -> None:
+    if job_name not in config or not isinstance(config[job_name], dict):
+      raise ConfigError(f"Configuration for job '{job_name}' not found or invalid (has to be a dictionary)")
+    config[job_name]["enabled"] = toggle
+
+  update_configs(set_enabled)
+
+def _set_nested_value(data: dict, dotted_key: str, value):
+  keys = dotted_key.split(".")
+  current = data
+  for key in keys[:-1]:
+    current = current.setdefault(key, {})
+  if value is None:
+    del current[keys[-1]]
+  else:
+    current[keys[-1]] = value
+
+def parse_value(raw_value: str) -> Any:
+  # Parse value to other supported styles
+  value = raw_value.strip()
+  if value.lower() == "true":
+    value = True
+  elif value.lower() == "false":
+    value = False
+  elif re.fullmatch(r"-?\d+", value):
+    value = int(value)
+  elif re.fullmatch(r"-?\d+\.\d+", value):
+    value = float(value)
+  elif value.startswith('"') and value.endswith('"'):
+    value = value[1:-1]
+  elif value.startswith("'") and value.endswith("'"):
+    value = value[1:-1]
+  elif value.lower() == "none":
+    value = None
+  return value
+
+def set_values(kv_pairs: list[str]) -> list[str]:
+  """Applies `key=value` pairs to the config, returns a message per pair."""
+  # Sanity check
+  merge_defaults_into_config()
+
+  def apply(config: dict) -> list[str]:
+    messages = []
+    for pair in kv_pairs:
+      match = re.match(r"^([\w\.]+)=(.*)$", pair)
+      if not match:
+        messages.append(f"Invalid format: {pair} (expected key=value)")
+        continue
+      key, raw_value = match.groups()
+      value = parse_value(raw_value)
+
+      _set_nested_value(config, key, value)
+      messages.append(f"Set {key} = {value!r}")
+    return messages
+
+  # Another worker or CLI writing meanwhile would be overwritten otherwise
+  return update_configs(apply)
+
+def setup_scheduler(dry_run: bool = False) -> list:
+  from .cron import reconcile_cron
+  return reconcile_cron(load_config(), dry_run=dry_run)
@@ -0,0 +1,156 @@
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional
+from .config_utils import CONFIGS_PATH, DEFAULTS_PATH, PIPELINES_KEY, ConfigError, job_settings, load_config, merge_defaults_into_config
+from .default_settings import DefaultSettings
+from .environment_manager import JOBS_DIR, env_files, install_host_requirements, job_env
+
+# Validated config kept in memory by the server, so config changes don't need
+# a server restart. A reload builds a whole new snapshot and swaps it in with
+# a single assignment: runs that already started keep the snapshot they got
+
+# Seconds between checks when watchfiles (inotify) isn't available
+POLL_INTERVAL = 1.0
+
+class ConfigSnapshot:
+  def __init__(self, raw: dict, settings: Dict[str, DefaultSettings], errors: Dict[str, str], inputs: Optional[Dict[str, tuple]] = None):
+    self.raw = raw
+    self.settings = settings
+    self.errors = errors
+    # What each job's settings were validated from, its config and env vars
+    self.inputs = inputs or {}
+    self.loaded_at = time.time()
+
+  def get(self, job_name: str) -> DefaultSettings:
+    if job_name in self.settings:
+      return self.settings[job_name]
+    if job_name in self.errors:
+      raise ConfigError(self.errors[job_name])
+    raise KeyError(f"Configuration for job '{job_name}' not found")
+
+_snapshot: Optional[ConfigSnapshot] = None
+_reload_lock = threading.Lock()
+
+def current() -> Optional[ConfigSnapshot]:
+  """The live snapshot, None when nothing loaded one (e.g. the CLI)."""
+  return _snapshot
+
+def _build(previous: Optional[ConfigSnapshot]) -> ConfigSnapshot:
+  merge_defaults_into_config()
+  raw = load_config()
+  settings: Dict[str, DefaultSettings] = {}
+  errors: Dict[str, str] = {}
+  inputs: Dict[str, tuple] = {}
+
+  for job_name, job_config in raw.items():
+    if not isinstance(job_config, dict) or job_name == PIPELINES_KEY:
+      continue
+    env = job_env(job_name)
+    prefix = f"{job_name.upper()}_"
+    inputs[job_name] = (job_config, {key: value for key, value in env.items() if key.startswith(prefix)})
+    # Jobs whose config and env vars didn't change keep their validated
+    # settings. Errors are checked again, e.g. a missing env var was set
+    if previous and job_name in previous.settings and previous.inputs.get(job_name) == inputs[job_name]:
+      settings[job_name] = previous.settings[job_name]
+      continue
+    try:
+      settings[job_name] = job_settings(job_name, raw, env)
+      # Only enabled jobs running in this process need their requirements here
+      if settings[job_name].enabled and settings[job_name].execution_mode != "subprocess":
+        install_host_requirements(job_name)
+    except Exception as e:
+      # A broken job config shouldn't take the others down with it
+      errors[job_name] = f"Invalid config for job '{job_name}': {e}"
+      if previous and job_name in previous.settings:
+        print(f"{errors[job_name]}\nKeeping the previous config")
+        settings[job_name] = previous.settings[job_name]
+        # Still not validated from the current inputs, checked again next time
+        inputs[job_name] = previous.inputs.get(job_name)
+        del errors[job_name]
+      else:
+        print(errors[job_name])
+
+  return ConfigSnapshot(raw, settings, errors, inputs)
+
+def reload() -> ConfigSnapshot:
+  """Validates the config on disk and swaps it in, then reschedules cron."""
+  global _snapshot
+  with _reload_lock:
+    previous = _snapshot
+    snapshot = _build(previous)
+    _snapshot = snapshot
+
+  if previous is not None and previous.raw != snapshot.raw:
+    from .cron import reconcile_cron
+    try:
+      reconcile_cron(snapshot.raw)
+    except Exception as e:
+      print(f"Failed to reschedule cron jobs: {e}")
+  return snapshot
+
+def _safe_reload() -> None:
+  try:
+    reload()
+  except Exception as e:
+    # e.g. configs.toml saved halfway through an edit, the next save fixes it
+    print(f"Failed to reload config, keeping the previous one: {e}")
+
+def _watched() -> list[Path]:
+  # Settings can come from `.env` files too, see `job_env`
+  return [CONFIGS_PATH, DEFAULTS_PATH] + env_files()
+
+def _watch_set() -> tuple[set, set]:
+  names = {path.resolve() for path in _watched()}
+  directories = {path.parent for path in names if path.parent.is_dir()}
+  # Jobs added later bring a `.env` of their own, see `env_files`
+  jobs_dir = JOBS_DIR.resolve()
+  if jobs_dir.is_dir():
+    directories |= {jobs_dir} | {path for path in jobs_dir.iterdir() if path.is_dir()}
+  return names, directories
+
+def _watch_inotify(stop: threading.Event) -> None:
+  from watchfiles import watch
+
+  jobs_dir = JOBS_DIR.resolve()
+  while not stop.is_set():
+    names, directories = _watch_set()
+
+    def is_config(_, path: str) -> bool:
+      path = Path(path).resolve()
+      return path in names or path.parent == jobs_dir or (path.name == "job.py" and path.parent.parent == jobs_dir)
+
+    for _ in watch(*directories, watch_filter=is_config, stop_event=stop, recursive=False):
+      _safe_reload()
+      # Watched again from scratch, e.g. with a new job's directory
+      if _watch_set() != (names, directories):
+        break
+
+def _watch_polling(stop: threading.Event) -> None:
+  def mtimes():
+    return tuple(path.stat().st_mtime_ns if path.exists() else None for path in _watched())
+
+  last = mtimes()
+  while not stop.wait(POLL_INTERVAL):
+    now = mtimes()
+    if now != last:
+      last = now
+      _safe_reload()
+
+def watch(stop: threading.Event) -> threading.Thread:
+  """Reloads the config in a background thread whenever its files change."""
+  try:
+    import watchfiles # noqa: F401
+    target = _watch_inotify
+  except ImportError:
+    target = _watch_polling
+
+  def run():
+    try:
+      target(stop)
+    except Exception as e:
+      print(f"Config watcher stopped: {e}")
+
+  thread = threading.Thread(target=run, name="config-watcher", daemon=True)
+  thread.start()
+  return thread
@@ -1,18 +1,23 @@
-from typing import Type, TypeVar, Any
+from typing import Callable, Optional, Type, TypeVar, Any, Mapping
 from pathlib import Path
 import tomllib
+import copy
 import tomli_w
 import importlib
-import os
 from pydantic import BaseModel, ValidationError, create_model
 from pydantic.fields import PydanticUndefined
 from .default_settings import DefaultSettings
-from .cron import update_cron
+from .cron import reconcile_cron
+from .environment_manager import job_env
+from .locks import atomic_write, file_lock
 
 T = TypeVar("T", bound=BaseModel)
 U = TypeVar("U", bound=DefaultSettings)
+V = TypeVar("V")
 CONFIGS_PATH = Path("configs.toml")
 DEFAULTS_PATH = Path("defaults.toml")
+# Table of configs.toml holding pipelines (core/pipelines.py), not a job
+PIPELINES_KEY = "pipelines"
 
 class ConfigError(RuntimeError):
   """Raised when user-editable keys are missing in config,
@@ -36,21 +41,25 @@ def merge_defaults_into_config() -> None:
   with DEFAULTS_PATH.open("rb") as f:
     default_data = tomllib.load(f)
 
-  if CONFIGS_PATH.exists():
-    with CONFIGS_PATH.open("rb") as f:
-      config_data = tomllib.load(f)
-  else:
-    config_data = {}
+  # Several server workers (and the CLI) merge at startup, the read and the
+  # write have to happen as one step
+  with file_lock("config"):
+    config_data = load_config()
 
-  _deep_merge_defaults(default_data, config_data)
+    merged_data = copy.deepcopy(config_data)
+    _deep_merge_defaults(default_data, merged_data)
 
-  with CONFIGS_PATH.open("wb") as f:
-    f.write(tomli_w.dumps(config_data).encode("utf-8"))
+    # Nothing new, don't touch the file (and wake up config watchers)
+    if CONFIGS_PATH.exists() and merged_data == config_data:
+      return
+
+    atomic_write(CONFIGS_PATH, tomli_w.dumps(merged_data).encode("utf-8"))
 
 def _populate_and_validate(
   model: Type[BaseModel],
   data: dict[str, Any],
   prefix: str,
+  env: Mapping[str, str],
   path: str = ""
 ) -> None:
   for name, field in model.model_fields.items():
@@ -71,6 +80,7 @@ def _populate_and_validate(
         field.annotation,
         data[name],
         prefix,
+        env,
         full_path
       )
       continue
@@ -86,7 +96,7 @@ def _populate_and_validate(
     else:
       env_key = f"{prefix}{name.upper()}"
       if name not in data:
-        env_val = os.getenv(env_key)
+        env_val = env.get(env_key)
         if env_val is None and no_default:
           raise ConfigError(
             f"Missing env var '{env_key}' for job '{prefix.lower()}'"
@@ -97,26 +107,31 @@ def _populate_and_validate(
 
 def generate_config(
   cls: Type[T],
-  job_name: str
+  job_name: str,
+  full_data: Optional[dict] = None,
+  env: Optional[Mapping[str, str]] = None
 ) -> T:
   """
   Load and validate config for a job.
   Priority: TOML > prefixed environment variables
+  `full_data` is the already loaded config, read from CONFIGS_PATH if not given.
+  `env` holds the environment variables, the job's (see `job_env`) if not given.
   """
   job_name_upper = job_name.upper()
 
-  if CONFIGS_PATH.exists():
-    with CONFIGS_PATH.open("rb") as f:
-      full_data = tomllib.load(f)
-  else:
-    full_data = {}
+  if full_data is None:
+    full_data = load_config()
 
   if job_name not in full_data:
     raise KeyError(f"Configuration for job '{job_name}' not found")
 
-  job_data = full_data[job_name]
+  # Populating env vars shouldn't leak into the caller's copy
+  job_data = copy.deepcopy(full_data[job_name])
 
-  _populate_and_validate(cls, job_data, f"{job_name_upper}_")
+  if env is None:
+    env = job_env(job_name)
+
+  _populate_and_validate(cls, job_data, f"{job_name_upper}_", env)
 
   try:
     return cls(**job_data)
@@ -125,6 +140,25 @@ def generate_config(
       f"Pydantic validation failed for job '{job_name}':\n{e}"
     ) from e
 
+def job_settings(job_name: str, full_data: Optional[dict] = None, env: Optional[Mapping[str, str]] = None) -> DefaultSettings:
+  """
+  Load and validate a job's config against its manifest entry, see
+  core/registry.py. A disabled job is only checked against DefaultSettings,
+  its entry (and maybe venv) isn't built until the job is enabled.
+  """
+  from .registry import settings_model
+
+  if full_data is None:
+    full_data = load_config()
+  job_data = full_data.get(job_name)
+  # `enabled` is user-editable, only the config sets it
+  if isinstance(job_data, dict) and not job_data.get("enabled", False):
+    try:
+      return DefaultSettings(**{"name": job_name, "module": f"jobs/{job_name}/job.py", **job_data})
+    except ValidationError as e:
+      raise ConfigError(f"Pydantic validation failed for job '{job_name}':\n{e}") from e
+  return generate_config(settings_model(job_name), job_name, full_data, env)
+
 def get_settings_cls(job_name: str) -> U:
   job_dir = Path(f"jobs/{job_name}")
   job_path = job_dir / "job.py"
@@ -170,25 +204,63 @@ def _extract_user_editable(model: Type[DefaultSettings]) -> Type[BaseModel]:
 
   return create_model(f"{model.__name__}EditableOnly", **fields)
 
+def _editable_config(job_name: str, value: dict) -> dict:
+  # Validate against the job's manifest entry, job code isn't imported
+  from .registry import VenvNotReadyError, settings_model
+  try:
+    SettingsClass = settings_model(job_name, build_venv=False)
+  except VenvNotReadyError:
+    # A write doesn't wait on pip, the job's own keys are checked when its
+    # config is loaded with the venv built
+    settings = _extract_user_editable(DefaultSettings)(**value)
+    return {**value, **settings.model_dump(exclude_none=True)}
+  return _extract_user_editable(SettingsClass)(**value).model_dump(exclude_none=True)
+
 # TODO: Update this to throw errors instead of print them
 # That way other guys can catch it and handle it
-def save_configs(config: dict):
+def _validate_configs(config: dict, previous: dict) -> dict:
   final_config = {}
   for job_name, value in config.items():
-    if isinstance(value, dict):
-      # Validate
-      SettingsClass = get_settings_cls(job_name)
-      EditableSettings = _extract_user_editable(SettingsClass)
-      settings = EditableSettings(**value)
-
-      final_config[job_name] = settings.model_dump(exclude_none=True)
-      update_cron(job_name, final_config[job_name])
+    if job_name == PIPELINES_KEY:
+      from .pipelines import Pipeline
+      for pipeline in value.values():
+        Pipeline(**pipeline)
+      final_config[job_name] = value
+    elif isinstance(value, dict):
+      # Tables that didn't change were validated when they were written
+      if value == previous.get(job_name):
+        final_config[job_name] = value
+      else:
+        final_config[job_name] = _editable_config(job_name, value)
     else:
       # raise? Do I need to make it atomic?
       print(f"Error: Configuration has to be a dictionary\n\n job: {job_name}\n value: {value}")
+  return final_config
 
-  with CONFIGS_PATH.open("wb") as f:
-    f.write(tomli_w.dumps(final_config).encode("utf-8"))
+def save_configs(config: dict):
+  with file_lock("config"):
+    final_config = _validate_configs(config, load_config())
+    atomic_write(CONFIGS_PATH, tomli_w.dumps(final_config).encode("utf-8"))
+
+  reconcile_cron(final_config)
+
+def update_configs(update: Callable[[dict], V]) -> V:
+  """
+  Applies `update` to the config on disk, then validates and saves it. The
+  read and the write happen as one step, a concurrent change isn't lost.
+
+  Returns:
+    Whatever `update` returns.
+  """
+  with file_lock("config"):
+    previous = load_config()
+    config = copy.deepcopy(previous)
+    result = update(config)
+    final_config = _validate_configs(config, previous)
+    atomic_write(CONFIGS_PATH, tomli_w.dumps(final_config).encode("utf-8"))
+
+  reconcile_cron(final_config)
+  return result
 
 def load_config() -> dict:
   if CONFIGS_PATH.exists():
@@ -0,0 +1,144 @@
+import asyncio
+import json
+import os
+import socket
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+
+# Control plane for a running server: the CLI sends commands over a Unix
+# domain socket so they run in the warm server process instead of a fresh
+# interpreter, and falls back to running them itself when no server listens
+SOCKET_PATH = Path(os.getenv("CONTROL_SOCKET", ".webhook.sock"))
+
+class ControlError(RuntimeError):
+  """Raised when the server ran a command and it failed."""
+  pass
+
+def is_supported() -> bool:
+  return hasattr(socket, "AF_UNIX")
+
+def request(command: str, **args: Any) -> Optional[Any]:
+  """
+  Runs a command on the running server.
+
+  Args:
+    command: One of the commands in `HANDLERS`.
+    **args: The command's arguments, JSON serializable.
+
+  Returns:
+    A dict with the command's result under `result`, or None if no server is
+    listening (the caller should run the command itself).
+
+  Raises:
+    ControlError: If the server ran the command and it failed.
+  """
+  if not is_supported() or not SOCKET_PATH.exists():
+    return None
+
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+    try:
+      client.connect(str(SOCKET_PATH))
+    except (ConnectionRefusedError, FileNotFoundError):
+      # Stale socket left behind by a server that didn't shut down cleanly
+      return None
+    client.sendall(json.dumps({"command": command, "args": args}).encode() + b"\n")
+
+    with client.makefile("rb") as stream:
+      line = stream.readline()
+
+  if not line:
+    raise ControlError(f"Server closed the connection while running '{command}'")
+  response = json.loads(line)
+  if not response.get("ok"):
+    raise ControlError(response.get("error", "Unknown error"))
+  return response
+
+def _handlers() -> Dict[str, Callable[..., Any]]:
+  from . import commands
+  from .job_runner import run_items, run_job
+  from .pipelines import run_pipeline
+
+  return {
+    "run-job": lambda job_name, payload=None: run_job(job_name, payload=payload or {}),
+    "run-batch": lambda items, parallelism=4: run_items([tuple(item) for item in items], parallelism),
+    "run-pipeline": lambda pipeline_name, payload=None: run_pipeline(pipeline_name, payload),
+    "enable": lambda job_name: commands.toggle_job(job_name, True),
+    "disable": lambda job_name: commands.toggle_job(job_name, False),
+    "set": lambda kv_pairs: commands.set_values(kv_pairs),
+    "setup-scheduler": lambda dry_run=False: [change._asdict() for change in commands.setup_scheduler(dry_run)],
+    "ping": lambda: "pong",
+  }
+
+async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, handlers: Dict[str, Callable[..., Any]]) -> None:
+  try:
+    line = await reader.readline()
+    if not line:
+      return
+    message = json.loads(line)
+    handler = handlers.get(message.get("command"))
+    if handler is None:
+      response = {"ok": False, "error": f"Unknown command: {message.get('command')}"}
+    else:
+      try:
+        # Commands block (subprocesses, file writes), keep the event loop free
+        result = await asyncio.to_thread(handler, **message.get("args", {}))
+        response = {"ok": True, "result": result}
+      except Exception as exc:
+        response = {"ok": False, "error": str(exc)}
+    writer.write(json.dumps(response, default=str).encode() + b"\n")
+    await writer.drain()
+  finally:
+    writer.close()
+
+# Held by the worker owning the socket, so workers starting together don't
+# unlink each other's socket
+_owner_lock: Optional[ExitStack] = None
+
+async def serve() -> Optional[asyncio.AbstractServer]:
+  """
+  Starts listening on `SOCKET_PATH`, returns None if the platform has no Unix
+  sockets or another server (or worker of this server) already owns the socket.
+  """
+  global _owner_lock
+  from .locks import LockBusyError, file_lock
+
+  if not is_supported():
+    return None
+
+  lock = ExitStack()
+  try:
+    lock.enter_context(file_lock("control", blocking=False))
+  except LockBusyError:
+    return None
+  _owner_lock = lock
+
+  if SOCKET_PATH.exists():
+    if request("ping") is not None:
+      print(f"Control socket {SOCKET_PATH} is owned by another server, not listening")
+      _release_owner_lock()
+      return None
+    SOCKET_PATH.unlink()
+
+  handlers = _handlers()
+  server = await asyncio.start_unix_server(
+    lambda reader, writer: _handle(reader, writer, handlers),
+    path=str(SOCKET_PATH)
+  )
+  # Anyone who can connect can run jobs and change the config
+  os.chmod(SOCKET_PATH, 0o600)
+  return server
+
+def _release_owner_lock() -> None:
+  global _owner_lock
+  if _owner_lock is not None:
+    _owner_lock.close()
+    _owner_lock = None
+
+async def close(server: Optional[asyncio.AbstractServer]) -> None:
+  if server is None:
+    return
+  server.close()
+  await server.wait_closed()
+  SOCKET_PATH.unlink(missing_ok=True)
+  _release_owner_lock()
@@ -1,34 +1,141 @@
 import sys
-from crontab import CronTab
+from functools import cache
 from pathlib import Path
+from typing import NamedTuple, Optional
 
-# Replace with your user (or system=True if you want system-level crons)
-cron = CronTab(user=True)
 root_dir = Path.cwd()
 
-def update_cron(job_name: str, job_config: dict = None):
-  from .config_utils import load_config
-  if not job_config:
-    config = load_config()
-    job_config = config[job_name]
-
-  job_exists = False
-  for job in cron.find_comment(job_name):
-    job_exists = True
-    break
-
-  if isinstance(job_config, dict):
-    if job_config.get("enabled", False) and job_config.get("cron", None):
-      if not job_exists:
-        command = f"cd {root_dir} && {sys.executable} -m cli run-job {job_name} >> /var/log/{job_name}.log 2>&1"
-        job = cron.new(command=command, comment=job_name)
-        job.setall(job_config["cron"])
-        if not job.is_valid():
-          print(f"Invalid cron schedule: {job_config['cron']}")
-        cron.write()
-    else:
-      # If job is disabled, or cron is not set, remove from cron
-      if job_exists:
-        for job in cron.find_comment(job_name):
-          cron.remove(job)
-        cron.write()
+# Every entry written by the webhook is tagged with the job and the checkout,
+# so entries added by hand or by another checkout are never touched
+TAG_PREFIX = "webhook:"
+
+class CronChange(NamedTuple):
+  action: str # add | remove | update
+  job_name: str
+  old: Optional[str] = None
+  new: Optional[str] = None
+
+# Reading the crontab shells out to `crontab -l`, so it's only done the first
+# time a command actually needs it
+@cache
+def get_cron():
+  from crontab import CronTab
+  # Replace with your user (or system=True if you want system-level crons)
+  return CronTab(user=True)
+
+def _command(job_name: str) -> str:
+  return f"cd {root_dir} && {sys.executable} -m cli run-job {job_name} >> /var/log/{job_name}.log 2>&1"
+
+def _tag(job_name: str) -> str:
+  return f"{TAG_PREFIX}{job_name}@{root_dir}"
+
+def _managed_job_name(entry) -> Optional[str]:
+  """The job of an entry written by this checkout, None for any other entry."""
+  comment = entry.comment or ""
+  if comment.startswith(TAG_PREFIX):
+    job_name, _, checkout = comment[len(TAG_PREFIX):].partition("@")
+    if checkout:
+      return job_name if checkout == str(root_dir) else None
+  elif comment and "-m cli run-job" in entry.command:
+    # Written before tagging, with the bare job name as comment
+    job_name = comment
+  else:
+    return None
+  # No checkout in the comment, the directory the entry runs in tells
+  return job_name if entry.command.startswith(f"cd {root_dir} && ") else None
+
+def _render(schedule: str, command: str, comment: str) -> str:
+  return f"{schedule} {command} # {comment}"
+
+def desired_entries(config: dict) -> dict[str, str]:
+  """Returns the cron schedule of every enabled job with a `cron` setting."""
+  from crontab import CronSlices
+
+  entries = {}
+  for job_name, job_config in config.items():
+    if not isinstance(job_config, dict):
+      continue
+    if not (job_config.get("enabled", False) and job_config.get("cron", None)):
+      continue
+    if not CronSlices.is_valid(job_config["cron"]):
+      print(f"Invalid cron schedule: {job_config['cron']}")
+      continue
+    # Normalised the same way entries read from the crontab are
+    entries[job_name] = CronSlices(job_config["cron"]).render()
+  return entries
+
+def plan_cron(desired: dict[str, str]) -> list[CronChange]:
+  """
+  Diffs the entries returned by `desired_entries` against the entries of
+  this checkout in the crontab.
+  """
+  current: dict[str, list] = {}
+  for entry in get_cron():
+    job_name = _managed_job_name(entry)
+    if job_name:
+      current.setdefault(job_name, []).append(entry)
+
+  changes: list[CronChange] = []
+  for job_name, schedule in desired.items():
+    new = _render(schedule, _command(job_name), _tag(job_name))
+    entries = current.pop(job_name, [])
+    if not entries:
+      changes.append(CronChange("add", job_name, new=new))
+      continue
+    old = _render(entries[0].slices.render(), entries[0].command, entries[0].comment)
+    if len(entries) > 1 or old != new:
+      changes.append(CronChange("update", job_name, old=old, new=new))
+
+  for job_name, entries in current.items():
+    for entry in entries:
+      changes.append(CronChange("remove", job_name, old=_render(entry.slices.render(), entry.command, entry.comment)))
+
+  return changes
+
+def format_changes(changes: list[CronChange]) -> str:
+  lines = []
+  for change in changes:
+    if change.old:
+      lines.append(f"- {change.old}")
+    if change.new:
+      lines.append(f"+ {change.new}")
+  return "\n".join(lines)
+
+def reconcile_cron(config: dict, dry_run: bool = False) -> list[CronChange]:
+  """
+  Brings the crontab in line with the config, every add, removal and schedule
+  change goes out in a single crontab write.
+
+  Args:
+    config: The whole config, job names to job settings.
+    dry_run: Only compute the changes.
+
+  Returns:
+    The changes that were (or would be) applied.
+  """
+  from .locks import file_lock
+
+  desired = desired_entries(config)
+  if dry_run:
+    # Other workers and checkouts may have written to it since it was loaded
+    get_cron().read()
+    return plan_cron(desired)
+
+  # Every server worker reconciles on config changes, the crontab is re-read
+  # under the lock so one worker doesn't overwrite what another just wrote
+  with file_lock("cron"):
+    cron = get_cron()
+    cron.read()
+    changes = plan_cron(desired)
+    if not changes:
+      return changes
+
+    for change in changes:
+      if change.action in ("update", "remove"):
+        cron.remove(*[entry for entry in cron if _managed_job_name(entry) == change.job_name])
+      if change.action in ("add", "update"):
+        entry = cron.new(command=_command(change.job_name), comment=_tag(change.job_name))
+        entry.setall(desired[change.job_name])
+
+    cron.write()
+  return changes
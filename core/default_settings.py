@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import Optional, Optional, Generic, TypeVar
+from typing import Literal, Optional, Optional, Generic, TypeVar
 
 T = TypeVar("T")
 
@@ -13,3 +13,35 @@ class DefaultSettings(BaseModel, Generic[T]):
   cron: Optional[str] = config_field(None, True, description="Cron expression for scheduling the job")
   enabled: bool = config_field(False, True, description="Whether the job is enabled or not")
   defaults: Optional[T] = config_field(None, description="Default values for the job")
+
+  # Request bodies over `payload_spool_threshold` are streamed to a file and
+  # the job gets a `core.payload.PayloadFile` instead of a dict
+  payload_spool_threshold: Optional[int] = config_field(None, True, ge=0, description="Body size in bytes above which the payload is spooled to a file")
+  max_payload_size: Optional[int] = config_field(None, True, gt=0, description="Largest accepted request body, in bytes")
+
+  # Trusted jobs can skip the venv and the process, see `_run_in_process` in
+  # core/job_runner.py. The limits below only apply to `subprocess`
+  execution_mode: Literal["subprocess", "thread", "asyncio"] = config_field("subprocess", True, description="Whether the job runs in its own process, or in the server's on a thread or an event loop")
+
+  # Limits of the job process
+  timeout: Optional[float] = config_field(None, True, gt=0, description="Wall-clock seconds before the job's process group is killed")
+  cpu_time_limit: Optional[int] = config_field(None, True, gt=0, description="CPU seconds the job process may use (RLIMIT_CPU)")
+  memory_limit: Optional[int] = config_field(None, True, gt=0, description="Address space limit of the job process, in MB (RLIMIT_AS)")
+  nice: Optional[int] = config_field(None, True, ge=0, le=19, description="Nice increment of the job process")
+  ionice_class: Optional[Literal["realtime", "best-effort", "idle"]] = config_field(None, True, description="IO scheduling class of the job process")
+  ionice_level: Optional[int] = config_field(None, True, ge=0, le=7, description="IO priority within `ionice_class`, 0 is highest")
+
+  # Memory accounting of the job process, see core/memory.py
+  memory_budget: Optional[int] = config_field(None, True, gt=0, description="Peak RSS of the job process in MB above which `memory_budget_action` is taken")
+  memory_budget_action: Literal["warn", "abort"] = config_field("warn", True, description="Whether a job over its memory budget logs a warning or is aborted")
+  memory_snapshot_top: Optional[int] = config_field(None, True, gt=0, description="Top allocation sites reported with the run's memory, traced with tracemalloc (slower)")
+
+  # Results of acknowledged runs are reused for identical payloads, see core/result_cache.py
+  cache_ttl: Optional[float] = config_field(None, True, gt=0, description="Seconds an acknowledged run's result is reused for the same payload")
+  cache_max_entries: int = config_field(128, True, gt=0, description="Cached results kept per job, least recently used go first")
+
+  # Values the job keeps between runs through `context.cache`, see core/job_cache.py
+  job_cache_max_size: int = config_field(64, True, gt=0, description="Size of the job's persistent cache in MB, least recently used values are evicted")
+
+  # Runs of an exclusive job never overlap, across server workers and the CLI
+  exclusive: bool = config_field(False, True, description="Whether runs of the job wait for the previous one to finish")
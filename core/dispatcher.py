@@ -0,0 +1,76 @@
+import os
+import socket
+import threading
+import traceback
+import uuid
+from typing import Optional
+from . import queue, tracing
+from .payload import PayloadFile
+
+# Threads per server worker running queued jobs. Jobs run in their own
+# process, so these threads mostly wait; more workers (`WORKERS`) or more
+# threads both add parallel runs
+THREADS = int(os.getenv("DISPATCH_THREADS", 4))
+# Seconds between checks for runs enqueued by other workers
+POLL_INTERVAL = 1.0
+
+_wakeup = threading.Event()
+
+def notify() -> None:
+  """Wakes this worker's threads up, a run was just enqueued."""
+  _wakeup.set()
+
+def _keep_lease(run_id: int, owner: str, done: threading.Event) -> None:
+  while not done.wait(queue.LEASE_SECONDS / 3):
+    if not queue.heartbeat(run_id, owner):
+      print(f"Lost the lease on run {run_id}")
+      return
+
+def _execute(run: queue.Run, owner: str) -> None:
+  from .job_runner import run_job
+
+  done = threading.Event()
+  heartbeat = threading.Thread(target=_keep_lease, args=(run.id, owner, done), daemon=True)
+  heartbeat.start()
+  try:
+    with tracing.remote_parent(run.traceparent), tracing.span("queue.run", run_id=run.id, job=run.job_name, attempt=run.attempts):
+      result = run_job(run.job_name, payload=run.payload)
+  except Exception as e:
+    print(f"Run {run.id} of job '{run.job_name}' failed: {e}")
+    finished = queue.fail(run.id, owner, str(e))
+  else:
+    finished = queue.complete(run.id, owner, result)
+  finally:
+    done.set()
+    heartbeat.join()
+
+  # A run whose lease ran out was requeued and still needs its payload
+  if isinstance(run.payload, PayloadFile):
+    if finished:
+      run.payload.unlink()
+    else:
+      run.payload.close()
+
+def _work(owner: str, stop: threading.Event) -> None:
+  while not stop.is_set():
+    try:
+      run = queue.claim(owner)
+    except Exception:
+      traceback.print_exc()
+      run = None
+    if run is None:
+      _wakeup.wait(POLL_INTERVAL)
+      _wakeup.clear()
+      continue
+    _execute(run, owner)
+
+def start(stop: threading.Event, threads: Optional[int] = None) -> list[threading.Thread]:
+  """Starts the threads running queued jobs until `stop` is set."""
+  workers = []
+  for index in range(THREADS if threads is None else threads):
+    # Leases are owned per thread, a dead worker's runs are told apart by host and pid
+    owner = f"{socket.gethostname()}:{os.getpid()}:{index}:{uuid.uuid4().hex[:8]}"
+    thread = threading.Thread(target=_work, args=(owner, stop), name=f"dispatcher-{index}", daemon=True)
+    thread.start()
+    workers.append(thread)
+  return workers
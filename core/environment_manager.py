@@ -1,32 +1,157 @@
 import os
 import subprocess
+import threading
+import hashlib
 from pathlib import Path
-from dotenv import load_dotenv
+from typing import Dict, List, Optional, Tuple
+from dotenv import dotenv_values
+from .locks import file_lock
 import sys
 
 JOBS_DIR = Path("jobs")
 VENVS_DIR = Path(".venvs")
+# Wheels are built once and shared by every venv
+WHEELS_DIR = VENVS_DIR / ".wheels"
+# Written once a venv is fully installed, an interrupted install is redone
+READY_MARKER = ".ready"
 
-def prepare_venv(job_name: str) -> Path:
-  venv_path = VENVS_DIR / job_name
-  if not venv_path.exists():
-    subprocess.run([sys.executable, "-m", "venv", str(venv_path)], check=True)
+def venv_python(venv_path: Path) -> Path:
   if os.name == "nt":
     python_path = venv_path / "Scripts" / "python.exe"
     if not python_path.exists(): # fallback for MSYS2 layout (bash for windows python3 alias)
       python_path = venv_path / "bin" / "python.exe"
   else:
     python_path = venv_path / "bin" / "python"
+  return python_path
+
+def resolve_requirements(req_file: Path) -> list[str]:
+  """
+  Flattens a requirements file, following `-r` includes, so jobs that end up
+  with the same dependencies resolve to the same list.
+  """
+  requirements: list[str] = []
+  for raw_line in req_file.read_text(encoding="utf-8").splitlines():
+    line = raw_line.split(" #", 1)[0].strip()
+    if not line or line.startswith("#"):
+      continue
+    for flag in ("-r ", "--requirement "):
+      if line.startswith(flag):
+        requirements.extend(resolve_requirements(req_file.parent / line[len(flag):].strip()))
+        break
+    else:
+      requirements.append(line)
+  return sorted(set(requirements))
+
+def job_requirements(job_name: str) -> list[str]:
   req_file = JOBS_DIR / job_name / "requirements.txt"
+  if not req_file.exists():
+    return []
+  return resolve_requirements(req_file)
+
+def requirements_hash(requirements: list[str]) -> str:
+  # Venvs are tied to the interpreter that created them
+  digest = hashlib.sha256(f"{sys.version}\n{sys.platform}\n".encode("utf-8"))
+  digest.update("\n".join(requirements).encode("utf-8"))
+  return digest.hexdigest()[:16]
+
+def _install(python_path: Path, requirements: list[str], req_file: Path) -> None:
+  req_file.write_text("\n".join(requirements) + "\n", encoding="utf-8")
+  WHEELS_DIR.mkdir(parents=True, exist_ok=True)
+  offline = [str(python_path), "-m", "pip", "install", "--no-index", "--find-links", str(WHEELS_DIR), "-r", str(req_file)]
+
+  # Every wheel is already cached -> no resolving against the index, no builds
+  if subprocess.run(offline, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0:
+    return
+
+  subprocess.run(
+    [str(python_path), "-m", "pip", "wheel", "--find-links", str(WHEELS_DIR), "-w", str(WHEELS_DIR), "-r", str(req_file)],
+    check=True
+  )
+  subprocess.run(offline, check=True)
+
+def ready_venv(job_name: str) -> Optional[Path]:
+  """The job's venv if it's built already, None otherwise."""
+  venv_path = VENVS_DIR / requirements_hash(job_requirements(job_name))
+  return venv_path if (venv_path / READY_MARKER).exists() else None
+
+def prepare_venv(job_name: str) -> Path:
+  """
+  Returns a venv with the job's requirements installed.
+
+  Venvs are keyed by a hash of the resolved requirements, so jobs with the
+  same dependencies share one, and packages come from a local wheel cache.
+  """
+  requirements = job_requirements(job_name)
+  key = requirements_hash(requirements)
+  venv_path = VENVS_DIR / key
+
+  if (venv_path / READY_MARKER).exists():
+    return venv_path
+
+  # Two runs of jobs with the same dependencies shouldn't build the same venv
+  # at once
+  with file_lock(f"venv-{key}"):
+    if (venv_path / READY_MARKER).exists():
+      return venv_path
+    if not venv_path.exists():
+      subprocess.run([sys.executable, "-m", "venv", str(venv_path)], check=True)
+    if requirements:
+      _install(venv_python(venv_path), requirements, venv_path / "requirements.txt")
+    (venv_path / READY_MARKER).write_text(job_name, encoding="utf-8")
 
-  if req_file.exists():
-    subprocess.run([str(python_path), "-m", "pip", "install", "-r", str(req_file)], check=True)
   return venv_path
 
-def load_env(job_name: str):
-  env_path = Path(".env")
-  if env_path.exists():
-    load_dotenv(dotenv_path=env_path)
-  job_env_path = JOBS_DIR / job_name / ".env"
-  if job_env_path.exists():
-    load_dotenv(dotenv_path=job_env_path)
\ No newline at end of file
+def install_host_requirements(job_name: str) -> None:
+  """Installs the job's requirements in the current interpreter, once per requirements set."""
+  requirements = job_requirements(job_name)
+  if not requirements:
+    return
+  key = requirements_hash(requirements + [sys.executable])
+  marker = VENVS_DIR / f".host-{key}"
+  if marker.exists():
+    return
+
+  with file_lock(f"venv-host-{key}"):
+    if marker.exists():
+      return
+    _install(Path(sys.executable), requirements, VENVS_DIR / f".host-{key}.txt")
+    marker.touch()
+
+# Parsed `.env` files, parsed again only when their mtime changes
+_dotenv_cache: Dict[Path, Tuple[int, Dict[str, str]]] = {}
+_dotenv_lock = threading.Lock()
+
+def _dotenv(path: Path) -> Dict[str, str]:
+  try:
+    mtime = path.stat().st_mtime_ns
+  except FileNotFoundError:
+    return {}
+  with _dotenv_lock:
+    cached = _dotenv_cache.get(path)
+    if cached is None or cached[0] != mtime:
+      values = {key: value for key, value in dotenv_values(path).items() if value is not None}
+      cached = _dotenv_cache[path] = (mtime, values)
+  return cached[1]
+
+def job_env(job_name: str) -> Dict[str, str]:
+  """
+  The environment a run of the job sees: the job's `.env`, overridden by the
+  root `.env`, overridden by the server's own environment. `os.environ` is
+  left alone, one job's variables never show up in another's runs.
+  """
+  env: Dict[str, str] = {}
+  for path in (JOBS_DIR / job_name / ".env", Path(".env")):
+    env.update(_dotenv(path))
+  env.update(os.environ)
+  return env
+
+def env_files() -> List[Path]:
+  """The root `.env` and every job's, whether they exist or not."""
+  return [Path(".env")] + sorted(path.parent / ".env" for path in JOBS_DIR.glob("*/job.py"))
+
+def getenv(name: str, default: Optional[str] = None) -> Optional[str]:
+  """A setting of the server itself (e.g. `PORT`), from its environment or the root `.env`."""
+  value = os.environ.get(name)
+  if value is None:
+    value = _dotenv(Path(".env")).get(name)
+  return default if value is None else value
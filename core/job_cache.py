@@ -0,0 +1,162 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional
+
+# Values jobs keep between runs, see `JobContext.cache`. Each job has its own
+# SQLite file, split into namespaces. Values are JSON, and the least recently
+# used ones are evicted once the file holds more than `job_cache_max_size`
+CACHE_DIR = Path(os.getenv("JOB_CACHE_DIR", ".webhook/cache"))
+DEFAULT_NAMESPACE = "default"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+  namespace TEXT NOT NULL,
+  key TEXT NOT NULL,
+  value TEXT NOT NULL,
+  size INTEGER NOT NULL,
+  expires_at REAL,
+  accessed_at REAL NOT NULL,
+  PRIMARY KEY (namespace, key)
+);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed_at);
+"""
+
+class _Store:
+  """The SQLite file of one job, shared by all of its namespaces."""
+
+  def __init__(self, path: Path, max_size: int):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    self.max_size = max_size
+    # Threads of a batch share the connection, the lock keeps them apart
+    self.lock = threading.Lock()
+    self.connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+    self.connection.execute("PRAGMA journal_mode=WAL")
+    self.connection.execute("PRAGMA synchronous=NORMAL")
+    self.connection.executescript(_SCHEMA)
+
+  def evict(self, now: float) -> None:
+    """Drops expired entries, then the least recently used ones until under `max_size`."""
+    self.connection.execute("DELETE FROM entries WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+    (size,) = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()
+    if size <= self.max_size:
+      return
+    freed = 0
+    rows = self.connection.execute("SELECT namespace, key, size FROM entries ORDER BY accessed_at").fetchall()
+    evicted = []
+    for namespace, key, entry_size in rows:
+      if size - freed <= self.max_size:
+        break
+      evicted.append((namespace, key))
+      freed += entry_size
+    self.connection.executemany("DELETE FROM entries WHERE namespace = ? AND key = ?", evicted)
+
+  def close(self) -> None:
+    self.connection.close()
+
+class JobCache:
+  """
+  A namespace of a job's persistent cache.
+
+  Args:
+    store: The job's SQLite file.
+    namespace: Keys of different namespaces never collide.
+  """
+
+  def __init__(self, store: _Store, namespace: str = DEFAULT_NAMESPACE):
+    self._store = store
+    self.namespace_name = namespace
+
+  def namespace(self, name: str) -> "JobCache":
+    """Another namespace of the same cache."""
+    return JobCache(self._store, name)
+
+  def get(self, key: str, default: Any = None) -> Any:
+    return self.get_many([key]).get(key, default)
+
+  def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+    """The fresh values of `keys`, missing and expired keys are left out."""
+    keys = list(dict.fromkeys(keys))
+    if not keys:
+      return {}
+    now = time.time()
+    found: Dict[str, Any] = {}
+    with self._store.lock:
+      connection = self._store.connection
+      # SQLite limits the number of variables per statement
+      for start in range(0, len(keys), 500):
+        chunk = keys[start:start + 500]
+        placeholders = ",".join("?" * len(chunk))
+        rows = connection.execute(
+          f"SELECT key, value FROM entries WHERE namespace = ? AND key IN ({placeholders})"
+          " AND (expires_at IS NULL OR expires_at > ?)",
+          (self.namespace_name, *chunk, now),
+        ).fetchall()
+        found.update((key, json.loads(value)) for key, value in rows)
+      if found:
+        connection.executemany(
+          "UPDATE entries SET accessed_at = ? WHERE namespace = ? AND key = ?",
+          [(now, self.namespace_name, key) for key in found],
+        )
+    return found
+
+  def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+    self.set_many({key: value}, ttl)
+
+  def set_many(self, values: Dict[str, Any], ttl: Optional[float] = None) -> None:
+    """
+    Stores JSON serializable `values`.
+
+    Args:
+      ttl: Seconds the values stay fresh, forever (until evicted) if None.
+    """
+    if not values:
+      return
+    now = time.time()
+    expires_at = now + ttl if ttl else None
+    rows = []
+    for key, value in values.items():
+      data = json.dumps(value, separators=(",", ":"))
+      rows.append((self.namespace_name, key, data, len(data), expires_at, now))
+    with self._store.lock:
+      connection = self._store.connection
+      connection.execute("BEGIN IMMEDIATE")
+      try:
+        connection.executemany(
+          "INSERT OR REPLACE INTO entries (namespace, key, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)",
+          rows,
+        )
+        self._store.evict(now)
+        connection.execute("COMMIT")
+      except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+
+  def delete(self, key: str) -> None:
+    self.delete_many([key])
+
+  def delete_many(self, keys: Iterable[str]) -> None:
+    with self._store.lock:
+      self._store.connection.executemany(
+        "DELETE FROM entries WHERE namespace = ? AND key = ?",
+        [(self.namespace_name, key) for key in keys],
+      )
+
+  def clear(self) -> None:
+    """Drops every value of this namespace."""
+    with self._store.lock:
+      self._store.connection.execute("DELETE FROM entries WHERE namespace = ?", (self.namespace_name,))
+
+  def __contains__(self, key: str) -> bool:
+    return key in self.get_many([key])
+
+  def close(self) -> None:
+    """Closes the job's cache file, for every namespace."""
+    self._store.close()
+
+def open_cache(job_name: str, max_size_mb: int) -> JobCache:
+  """The default namespace of the job's cache."""
+  return JobCache(_Store(CACHE_DIR / f"{job_name}.db", max_size_mb * 1024 * 1024))
@@ -0,0 +1,43 @@
+import inspect
+import os
+from typing import Any, Callable, Dict, Optional
+from .default_settings import DefaultSettings
+from .job_cache import JobCache, open_cache
+
+class JobContext:
+  """
+  Passed to a job's `run()` as `context` when its signature takes it.
+
+  Args:
+    job_name: The job being run.
+    config: The job's settings.
+    env: Environment variables of this run, a copy of `os.environ` by default.
+      Jobs running in the server process (see `execution_mode`) share
+      `os.environ`, they should read `context.env` instead.
+  """
+
+  def __init__(self, job_name: str, config: DefaultSettings, env: Optional[Dict[str, str]] = None):
+    self.job_name = job_name
+    self.config = config
+    self.env = dict(env if env is not None else os.environ)
+    self._cache: Optional[JobCache] = None
+
+  @property
+  def cache(self) -> JobCache:
+    """The job's persistent cache, see core/job_cache.py. Opened on first use."""
+    if self._cache is None:
+      self._cache = open_cache(self.job_name, self.config.job_cache_max_size)
+    return self._cache
+
+  def close(self) -> None:
+    if self._cache is not None:
+      self._cache.close()
+      self._cache = None
+
+def run_kwargs(run: Callable, config: DefaultSettings, payload: Any, context: JobContext) -> Dict[str, Any]:
+  """Arguments for the job's `run()`, older jobs don't take a context."""
+  kwargs = {"config": config, "payload": payload}
+  parameters = inspect.signature(run).parameters
+  if "context" in parameters or any(p.kind == inspect.Parameter.VAR_KEYWORD for p in parameters.values()):
+    kwargs["context"] = context
+  return kwargs
@@ -1,119 +1,414 @@
+import asyncio
+import contextvars
+import inspect
 import json
+import math
 import sys
 import os
 import importlib
-import subprocess
-from typing import Any, Dict, Optional, TypeVar
-from pathlib import Path
-from fastapi import APIRouter, BackgroundTasks, Body, Depends, HTTPException, Request, status
-from fastapi.responses import JSONResponse, Response
-from .config_utils import generate_config, get_settings_cls, merge_defaults_into_config
-from .environment_manager import prepare_venv, load_env
+import time
+import signal
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import ExitStack, closing, nullcontext
+from typing import Any, Callable, Dict, Optional, TypeVar, Union
+from queue import Empty, Queue
+from . import config_store, tracing
+from .config_utils import get_settings_cls, job_settings, merge_defaults_into_config
+from .environment_manager import install_host_requirements, job_env, prepare_venv, venv_python
 from .default_settings import DefaultSettings
+from .job_context import JobContext, run_kwargs
+from .locks import file_lock
+from .memory import MemoryMonitor
+from .limits import JobTimeoutError, apply_limits, priority_prefix, run_process, usage
+from .payload import PayloadFile
 
 T = TypeVar("U", bound=DefaultSettings)
 
-# TODO: Make return value a pydantic model
-def run_job(job_name: str, payload: dict = {}) -> dict:
+# Runs of `thread` jobs going at the same time, each on a thread of its own.
+# A run that timed out gives its slot back, its thread keeps going
+IN_PROCESS_THREADS = int(os.getenv("IN_PROCESS_THREADS", "8"))
+_in_process_slots = threading.BoundedSemaphore(IN_PROCESS_THREADS)
+# Runs of `asyncio` jobs, on a loop of their own so they can't stall the server's
+_job_loop: Optional[asyncio.AbstractEventLoop] = None
+_in_process_lock = threading.Lock()
+# Seconds the main thread of a batch job process waits on its runs at a time,
+# a memory budget abort only gets to it in between
+BATCH_POLL_INTERVAL = 0.1
+
+def load_job_config(job_name: str) -> DefaultSettings:
+  snapshot = config_store.current()
+  if snapshot is not None:
+    # The server keeps the validated config in memory, see core/config_store.py
+    return snapshot.get(job_name)
+
   # Sanity check
   merge_defaults_into_config()
 
-  load_env(job_name)
+  config = job_settings(job_name)
+  # Enabled jobs running in this process need their dependencies here
+  if config.enabled and config.execution_mode != "subprocess":
+    install_host_requirements(job_name)
+  return config
+
+def _run_job_process(job_name: str, config: DefaultSettings, stdin_data: dict, timeout: Optional[float]) -> dict:
+  with tracing.span("run_job.prepare_venv", job=job_name):
+    venv_path = prepare_venv(job_name)
+
+  module_path = "core.job_runner"
+
+  python_path = venv_python(venv_path)
+
+  # Held by the job's whole run, whichever process (worker, CLI, cron) started it
+  lock = file_lock(f"job-{job_name}") if config.exclusive else nullcontext()
+  with lock, tracing.span("run_job.process", job=job_name) as span:
+    # The job process' spans are children of this one
+    stdin_data["traceparent"] = tracing.traceparent()
+    result = run_process(
+      priority_prefix(config) + [str(python_path), "-m", module_path],
+      input=json.dumps(stdin_data).encode(),
+      timeout=timeout,
+      env=job_env(job_name),
+    )
+    span.set_attribute("exit_code", result.returncode)
+
+  if result.returncode < 0:
+    # Killed by a signal, e.g. SIGXCPU/SIGKILL from cpu_time_limit
+    raise Exception(f"Job failed, killed by {signal.Signals(-result.returncode).name}\n" + result.stderr.decode())
+  if result.returncode != 0:
+    raise Exception("Job failed\n" + result.stderr.decode())
+  
+  try:
+    return json.loads(result.stdout.decode())
+  except json.JSONDecodeError:
+    return {}
+
+def _submit_thread(function: Callable, kwargs: Dict[str, Any], timeout: Optional[float]) -> tuple[Future, Callable[[], None]]:
+  """
+  Runs `function` on a new thread, in a copy of the caller's context.
+
+  Returns:
+    The run's future, and a callable giving its slot back once the caller
+    stops waiting on it.
+
+  Raises:
+    JobTimeoutError: If no slot freed up within `timeout`.
+  """
+  if not _in_process_slots.acquire(timeout=timeout):
+    raise JobTimeoutError(f"Job timed out after {timeout}s waiting for one of the IN_PROCESS_THREADS")
+  # Taken by whichever comes first, the run ending or the caller giving up on it
+  slot_returned = threading.Lock()
+
+  def give_back() -> None:
+    if slot_returned.acquire(blocking=False):
+      _in_process_slots.release()
 
-  # Install dependencies
-  req_file = Path("jobs") / job_name / "requirements.txt"
+  context = contextvars.copy_context()
+  future: Future = Future()
 
-  if req_file.exists():
-    subprocess.run([sys.executable, "-m", "pip", "install", "-r", str(req_file)], check=True)
+  def target() -> None:
+    try:
+      result = context.run(function, **kwargs)
+    except BaseException as e:
+      give_back()
+      future.set_exception(e)
+    else:
+      give_back()
+      future.set_result(result)
+
+  threading.Thread(target=target, name="job", daemon=True).start()
+  return future, give_back
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+  global _job_loop
+  with _in_process_lock:
+    if _job_loop is None:
+      _job_loop = asyncio.new_event_loop()
+      threading.Thread(target=_job_loop.run_forever, name="job-loop", daemon=True).start()
+    return _job_loop
+
+def _submit_coroutine(coroutine) -> tuple[Future, Callable[[], None]]:
+  """
+  Schedules `coroutine` on the job loop, in a copy of the caller's context.
+
+  Returns:
+    The run's future, and a callable cancelling it.
+  """
+  loop = _get_loop()
+  context = contextvars.copy_context()
+  future: Future = Future()
+  task_ready = threading.Event()
+  task = None
+
+  def done(task: asyncio.Task) -> None:
+    if task.cancelled():
+      future.cancel()
+    elif task.exception() is not None:
+      future.set_exception(task.exception())
+    else:
+      future.set_result(task.result())
+
+  def start() -> None:
+    nonlocal task
+    # The task copies the current context, so the job's spans keep their parent
+    task = context.run(loop.create_task, coroutine)
+    task.add_done_callback(done)
+    task_ready.set()
+
+  loop.call_soon_threadsafe(start)
+  task_ready.wait()
+  return future, lambda: loop.call_soon_threadsafe(task.cancel)
+
+def _run_in_process(job_name: str, config: DefaultSettings, payload: Any) -> dict:
+  """
+  Runs a trusted job's `run()` in this process: the module is imported once
+  and runs skip the venv and the process start. A run that times out is
+  reported as such, an `asyncio` run is cancelled but a `thread` run can't be
+  stopped: it keeps the job's lock (`exclusive`) and context until it ends.
+  """
+  job_mod = importlib.import_module(f"jobs.{job_name}.job")
+  # The host's config comes from the job's manifest, the job gets its own class
+  config = get_settings_cls(job_name)(**config.model_dump())
 
-  settings_class = get_settings_cls(job_name)
-  config: DefaultSettings = generate_config(settings_class, job_name)
+  with tracing.span("job.run", job=job_name, execution_mode=config.execution_mode):
+    # Released when the run ends, not when the caller stops waiting on it
+    resources = ExitStack()
+    try:
+      if config.exclusive:
+        resources.enter_context(file_lock(f"job-{job_name}"))
+      started = time.monotonic()
+      context = resources.enter_context(closing(JobContext(job_name, config, env=job_env(job_name))))
+      kwargs = run_kwargs(job_mod.run, config, payload, context)
+      if config.execution_mode == "asyncio":
+        if not inspect.iscoroutinefunction(job_mod.run):
+          raise TypeError(f"execution_mode 'asyncio' needs an async 'run' in jobs.{job_name}.job")
+        future, give_up = _submit_coroutine(job_mod.run(**kwargs))
+      else:
+        future, give_up = _submit_thread(job_mod.run, kwargs, config.timeout)
+    except BaseException:
+      resources.close()
+      raise
+    future.add_done_callback(lambda _: resources.close())
+
+    remaining = None if config.timeout is None else max(0, config.timeout - (time.monotonic() - started))
+    try:
+      output = future.result(timeout=remaining)
+    except FutureTimeoutError:
+      give_up()
+      raise JobTimeoutError(f"Job timed out after {config.timeout}s")
+  return {"output": output}
+
+# TODO: Make return value a pydantic model
+def run_job(job_name: str, payload: Union[dict, PayloadFile] = {}) -> dict:
+  with tracing.span("run_job", job=job_name):
+    return _run_job(job_name, payload)
+
+def _run_job(job_name: str, payload: Union[dict, PayloadFile]) -> dict:
+  with tracing.span("run_job.config", job=job_name):
+    config = load_job_config(job_name)
 
   if not config.enabled:
     return {"message": "Job is disabled in config."}
 
-  venv_path = prepare_venv(job_name)
+  started = time.perf_counter()
+  if config.execution_mode != "subprocess":
+    try:
+      result = _run_in_process(job_name, config, payload or {})
+    except JobTimeoutError:
+      raise
+    except Exception as e:
+      # Same error as a job process would end with
+      raise Exception(f"Job failed\nJob runtime error: {type(e).__name__}: {e}") from e
+    result["duration_seconds"] = round(time.perf_counter() - started, 3)
+    return result
 
-  module_path = "core.job_runner"
+  stdin_data = {
+    "job_name": job_name,
+    "config": config.model_dump(),
+    "payload": payload or {}
+  }
+  # Only the file's location goes through stdin, the job maps the body itself
+  if isinstance(payload, PayloadFile):
+    stdin_data["payload"] = {}
+    stdin_data["payload_file"] = payload.to_dict()
+
+  result = _run_job_process(job_name, config, stdin_data, config.timeout)
+  result["duration_seconds"] = round(time.perf_counter() - started, 3)
+  return result
+
+def run_batch(job_name: str, payloads: list[dict], parallelism: int = 4) -> list[dict]:
+  """
+  Runs the job once per payload, all in a single job process: the config is
+  loaded and the venv prepared once for the whole batch.
+
+  Returns:
+    One dict per payload, in order, with either `output` or `error`.
+  """
+  if not payloads:
+    return []
+  with tracing.span("run_batch.config", job=job_name):
+    config = load_job_config(job_name)
 
-  if os.name == "nt":
-    python_path = venv_path / "Scripts" / "python.exe"
-    if not python_path.exists(): # fallback for MSYS2 layout (bash for windows python3 alias)
-      python_path = venv_path / "bin" / "python.exe"
-  else:
-    python_path = venv_path / "bin" / "python"
+  if not config.enabled:
+    return [{"error": "Job is disabled in config."} for _ in payloads]
+
+  # Runs of an exclusive job can't overlap, not even within a batch
+  parallelism = 1 if config.exclusive else max(1, parallelism)
+
+  if config.execution_mode != "subprocess":
+    def run_item(payload: dict) -> dict:
+      started = time.perf_counter()
+      try:
+        result = _run_in_process(job_name, config, payload)
+      except JobTimeoutError as e:
+        return {"error": str(e)}
+      except Exception as e:
+        return {"error": f"Job runtime error: {type(e).__name__}: {e}"}
+      result["duration_seconds"] = round(time.perf_counter() - started, 3)
+      return result
 
+    # Exclusive runs take the job's lock one by one, see _run_in_process
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+      # Contexts are copied here, worker threads would start without the trace
+      runs = [(contextvars.copy_context(), payload) for payload in payloads]
+      return list(executor.map(lambda run: run[0].run(run_item, run[1]), runs))
   stdin_data = {
     "job_name": job_name,
     "config": config.model_dump(),
-    "payload": payload or {}
+    "payloads": payloads,
+    "parallelism": parallelism,
   }
+  # `timeout` is per run and enforced in the job process, this one only stops
+  # a process that's stuck: a round of runs each, and one more to start up
+  timeout = config.timeout * (math.ceil(len(payloads) / parallelism) + 1) if config.timeout else None
+  return _run_job_process(job_name, config, stdin_data, timeout)["outputs"]
 
-  result = subprocess.run(
-    [str(python_path), "-m", module_path],
-    input=json.dumps(stdin_data).encode(),
-    stdout=subprocess.PIPE,
-    stderr=subprocess.PIPE,
-  )
+def run_items(items: list[tuple[str, dict]], parallelism: int = 4) -> list[dict]:
+  """
+  Runs a batch of `(job_name, payload)` items, one job process per job.
 
-  if result.returncode != 0:
-    raise Exception("Job failed\n" + result.stderr.decode())
-  
-  try:
-    result = json.loads(result.stdout.decode())
-  except json.JSONDecodeError:
-    result = {}
+  Returns:
+    One dict per item, in order, with `job`, `ok` and either `result` or `error`.
+  """
+  by_job: dict[str, list[int]] = {}
+  for index, (job_name, _) in enumerate(items):
+    by_job.setdefault(job_name, []).append(index)
 
-  return result
+  results: list[dict] = [{} for _ in items]
+  # `parallelism` caps the whole request, the jobs running together share it
+  groups = max(1, min(parallelism, len(by_job)))
+  shares = [parallelism // groups + (1 if slot < parallelism % groups else 0) for slot in range(groups)]
+  free_shares = Queue()
+  for share in shares:
+    free_shares.put(share)
 
-def _extract_payload(
-  request: Request,
-  body: Optional[Dict[str, Any]] = Body(default=None),
-) -> Dict[str, Any]:
-  payload: Dict[str, Any] = {}
-
-  if body:
-    payload.update(body)
-
-  # `request.query_params` is ImmutableMultiDict ‑> cast to plain dict
-  if request.query_params:
-    payload.update(request.query_params.multi_items())
-
-  # normalise booleans that came in as strings
-  for k, v in payload.items():
-    if isinstance(v, str) and v.lower() in {"true", "false"}:
-      payload[k] = v.lower() == "true"
-
-  return payload
-
-router = APIRouter(prefix="/run", tags=["jobs"])
-@router.api_route(
-  "/{job_name}",
-  methods=["GET", "POST", "PUT", "PATCH", "DELETE"],
-  status_code=status.HTTP_200_OK,
-)
-async def run_job_endpoint(
-  job_name: str,
-  background: BackgroundTasks,
-  request: Request,
-  payload: Dict[str, Any] = Depends(_extract_payload),
-):
-  ack = bool(payload.pop("acknowledgment", False))
-
-  if not ack:
-    # fire‑and‑forget
-    background.add_task(run_job, job_name, payload=payload)
-    return Response(status_code=status.HTTP_200_OK)
-  else:
+  def run_group(job_name: str, indexes: list[int]) -> None:
+    share = free_shares.get()
     try:
-      result = run_job(job_name, payload=payload)
-    except Exception as exc:
-      raise HTTPException(
-        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-        detail=str(exc),
-      ) from exc
+      with tracing.span("run_batch", job=job_name, items=len(indexes)):
+        outputs = run_batch(job_name, [items[index][1] for index in indexes], share)
+    except Exception as e:
+      outputs = [{"error": str(e)} for _ in indexes]
+    finally:
+      free_shares.put(share)
+    for index, output in zip(indexes, outputs):
+      if "error" in output:
+        results[index] = {"job": job_name, "ok": False, "error": output["error"]}
+      else:
+        results[index] = {"job": job_name, "ok": True, "result": output}
+
+  with ThreadPoolExecutor(max_workers=groups) as executor:
+    # Each group gets a copy of the context, so its spans keep their parent
+    for future in [executor.submit(contextvars.copy_context().run, run_group, job_name, indexes) for job_name, indexes in by_job.items()]:
+      future.result()
+  return results
+
+def _run_one(job_mod, config: DefaultSettings, payload: Any, context: JobContext) -> dict:
+  started = time.perf_counter()
+  try:
+    with tracing.span("job.run"):
+      output = job_mod.run(**run_kwargs(job_mod.run, config, payload, context))
+  except Exception as e:
+    return {"error": f"Job runtime error: {type(e).__name__}: {e}"}
+  return {"output": output, "duration_seconds": round(time.perf_counter() - started, 3)}
 
-    return JSONResponse(content={"acknowledgment": "completed", "result": result})
+def _run_payloads(job_mod, config: DefaultSettings, payloads: list, parallelism: int, context: JobContext, monitor: MemoryMonitor) -> list[dict]:
+  """
+  Runs the payloads of a batch, `parallelism` at a time, on daemon threads.
+  The main thread only waits on them, so a memory budget abort reaches it.
+  A run going past `timeout` is reported as timed out and a new thread takes
+  its place, runs cut short don't keep the process from exiting.
+
+  Returns:
+    One dict per payload, in order, with either `output` or `error`.
+  """
+  outputs: list[Optional[dict]] = [None] * len(payloads)
+  waiting: Queue = Queue()
+  for index, payload in enumerate(payloads):
+    # Contexts are copied here, worker threads would start without the trace
+    waiting.put((index, contextvars.copy_context(), payload))
+  lock = threading.Lock()
+  # Start times of the runs going, by payload index
+  started: Dict[int, float] = {}
+  left = len(payloads)
+  done = threading.Event()
+  if not left:
+    done.set()
+
+  def finish(index: int, output: dict) -> bool:
+    """Records the payload's output, False if it has one already."""
+    nonlocal left
+    with lock:
+      started.pop(index, None)
+      if outputs[index] is not None:
+        return False
+      outputs[index] = output
+      left -= 1
+      if not left:
+        done.set()
+      return True
+
+  def work() -> None:
+    while True:
+      try:
+        index, run_context, payload = waiting.get_nowait()
+      except Empty:
+        return
+      with lock:
+        # Reported already, the batch was aborted
+        if outputs[index] is not None:
+          continue
+        started[index] = time.monotonic()
+      try:
+        output = run_context.run(_run_one, job_mod, config, payload, context)
+      except BaseException as e:
+        # e.g. a SystemExit, the run would never get a result
+        output = {"error": f"Job runtime error: {type(e).__name__}: {e}"}
+      # Timed out, another thread has taken this one's place
+      if not finish(index, output):
+        return
+
+  for _ in range(min(parallelism, len(payloads))):
+    threading.Thread(target=work, name="job", daemon=True).start()
+  try:
+    while not done.wait(BATCH_POLL_INTERVAL):
+      if config.timeout is None:
+        continue
+      now = time.monotonic()
+      with lock:
+        late = [index for index, start in started.items() if now - start >= config.timeout]
+      for index in late:
+        if finish(index, {"error": f"Job timed out after {config.timeout}s"}):
+          threading.Thread(target=work, name="job", daemon=True).start()
+  except (Exception, KeyboardInterrupt) as e:
+    # A KeyboardInterrupt here is the memory monitor aborting the batch
+    e = monitor.check(e)
+    if isinstance(e, KeyboardInterrupt):
+      raise
+    # Finished runs keep their results, the others get the abort's error
+    for index in range(len(payloads)):
+      finish(index, {"error": f"Job runtime error: {type(e).__name__}: {e}"})
+  return outputs
 
 def main():
   raw = sys.stdin.read()
@@ -123,9 +418,17 @@ def main():
     print("Invalid JSON on stdin", file=sys.stderr)
     sys.exit(1)
 
+  # Continues the trace of whoever started the process, see core/tracing.py
+  tracing.configure(f"job:{data.get('job_name')}")
+  with tracing.remote_parent(data.get("traceparent")), tracing.span("job.main", job=data.get("job_name")):
+    _main(data)
+
+def _main(data: dict) -> None:
   job_name: str = data["job_name"]
   config_dict = data["config"]
   payload = data.get("payload", {})
+  if data.get("payload_file"):
+    payload = PayloadFile.from_dict(data["payload_file"])
 
   if not job_name:
     print("Job name missing from input", file=sys.stderr)
@@ -135,24 +438,45 @@ def main():
     print("Config missing from input", file=sys.stderr)
     sys.exit(1)
 
-  SettingsCls = get_settings_cls(job_name)
+  with tracing.span("job.import"):
+    SettingsCls = get_settings_cls(job_name)
   try:
     config = SettingsCls(**config_dict)
   except Exception as e:
     print(f"Config validation failed: {e}", file=sys.stderr)
     sys.exit(1)
 
+  apply_limits(config)
+
   # Import job module and call run()
   job_mod = importlib.import_module(f"jobs.{job_name}.job")
   if not hasattr(job_mod, "run"):
     print(f"'run' function missing in jobs.{job_name}.job", file=sys.stderr)
     sys.exit(1)
 
-  try:
-    job_mod.run(config=config, payload=payload)
-  except Exception as e:
-    print(f"Job runtime error: {e}", file=sys.stderr)
-    sys.exit(1)
+  # Jobs that take a `context` get the job's persistent cache through it
+  context = JobContext(job_name, config)
+
+  # stdout is reserved for the result, job logs go to stderr. Not restored, the
+  # runs of a batch that was aborted may still be logging
+  result_stream, sys.stdout = sys.stdout, sys.stderr
+  with MemoryMonitor(config) as monitor, closing(context):
+    if "payloads" in data:
+      outputs = _run_payloads(job_mod, config, data["payloads"], data.get("parallelism", 1), context, monitor)
+    else:
+      try:
+        with tracing.span("job.run"):
+          output = job_mod.run(**run_kwargs(job_mod.run, config, payload, context))
+      except (Exception, KeyboardInterrupt) as e:
+        # A KeyboardInterrupt here is the memory monitor aborting the run
+        e = monitor.check(e)
+        if isinstance(e, KeyboardInterrupt):
+          raise
+        print(f"Job runtime error: {type(e).__name__}: {e}", file=sys.stderr)
+        sys.exit(1)
+
+  result = {"outputs": outputs} if "payloads" in data else {"output": output}
+  print(json.dumps({**result, "rusage": usage(), "memory": monitor.report()}, default=str), file=result_stream)
 
 if __name__ == "__main__":
   main()
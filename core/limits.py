@@ -0,0 +1,153 @@
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import threading
+from typing import Dict, Optional
+from .default_settings import DefaultSettings
+
+# Seconds a job gets to exit after SIGTERM before its process group is killed
+KILL_GRACE_PERIOD = 5
+# The CPU limit is enforced with SIGXCPU at the soft limit, then SIGKILL here
+CPU_HARD_LIMIT_MARGIN = 5
+
+_IONICE_CLASSES = {"realtime": "1", "best-effort": "2", "idle": "3"}
+
+class JobTimeoutError(TimeoutError):
+  """Raised when a job runs past its wall-clock timeout and gets killed."""
+  pass
+
+def priority_prefix(config: DefaultSettings) -> list[str]:
+  """Command prefix setting the job's IO priority, if `ionice` is available."""
+  if not config.ionice_class or os.name == "nt":
+    return []
+  ionice = shutil.which("ionice")
+  if ionice is None:
+    print("ionice not found, ignoring ionice_class", file=sys.stderr)
+    return []
+  prefix = [ionice, "-c", _IONICE_CLASSES[config.ionice_class]]
+  if config.ionice_level is not None and config.ionice_class != "idle":
+    prefix += ["-n", str(config.ionice_level)]
+  return prefix
+
+def apply_limits(config: DefaultSettings) -> None:
+  """
+  Applies the job's CPU, address space and nice limits to the current
+  process. Called by the job process itself, so the server never needs a
+  (thread-unsafe) preexec_fn.
+  """
+  if os.name == "nt":
+    return
+  import resource
+
+  if config.cpu_time_limit:
+    resource.setrlimit(resource.RLIMIT_CPU, (config.cpu_time_limit, config.cpu_time_limit + CPU_HARD_LIMIT_MARGIN))
+  if config.memory_limit:
+    limit = config.memory_limit * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+  if config.nice:
+    os.nice(config.nice)
+
+def usage() -> dict:
+  """Resource usage of the current process and its finished children."""
+  if os.name == "nt":
+    return {}
+  import resource
+
+  own = resource.getrusage(resource.RUSAGE_SELF)
+  children = resource.getrusage(resource.RUSAGE_CHILDREN)
+  # ru_maxrss is in kilobytes on Linux, bytes on macOS
+  rss_unit = 1 if sys.platform == "darwin" else 1024
+  return {
+    "user_time": round(own.ru_utime + children.ru_utime, 3),
+    "system_time": round(own.ru_stime + children.ru_stime, 3),
+    "max_rss_bytes": max(own.ru_maxrss, children.ru_maxrss) * rss_unit,
+    "minor_faults": own.ru_minflt + children.ru_minflt,
+    "major_faults": own.ru_majflt + children.ru_majflt,
+    "voluntary_context_switches": own.ru_nvcsw + children.ru_nvcsw,
+    "involuntary_context_switches": own.ru_nivcsw + children.ru_nivcsw,
+  }
+
+def _kill_group(process: subprocess.Popen) -> None:
+  if os.name == "nt":
+    process.kill()
+    return
+  try:
+    os.killpg(process.pid, signal.SIGTERM)
+    process.wait(timeout=KILL_GRACE_PERIOD)
+  except subprocess.TimeoutExpired:
+    pass
+  except ProcessLookupError:
+    return
+  try:
+    # Whatever is left of the group, including children that ignored SIGTERM
+    os.killpg(process.pid, signal.SIGKILL)
+  except ProcessLookupError:
+    pass
+
+def _drain(stream, chunks: list[bytes]) -> None:
+  chunks.append(stream.read())
+  stream.close()
+
+def _feed(stream, data: bytes) -> None:
+  try:
+    stream.write(data)
+  except BrokenPipeError:
+    pass
+  finally:
+    stream.close()
+
+def run_process(args: list[str], input: bytes, timeout: Optional[float], env: Optional[Dict[str, str]] = None) -> subprocess.CompletedProcess:
+  """
+  Runs the job process in its own process group. The whole group is killed
+  when the job outlives `timeout`, and stray children are killed once the
+  job exits so they can't hold the pipes (and the caller) forever.
+
+  Args:
+    env: Environment of the job process, this process' own if None.
+
+  Raises:
+    JobTimeoutError: If the job was killed for running too long.
+  """
+  process = subprocess.Popen(
+    args,
+    stdin=subprocess.PIPE,
+    stdout=subprocess.PIPE,
+    stderr=subprocess.PIPE,
+    env=env,
+    # Own process group, so anything the job spawns is killed with it
+    start_new_session=os.name != "nt",
+  )
+  stdout: list[bytes] = []
+  stderr: list[bytes] = []
+  threads = [
+    threading.Thread(target=_feed, args=(process.stdin, input), daemon=True),
+    threading.Thread(target=_drain, args=(process.stdout, stdout), daemon=True),
+    threading.Thread(target=_drain, args=(process.stderr, stderr), daemon=True),
+  ]
+  for thread in threads:
+    thread.start()
+
+  timed_out = False
+  try:
+    process.wait(timeout=timeout)
+    if os.name != "nt":
+      try:
+        # The job is done, anything it left running in its group goes too
+        os.killpg(process.pid, signal.SIGKILL)
+      except ProcessLookupError:
+        pass
+  except subprocess.TimeoutExpired:
+    timed_out = True
+    _kill_group(process)
+    process.wait()
+
+  for thread in threads:
+    thread.join()
+
+  if timed_out:
+    raise JobTimeoutError(
+      f"Job timed out after {timeout}s and was killed\n" + b"".join(stderr).decode(errors="replace")
+    )
+  return subprocess.CompletedProcess(args, process.returncode, b"".join(stdout), b"".join(stderr))
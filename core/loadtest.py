@@ -0,0 +1,141 @@
+import asyncio
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+# Load generator for `python -m cli loadtest`. Requests are sent on a fixed
+# schedule when `rate` is set (open loop, so a slow server shows up as
+# latency instead of a lower send rate), otherwise as fast as `concurrency`
+# allows
+
+# Seconds between queue depth samples
+STATS_INTERVAL = 0.5
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+  """Nearest-rank percentile of `values`, None if there are none."""
+  if not values:
+    return None
+  ordered = sorted(values)
+  index = max(0, min(len(ordered) - 1, round(fraction * len(ordered) + 0.5) - 1))
+  return ordered[index]
+
+def _latency_summary(latencies: List[float]) -> Dict[str, Optional[float]]:
+  def ms(value: Optional[float]) -> Optional[float]:
+    return None if value is None else round(value * 1000, 2)
+
+  return {
+    "p50_ms": ms(percentile(latencies, 0.50)),
+    "p95_ms": ms(percentile(latencies, 0.95)),
+    "p99_ms": ms(percentile(latencies, 0.99)),
+    "max_ms": ms(max(latencies) if latencies else None),
+    "mean_ms": ms(sum(latencies) / len(latencies) if latencies else None),
+  }
+
+async def _queue_depth(client, url: str) -> Optional[Dict[str, int]]:
+  try:
+    response = await client.get(f"{url}/stats")
+    stats = response.json()
+    # Triggers still in the answering worker's spool aren't in the queue yet
+    return {**stats["queue"], "spooled": stats.get("spool", 0)}
+  except Exception:
+    return None
+
+async def run_loadtest(
+  url: str,
+  job: str,
+  requests: int,
+  concurrency: int,
+  rate: Optional[float],
+  payload_size: int,
+  ack: bool,
+  drain_timeout: float,
+) -> dict:
+  """
+  Sends `requests` triggers to `/run/{job}` and measures the server.
+
+  Returns:
+    Throughput, latency percentiles, errors and the server's queue depth.
+  """
+  import httpx
+
+  url = url.rstrip("/")
+  target = f"{url}/run/{job}" + ("?acknowledgment=true" if ack else "")
+  payload = {"data": "x" * payload_size}
+  latencies: List[float] = []
+  errors: Counter = Counter()
+  depth_samples: List[Dict[str, int]] = []
+  sent = 0
+
+  limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+  async with httpx.AsyncClient(limits=limits, timeout=None) as client:
+    stop_sampling = asyncio.Event()
+
+    async def sample_stats():
+      while not stop_sampling.is_set():
+        depth = await _queue_depth(client, url)
+        if depth is not None:
+          depth_samples.append(depth)
+        try:
+          await asyncio.wait_for(stop_sampling.wait(), STATS_INTERVAL)
+        except asyncio.TimeoutError:
+          pass
+
+    async def send():
+      nonlocal sent
+      while sent < requests:
+        index = sent
+        sent += 1
+        if rate:
+          delay = started + index / rate - time.perf_counter()
+          if delay > 0:
+            await asyncio.sleep(delay)
+        request_started = time.perf_counter()
+        try:
+          response = await client.post(target, json=payload)
+        except httpx.HTTPError as e:
+          errors[type(e).__name__] += 1
+          continue
+        latencies.append(time.perf_counter() - request_started)
+        if response.status_code >= 400:
+          errors[str(response.status_code)] += 1
+
+    sampler = asyncio.create_task(sample_stats())
+    started = time.perf_counter()
+    await asyncio.gather(*(send() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    # Fire-and-forget runs are still queued, wait for the server to catch up
+    drain_seconds = None
+    if not ack:
+      while time.perf_counter() - started - elapsed < drain_timeout:
+        depth = await _queue_depth(client, url)
+        if depth is not None and not depth.get("queued") and not depth.get("running") and not depth.get("spooled"):
+          drain_seconds = round(time.perf_counter() - started - elapsed, 3)
+          break
+        await asyncio.sleep(STATS_INTERVAL / 5)
+
+    stop_sampling.set()
+    await sampler
+    final_depth = await _queue_depth(client, url)
+
+  failed = sum(errors.values())
+  return {
+    "target": target,
+    "requests": requests,
+    "concurrency": concurrency,
+    "rate": rate,
+    "payload_bytes": payload_size,
+    "ack": ack,
+    "elapsed_seconds": round(elapsed, 3),
+    "throughput_rps": round(requests / elapsed, 2) if elapsed else None,
+    "latency": _latency_summary(latencies),
+    "errors": dict(errors),
+    "error_rate": round(failed / requests, 4) if requests else 0,
+    "queue": {
+      "max_queued": max((sample.get("queued", 0) for sample in depth_samples), default=None),
+      "max_running": max((sample.get("running", 0) for sample in depth_samples), default=None),
+      "max_spooled": max((sample.get("spooled", 0) for sample in depth_samples), default=None),
+      "final": final_depth,
+      "drain_seconds": drain_seconds,
+    },
+  }
@@ -0,0 +1,64 @@
+import os
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Union
+
+# Cross-process coordination for several server workers (and the CLI)
+# running against the same checkout
+LOCKS_DIR = Path(".locks")
+
+class LockBusyError(RuntimeError):
+  """Raised when a non-blocking lock is held by another process."""
+  pass
+
+@contextmanager
+def file_lock(name: str, blocking: bool = True) -> Iterator[None]:
+  """
+  Exclusive lock shared by every process using the same `name`, released
+  by the OS if the holder dies.
+
+  Raises:
+    LockBusyError: If `blocking` is False and another process holds the lock.
+  """
+  LOCKS_DIR.mkdir(parents=True, exist_ok=True)
+  with (LOCKS_DIR / f"{name}.lock").open("a+b") as lock_file:
+    if os.name == "nt":
+      import msvcrt
+      mode = msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK
+      try:
+        msvcrt.locking(lock_file.fileno(), mode, 1)
+      except OSError as e:
+        raise LockBusyError(f"Lock '{name}' is held by another process") from e
+      try:
+        yield
+      finally:
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+      return
+
+    import fcntl
+    try:
+      fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError as e:
+      raise LockBusyError(f"Lock '{name}' is held by another process") from e
+    try:
+      yield
+    finally:
+      fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def atomic_write(path: Union[str, Path], data: bytes) -> None:
+  """Writes `data` to `path` so readers see either the old or the new file, never half of one."""
+  path = Path(path)
+  fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+  try:
+    # mkstemp creates the file as 0600, keep the permissions of the file replaced
+    os.chmod(tmp_path, path.stat().st_mode if path.exists() else 0o644)
+    with os.fdopen(fd, "wb") as f:
+      f.write(data)
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+  except BaseException:
+    Path(tmp_path).unlink(missing_ok=True)
+    raise
@@ -0,0 +1,122 @@
+import _thread
+import os
+import sys
+import threading
+import tracemalloc
+from typing import Optional
+from .default_settings import DefaultSettings
+
+# Memory accounting of the job process, see `memory_budget` and
+# `memory_snapshot_top` in core/default_settings.py
+
+# Seconds between checks of the peak RSS against the budget
+SAMPLE_INTERVAL = 0.1
+# Growth of traced memory over the last snapshot that triggers a new one
+SNAPSHOT_GROWTH = 1.2
+# Seconds an aborted job gets to unwind before the process exits anyway
+ABORT_GRACE_PERIOD = 5
+
+class MemoryBudgetError(MemoryError):
+  """Raised in the job when its peak RSS goes over `memory_budget`."""
+  pass
+
+def peak_rss() -> Optional[int]:
+  """Peak resident set size of the current process in bytes, None on Windows."""
+  if os.name == "nt":
+    return None
+  import resource
+
+  # ru_maxrss is in kilobytes on Linux, bytes on macOS
+  rss_unit = 1 if sys.platform == "darwin" else 1024
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * rss_unit
+
+class MemoryMonitor:
+  """
+  Watches the job process' peak RSS while the job runs. Over the budget it
+  logs a warning, or aborts the run: the main thread gets a
+  `MemoryBudgetError` and the process exits if it doesn't unwind in time.
+
+  Args:
+    config: The job's settings.
+  """
+
+  def __init__(self, config: DefaultSettings):
+    self.budget = config.memory_budget * 1024 * 1024 if config.memory_budget else None
+    self.action = config.memory_budget_action
+    self.top = config.memory_snapshot_top
+    self.exceeded = False
+    # Taken as traced memory peaks, allocations freed by the end still show
+    self._snapshot: Optional[tracemalloc.Snapshot] = None
+    self._snapshot_size = 0
+    self._stop = threading.Event()
+    self._thread: Optional[threading.Thread] = None
+
+  def __enter__(self) -> "MemoryMonitor":
+    if self.top:
+      tracemalloc.start()
+    if self.top or (self.budget and peak_rss() is not None):
+      self._thread = threading.Thread(target=self._watch, name="memory-monitor", daemon=True)
+      self._thread.start()
+    return self
+
+  def __exit__(self, *exc_info) -> None:
+    self._stop.set()
+    if self._thread is not None:
+      self._thread.join()
+
+  def error_message(self) -> str:
+    return f"Memory budget of {self.budget / (1024 * 1024):.0f} MB exceeded, peak RSS {peak_rss() / (1024 * 1024):.1f} MB"
+
+  def _take_snapshot(self, force: bool = False) -> None:
+    size = tracemalloc.get_traced_memory()[0]
+    if force or size > self._snapshot_size * SNAPSHOT_GROWTH:
+      self._snapshot = tracemalloc.take_snapshot()
+      self._snapshot_size = size
+
+  def _watch(self) -> None:
+    while not self._stop.wait(SAMPLE_INTERVAL):
+      if self.top:
+        self._take_snapshot()
+      if not self.budget or self.exceeded or peak_rss() <= self.budget:
+        continue
+      self.exceeded = True
+      if self.top:
+        self._take_snapshot(force=True)
+      print(self.error_message() + (", aborting the run" if self.action == "abort" else ""), file=sys.stderr)
+      for allocation in self._top_allocations():
+        print(f"  {allocation['size_bytes'] / (1024 * 1024):.1f} MB in {allocation['count']} blocks at {allocation['site']}", file=sys.stderr)
+      if self.action == "warn":
+        continue
+      _thread.interrupt_main()
+      if self._stop.wait(ABORT_GRACE_PERIOD):
+        return
+      # Stuck in C code or in another thread, e.g. a batch
+      print("Job didn't stop in time, exiting", file=sys.stderr)
+      sys.stderr.flush()
+      os._exit(1)
+
+  def check(self, error: BaseException) -> BaseException:
+    """The error to report for `error`, the budget's if it caused it."""
+    if self.exceeded and self.action == "abort" and isinstance(error, KeyboardInterrupt):
+      return MemoryBudgetError(self.error_message())
+    return error
+
+  def _top_allocations(self) -> list[dict]:
+    if self._snapshot is None:
+      return []
+    # Leave out tracemalloc's own bookkeeping
+    snapshot = self._snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+    return [
+      {"site": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}", "size_bytes": stat.size, "count": stat.count}
+      for stat in snapshot.statistics("lineno")[:self.top]
+    ]
+
+  def report(self) -> dict:
+    """Peak RSS, whether the budget was exceeded and the top allocation sites."""
+    report = {"peak_rss_bytes": peak_rss(), "budget_bytes": self.budget, "budget_exceeded": self.exceeded}
+    if self.top and tracemalloc.is_tracing():
+      self._take_snapshot()
+      report["traced_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+      report["top_allocations"] = self._top_allocations()
+      tracemalloc.stop()
+    return report
@@ -0,0 +1,103 @@
+import json
+import mmap
+import os
+import tempfile
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, Optional, Union
+
+# Large request bodies are streamed here instead of being decoded and piped
+# through stdin. /dev/shm is a tmpfs, so the "file" is shared memory the job
+# process maps without another copy
+_SHM_DIR = Path("/dev/shm")
+SPOOL_DIR = (_SHM_DIR if _SHM_DIR.is_dir() else Path(tempfile.gettempdir())) / "webhook-payloads"
+
+class PayloadTooLargeError(ValueError):
+  """Raised when a request body is over the job's `max_payload_size`."""
+  pass
+
+class PayloadFile:
+  """
+  A request body spooled to a file, handed to the job instead of a dict.
+
+  Args:
+    path: Where the body is stored.
+    size: Size of the body in bytes.
+    content_type: Content type of the request.
+    params: Query parameters of the request.
+  """
+
+  def __init__(self, path: Union[str, Path], size: int, content_type: Optional[str] = None, params: Optional[Dict[str, Any]] = None):
+    self.path = Path(path)
+    self.size = size
+    self.content_type = content_type
+    self.params = params or {}
+    self._mmap: Optional[mmap.mmap] = None
+
+  def view(self) -> memoryview:
+    """The body as a read-only memoryview over a memory map, no copies."""
+    if self._mmap is None:
+      with self.path.open("rb") as f:
+        self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(self._mmap)
+
+  def open(self):
+    return self.path.open("rb")
+
+  def json(self) -> Any:
+    with self.open() as f:
+      return json.load(f)
+
+  def close(self) -> None:
+    if self._mmap is not None:
+      self._mmap.close()
+      self._mmap = None
+
+  def unlink(self) -> None:
+    self.close()
+    self.path.unlink(missing_ok=True)
+
+  def to_dict(self) -> Dict[str, Any]:
+    return {"path": str(self.path), "size": self.size, "content_type": self.content_type, "params": self.params}
+
+  @classmethod
+  def from_dict(cls, data: Dict[str, Any]) -> "PayloadFile":
+    return cls(**data)
+
+async def read_body(stream: AsyncIterator[bytes], spool_threshold: Optional[int], max_size: Optional[int], content_type: Optional[str] = None) -> Union[bytes, PayloadFile]:
+  """
+  Reads a request body, spooling it to `SPOOL_DIR` once it grows past
+  `spool_threshold`.
+
+  Returns:
+    The body as bytes, or a PayloadFile if it was spooled.
+
+  Raises:
+    PayloadTooLargeError: If the body is over `max_size` bytes.
+  """
+  buffer = bytearray()
+  spool = None
+  size = 0
+  try:
+    async for chunk in stream:
+      size += len(chunk)
+      if max_size is not None and size > max_size:
+        raise PayloadTooLargeError(f"Payload is over the {max_size} bytes limit")
+      if spool is None:
+        buffer += chunk
+        if spool_threshold is not None and len(buffer) > spool_threshold:
+          SPOOL_DIR.mkdir(parents=True, exist_ok=True)
+          spool = tempfile.NamedTemporaryFile(dir=SPOOL_DIR, prefix="payload-", delete=False)
+          spool.write(buffer)
+          buffer = bytearray()
+      else:
+        spool.write(chunk)
+  except BaseException:
+    if spool is not None:
+      spool.close()
+      os.unlink(spool.name)
+    raise
+
+  if spool is None:
+    return bytes(buffer)
+  spool.close()
+  return PayloadFile(spool.name, size, content_type)
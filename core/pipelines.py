@@ -0,0 +1,142 @@
+import contextvars
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Dict, Optional
+from pydantic import BaseModel, Field, ValidationError, model_validator
+from . import config_store, tracing
+from .config_utils import ConfigError, PIPELINES_KEY, load_config
+
+# Pipelines chain jobs declared in configs.toml:
+#
+#   [pipelines.digest.stages.fetch]
+#   job = "notion_rss"
+#
+#   [pipelines.digest.stages.notify]
+#   job = "notify"
+#   needs = ["fetch"]
+#
+# A stage's payload is the output of the stage it needs (fan-in: a dict of
+# stage name to output), outputs stay in this process' memory between stages.
+# Stages whose needs are met run concurrently
+
+class Stage(BaseModel):
+  job: str = Field(..., description="Job run by the stage")
+  needs: list[str] = Field([], description="Stages whose output is this stage's payload")
+  payload: Dict[str, Any] = Field({}, description="Static payload, merged under the input")
+
+class Pipeline(BaseModel):
+  stages: Dict[str, Stage]
+
+  @model_validator(mode="after")
+  def check_graph(self) -> "Pipeline":
+    if not self.stages:
+      raise ValueError("A pipeline needs at least one stage")
+    for name, stage in self.stages.items():
+      unknown = [need for need in stage.needs if need not in self.stages]
+      if unknown:
+        raise ValueError(f"Stage '{name}' needs unknown stage(s): {', '.join(unknown)}")
+
+    # Kahn's algorithm, whatever is left over is part of a cycle
+    remaining = {name: set(stage.needs) for name, stage in self.stages.items()}
+    while True:
+      ready = [name for name, needs in remaining.items() if not needs]
+      if not ready:
+        break
+      for name in ready:
+        del remaining[name]
+      for needs in remaining.values():
+        needs.difference_update(ready)
+    if remaining:
+      raise ValueError(f"Stages form a cycle: {', '.join(sorted(remaining))}")
+    return self
+
+def get_pipeline(name: str) -> Pipeline:
+  snapshot = config_store.current()
+  config = snapshot.raw if snapshot is not None else load_config()
+  pipelines = config.get(PIPELINES_KEY, {})
+  if name not in pipelines:
+    raise KeyError(f"Pipeline '{name}' not found")
+  try:
+    return Pipeline(**pipelines[name])
+  except ValidationError as e:
+    raise ConfigError(f"Invalid pipeline '{name}':\n{e}") from e
+
+def _stage_payload(stage: Stage, payload: Dict[str, Any], outputs: Dict[str, Any]) -> Dict[str, Any]:
+  if not stage.needs:
+    data = payload
+  elif len(stage.needs) == 1:
+    output = outputs[stage.needs[0]]
+    data = output if isinstance(output, dict) else {"input": output}
+  else:
+    data = {need: outputs[need] for need in stage.needs}
+  return {**stage.payload, **data}
+
+def _run_stage(stage_name: str, stage: Stage, payload: Dict[str, Any]) -> dict:
+  from .job_runner import run_job
+
+  with tracing.span("pipeline.stage", stage=stage_name, job=stage.job):
+    result = run_job(stage.job, payload=payload)
+  if "output" not in result:
+    # e.g. the job is disabled, there's nothing to pass on
+    raise RuntimeError(result.get("message", f"Job '{stage.job}' returned no output"))
+  return result
+
+def run_pipeline(name: str, payload: Optional[Dict[str, Any]] = None) -> dict:
+  """
+  Runs every stage of the pipeline, each one as soon as the stages it needs
+  are done. Stages after a failed one are skipped.
+
+  Returns:
+    Per stage: `ok`, the job's result or the error, when it started and how
+    long it took, in seconds since the pipeline started.
+  """
+  with tracing.span("pipeline", pipeline=name):
+    return _run_pipeline(get_pipeline(name), payload or {})
+
+def _run_pipeline(pipeline: Pipeline, payload: Dict[str, Any]) -> dict:
+  started = time.perf_counter()
+  outputs: Dict[str, Any] = {}
+  report: Dict[str, dict] = {}
+  pending = dict(pipeline.stages)
+  running: Dict[Future, str] = {}
+
+  def submit_ready(executor: ThreadPoolExecutor) -> None:
+    for stage_name, stage in list(pending.items()):
+      failed = [need for need in stage.needs if report.get(need, {}).get("ok") is False]
+      if failed:
+        del pending[stage_name]
+        report[stage_name] = {"job": stage.job, "ok": False, "skipped": True, "error": f"Needed stage(s) failed: {', '.join(failed)}"}
+        continue
+      if all(need in outputs for need in stage.needs):
+        del pending[stage_name]
+        stage_payload = _stage_payload(stage, payload, outputs)
+        report[stage_name] = {"job": stage.job, "started_at": round(time.perf_counter() - started, 3)}
+        # Stage threads get a copy of the context, so their spans keep their parent
+        running[executor.submit(contextvars.copy_context().run, _run_stage, stage_name, stage, stage_payload)] = stage_name
+
+  with ThreadPoolExecutor(max_workers=len(pipeline.stages)) as executor:
+    submit_ready(executor)
+    while running:
+      done, _ = wait(running, return_when=FIRST_COMPLETED)
+      for future in done:
+        stage_name = running.pop(future)
+        stage_report = report[stage_name]
+        stage_report["duration_seconds"] = round(time.perf_counter() - started - stage_report["started_at"], 3)
+        try:
+          result = future.result()
+        except Exception as e:
+          stage_report.update(ok=False, error=str(e))
+        else:
+          outputs[stage_name] = result["output"]
+          stage_report.update(ok=True, result=result)
+      # Skipping stages can make others skippable, repeat until nothing changes
+      count = None
+      while count != len(pending):
+        count = len(pending)
+        submit_ready(executor)
+
+  return {
+    "ok": all(stage["ok"] for stage in report.values()),
+    "stages": report,
+    "duration_seconds": round(time.perf_counter() - started, 3),
+  }
@@ -0,0 +1,229 @@
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Union
+from .payload import PayloadFile
+
+# Fire-and-forget runs shared by every server worker. A run is claimed with a
+# lease: the worker running it renews the lease, and if the worker dies the
+# lease runs out and another worker picks the run up again
+QUEUE_PATH = Path(os.getenv("QUEUE_PATH", ".webhook/queue.db"))
+# Seconds a claim is valid without a heartbeat
+LEASE_SECONDS = 60
+# Runs whose worker died this many times are given up on
+MAX_ATTEMPTS = 3
+# Finished runs are kept this long, for inspection
+RETENTION_SECONDS = 24 * 60 * 60
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  job_name TEXT NOT NULL,
+  payload TEXT NOT NULL,
+  payload_file TEXT,
+  exclusive INTEGER NOT NULL DEFAULT 0,
+  status TEXT NOT NULL DEFAULT 'queued',
+  attempts INTEGER NOT NULL DEFAULT 0,
+  lease_owner TEXT,
+  lease_expires REAL,
+  created_at REAL NOT NULL,
+  started_at REAL,
+  finished_at REAL,
+  result TEXT,
+  error TEXT,
+  traceparent TEXT,
+  trigger_id TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_status ON runs (status, id);
+"""
+# Columns added after the table was first created
+_MIGRATIONS = [
+  "ALTER TABLE runs ADD COLUMN traceparent TEXT",
+  "ALTER TABLE runs ADD COLUMN trigger_id TEXT",
+  "CREATE UNIQUE INDEX IF NOT EXISTS runs_trigger ON runs (trigger_id)",
+]
+
+class Run(NamedTuple):
+  id: int
+  job_name: str
+  payload: Union[Dict[str, Any], PayloadFile]
+  attempts: int
+  # Trace context of the request that queued the run, see core/tracing.py
+  traceparent: Optional[str] = None
+
+_initialized = False
+
+@contextmanager
+def _connect() -> Iterator[sqlite3.Connection]:
+  global _initialized
+  QUEUE_PATH.parent.mkdir(parents=True, exist_ok=True)
+  # Autocommit, transactions are opened explicitly. The timeout covers other
+  # workers holding the write lock
+  connection = sqlite3.connect(QUEUE_PATH, timeout=30, isolation_level=None)
+  connection.execute("PRAGMA journal_mode=WAL")
+  connection.execute("PRAGMA synchronous=NORMAL")
+  if not _initialized:
+    connection.executescript(_SCHEMA)
+    for migration in _MIGRATIONS:
+      try:
+        connection.execute(migration)
+      except sqlite3.OperationalError:
+        # Already applied
+        pass
+    _initialized = True
+  try:
+    yield connection
+  finally:
+    connection.close()
+
+def enqueue(job_name: str, payload: Union[Dict[str, Any], PayloadFile], exclusive: bool = False, traceparent: Optional[str] = None) -> int:
+  """Adds a run to the queue, returns its id."""
+  if isinstance(payload, PayloadFile):
+    data, payload_file = {}, json.dumps(payload.to_dict())
+  else:
+    data, payload_file = payload, None
+
+  with _connect() as connection:
+    cursor = connection.execute(
+      "INSERT INTO runs (job_name, payload, payload_file, exclusive, created_at, traceparent) VALUES (?, ?, ?, ?, ?, ?)",
+      (job_name, json.dumps(data), payload_file, int(exclusive), time.time(), traceparent),
+    )
+    return cursor.lastrowid
+
+def enqueue_many(triggers: List[Dict[str, Any]]) -> None:
+  """
+  Adds triggers spooled by core/spool.py to the queue in one transaction. A
+  trigger already queued (same `trigger_id`) is skipped, replaying a spool
+  twice queues each run once.
+  """
+  rows = [
+    (
+      trigger["job_name"], json.dumps(trigger["payload"]),
+      json.dumps(trigger["payload_file"]) if trigger["payload_file"] else None,
+      int(trigger["exclusive"]), trigger["created_at"], trigger["traceparent"], trigger["trigger_id"],
+    )
+    for trigger in triggers
+  ]
+  with _connect() as connection:
+    # The spool drops the triggers once they're queued, they have to be on disk
+    connection.execute("PRAGMA synchronous=FULL")
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+      connection.executemany(
+        "INSERT OR IGNORE INTO runs (job_name, payload, payload_file, exclusive, created_at, traceparent, trigger_id)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?)",
+        rows,
+      )
+      connection.execute("COMMIT")
+    except BaseException:
+      connection.execute("ROLLBACK")
+      raise
+
+def known_triggers(trigger_ids: List[str]) -> set[str]:
+  """The ids of `trigger_ids` that have a run in the queue, whatever its status."""
+  known: set[str] = set()
+  with _connect() as connection:
+    # SQLite caps the parameters of a statement
+    for start in range(0, len(trigger_ids), 500):
+      chunk = trigger_ids[start:start + 500]
+      rows = connection.execute(f"SELECT trigger_id FROM runs WHERE trigger_id IN ({', '.join('?' * len(chunk))})", chunk)
+      known.update(row[0] for row in rows)
+  return known
+
+def _requeue_expired(connection: sqlite3.Connection, now: float) -> None:
+  connection.execute(
+    "UPDATE runs SET status = 'failed', finished_at = ?, error = 'Worker died while running the job', lease_owner = NULL"
+    " WHERE status = 'running' AND lease_expires < ? AND attempts >= ?",
+    (now, now, MAX_ATTEMPTS),
+  )
+  connection.execute(
+    "UPDATE runs SET status = 'queued', lease_owner = NULL, lease_expires = NULL"
+    " WHERE status = 'running' AND lease_expires < ?",
+    (now,),
+  )
+
+def claim(owner: str) -> Optional[Run]:
+  """
+  Claims the oldest queued run for `owner`. Runs of an exclusive job are
+  skipped while another run of the same job holds a lease.
+
+  Returns:
+    The claimed run, or None if there is nothing to run.
+  """
+  now = time.time()
+  with _connect() as connection:
+    # Takes the write lock upfront, two workers can't claim the same run
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+      _requeue_expired(connection, now)
+      row = connection.execute(
+        "SELECT id, job_name, payload, payload_file, attempts, traceparent FROM runs AS queued"
+        " WHERE status = 'queued' AND NOT (exclusive AND EXISTS ("
+        "   SELECT 1 FROM runs AS running WHERE running.status = 'running' AND running.job_name = queued.job_name"
+        " )) ORDER BY id LIMIT 1"
+      ).fetchone()
+      if row is not None:
+        connection.execute(
+          "UPDATE runs SET status = 'running', attempts = attempts + 1, lease_owner = ?, lease_expires = ?, started_at = ? WHERE id = ?",
+          (owner, now + LEASE_SECONDS, now, row[0]),
+        )
+      connection.execute("COMMIT")
+    except BaseException:
+      connection.execute("ROLLBACK")
+      raise
+
+  if row is None:
+    return None
+  run_id, job_name, payload, payload_file, attempts, traceparent = row
+  if payload_file:
+    return Run(run_id, job_name, PayloadFile.from_dict(json.loads(payload_file)), attempts + 1, traceparent)
+  return Run(run_id, job_name, json.loads(payload), attempts + 1, traceparent)
+
+def heartbeat(run_id: int, owner: str) -> bool:
+  """Renews the lease on a run, returns False if `owner` lost it."""
+  with _connect() as connection:
+    cursor = connection.execute(
+      "UPDATE runs SET lease_expires = ? WHERE id = ? AND lease_owner = ? AND status = 'running'",
+      (time.time() + LEASE_SECONDS, run_id, owner),
+    )
+    return cursor.rowcount == 1
+
+def _finish(run_id: int, owner: str, status: str, result: Optional[str], error: Optional[str]) -> bool:
+  now = time.time()
+  with _connect() as connection:
+    cursor = connection.execute(
+      "UPDATE runs SET status = ?, finished_at = ?, result = ?, error = ?, lease_owner = NULL, lease_expires = NULL"
+      " WHERE id = ? AND lease_owner = ?",
+      (status, now, result, error, run_id, owner),
+    )
+    connection.execute(
+      "DELETE FROM runs WHERE status IN ('done', 'failed') AND finished_at < ?",
+      (now - RETENTION_SECONDS,),
+    )
+    return cursor.rowcount == 1
+
+def complete(run_id: int, owner: str, result: Any) -> bool:
+  """Stores the result of a run, returns False if `owner` lost the lease."""
+  return _finish(run_id, owner, "done", json.dumps(result, default=str), None)
+
+def fail(run_id: int, owner: str, error: str) -> bool:
+  return _finish(run_id, owner, "failed", None, error)
+
+def payload_file(run_id: int, owner: str) -> Optional[PayloadFile]:
+  """The spooled payload of a run leased by `owner`, if it has one."""
+  with _connect() as connection:
+    row = connection.execute(
+      "SELECT payload_file FROM runs WHERE id = ? AND lease_owner = ? AND status = 'running'",
+      (run_id, owner),
+    ).fetchone()
+  if row is None or not row[0]:
+    return None
+  return PayloadFile.from_dict(json.loads(row[0]))
+
+def depth() -> Dict[str, int]:
+  """Number of runs per status."""
+  with _connect() as connection:
+    return dict(connection.execute("SELECT status, COUNT(*) FROM runs GROUP BY status").fetchall())
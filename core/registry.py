@@ -0,0 +1,255 @@
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+from contextlib import redirect_stdout
+from pathlib import Path
+from typing import Annotated, Any, Dict, List, Literal, Optional, Tuple, Type, Union
+from pydantic import BaseModel, BeforeValidator, Field, create_model
+from .default_settings import DefaultSettings
+from .environment_manager import JOBS_DIR, job_requirements, requirements_hash
+from .locks import atomic_write, file_lock
+
+# Each job's settings, described by a manifest built in a process of its own:
+# the host validates and lists configs without importing job code (or notion
+# clients and the like). A job's entry is rebuilt when its files change.
+#
+# Settings are described with the job's venv if it's built already, else with
+# the host's interpreter. The venv is only built (its requirements installed)
+# for a job whose settings can't be imported without them.
+#
+# The host models built from the manifest check types, defaults and
+# constraints. Validators written in Python only run with the job itself
+MANIFEST_PATH = Path(os.getenv("REGISTRY_PATH", ".webhook/registry.json"))
+# Bump when the entries change shape, every entry is rebuilt
+MANIFEST_VERSION = 1
+_BASE_SETTINGS = Path(__file__).parent / "default_settings.py"
+# Exit code of `python -m core.registry` when the job imports a missing module
+MISSING_MODULE_EXIT = 3
+
+_SCHEMA_CONSTRAINTS = {
+  "minimum": "ge",
+  "maximum": "le",
+  "exclusiveMinimum": "gt",
+  "exclusiveMaximum": "lt",
+  "minLength": "min_length",
+  "maxLength": "max_length",
+  "pattern": "pattern",
+  "minItems": "min_length",
+  "maxItems": "max_length",
+}
+
+class RegistryError(RuntimeError):
+  """Raised when a job's manifest entry can't be built."""
+  pass
+
+class VenvNotReadyError(RegistryError):
+  """Raised when describing the job needs its venv, and building it wasn't allowed."""
+  pass
+
+_manifest: Optional[dict] = None
+_manifest_mtime: Optional[int] = None
+_models: Dict[str, Tuple[str, Type[DefaultSettings]]] = {}
+_lock = threading.Lock()
+
+def list_jobs() -> List[str]:
+  """Every job in the jobs directory, whether it's configured or not."""
+  return sorted(path.parent.name for path in JOBS_DIR.glob("*/job.py"))
+
+def fingerprint(job_name: str) -> str:
+  """Changes whenever a file that could change the job's settings does."""
+  job_dir = JOBS_DIR / job_name
+  digest = hashlib.sha256(f"{MANIFEST_VERSION}\n{requirements_hash(job_requirements(job_name))}\n".encode("utf-8"))
+  files = [path for path in job_dir.rglob("*.py") if "__pycache__" not in path.parts]
+  for path in sorted(files) + [job_dir / "requirements.txt", _BASE_SETTINGS]:
+    if path.exists():
+      stat = path.stat()
+      digest.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}\n".encode("utf-8"))
+  return digest.hexdigest()[:16]
+
+def describe(job_name: str) -> dict:
+  """The manifest entry of the job, run in the job's venv."""
+  from .config_utils import get_settings_cls
+
+  # Whatever the job prints on import would end up in the entry
+  with redirect_stdout(sys.stderr):
+    settings_class = get_settings_cls(job_name)
+  return {
+    "settings_class": settings_class.__name__,
+    "schema": settings_class.model_json_schema(),
+  }
+
+def _describe_with(python_path: Path, job_name: str) -> subprocess.CompletedProcess:
+  return subprocess.run(
+    [str(python_path), "-m", "core.registry", job_name],
+    capture_output=True,
+  )
+
+def _build_entry(job_name: str, job_fingerprint: str, build_venv: bool = True) -> dict:
+  from .environment_manager import prepare_venv, ready_venv, venv_python
+
+  venv_path = ready_venv(job_name)
+  result = _describe_with(venv_python(venv_path) if venv_path else Path(sys.executable), job_name)
+  if result.returncode == MISSING_MODULE_EXIT and venv_path is None:
+    # The settings need the job's requirements, e.g. one of its types
+    if not build_venv:
+      raise VenvNotReadyError(f"Describing job '{job_name}' needs its venv, which isn't built yet")
+    result = _describe_with(venv_python(prepare_venv(job_name)), job_name)
+  if result.returncode != 0:
+    raise RegistryError(f"Failed to describe job '{job_name}'\n" + result.stderr.decode(errors="replace"))
+  entry = json.loads(result.stdout.decode())
+  entry["fingerprint"] = job_fingerprint
+  entry["requirements_hash"] = requirements_hash(job_requirements(job_name))
+  entry["editable"] = _editable_paths(entry["schema"])
+  return entry
+
+def _read_manifest() -> dict:
+  global _manifest, _manifest_mtime
+  mtime = MANIFEST_PATH.stat().st_mtime_ns if MANIFEST_PATH.exists() else None
+  if _manifest is None or mtime != _manifest_mtime:
+    try:
+      _manifest = json.loads(MANIFEST_PATH.read_text(encoding="utf-8")) if mtime is not None else {}
+    except json.JSONDecodeError:
+      # Rebuilt entry by entry
+      _manifest = {}
+    _manifest_mtime = mtime
+  return _manifest
+
+def get_entry(job_name: str, rebuild: bool = False, build_venv: bool = True) -> dict:
+  """
+  The job's manifest entry, rebuilt first if the job's files changed.
+
+  Args:
+    build_venv: Whether the job's venv may be built to describe it.
+
+  Raises:
+    FileNotFoundError: If the job doesn't exist.
+    VenvNotReadyError: If describing the job needs a venv `build_venv` doesn't allow.
+    RegistryError: If the job's settings can't be described.
+  """
+  if not (JOBS_DIR / job_name / "job.py").exists():
+    raise FileNotFoundError(
+      f"Settings file not found for job '{job_name}'.\n"
+      f"Ensure you have a 'job.py' file in {JOBS_DIR / job_name}."
+    )
+  job_fingerprint = fingerprint(job_name)
+  with _lock:
+    entry = _read_manifest().get(job_name)
+  if entry is not None and entry["fingerprint"] == job_fingerprint and not rebuild:
+    return entry
+
+  # Server workers and the CLI may notice the change at the same time
+  with file_lock("registry"):
+    with _lock:
+      entry = _read_manifest().get(job_name)
+    if entry is not None and entry["fingerprint"] == job_fingerprint and not rebuild:
+      return entry
+    entry = _build_entry(job_name, job_fingerprint, build_venv)
+    with _lock:
+      manifest = {**_read_manifest(), job_name: entry}
+      MANIFEST_PATH.parent.mkdir(parents=True, exist_ok=True)
+      atomic_write(MANIFEST_PATH, json.dumps(manifest, indent=2).encode("utf-8"))
+  return entry
+
+def _editable_paths(schema: dict, properties: Optional[dict] = None, prefix: str = "") -> List[str]:
+  paths = []
+  for name, prop in (properties if properties is not None else schema.get("properties", {})).items():
+    ref = prop.get("$ref") or (prop.get("allOf") or [{}])[0].get("$ref")
+    nested = schema["$defs"][ref.rsplit("/", 1)[-1]] if ref else {}
+    if "properties" in nested:
+      paths.extend(_editable_paths(schema, nested["properties"], f"{prefix}{name}."))
+    elif prop.get("user_editable"):
+      paths.append(f"{prefix}{name}")
+  return paths
+
+def _json_string(value: Any) -> Any:
+  # Lists and objects set through env vars come in as JSON
+  if isinstance(value, str):
+    try:
+      return json.loads(value)
+    except json.JSONDecodeError:
+      pass
+  return value
+
+class _SchemaModels:
+  """Pydantic models rebuilt from a settings class' JSON schema."""
+
+  def __init__(self, schema: dict):
+    self.defs = schema.get("$defs", {})
+    self.models: Dict[str, Type[BaseModel]] = {}
+
+  def annotation(self, prop: dict) -> Any:
+    ref = prop.get("$ref") or (prop.get("allOf") or [{}])[0].get("$ref")
+    if ref:
+      name = ref.rsplit("/", 1)[-1]
+      # Enums are in $defs too, only objects become models
+      if "properties" not in self.defs[name] and self.defs[name].get("type", "object") != "object":
+        return self.annotation(self.defs[name])
+      if name not in self.models:
+        self.models[name] = self.model(name, self.defs[name])
+      return Annotated[self.models[name], BeforeValidator(_json_string)]
+    if "anyOf" in prop:
+      return Union[tuple(self.annotation(option) for option in prop["anyOf"])]
+    if "enum" in prop:
+      return Literal[tuple(prop["enum"])]
+    if "const" in prop:
+      return Literal[prop["const"]]
+
+    kind = prop.get("type")
+    if kind == "array":
+      annotation = List[self.annotation(prop["items"])] if "items" in prop else list
+    elif kind == "object":
+      values = prop.get("additionalProperties")
+      annotation = Dict[str, self.annotation(values) if isinstance(values, dict) else Any]
+    else:
+      annotation = {"string": str, "integer": int, "number": float, "boolean": bool, "null": type(None)}.get(kind, Any)
+    constraints = {key: prop[name] for name, key in _SCHEMA_CONSTRAINTS.items() if name in prop}
+    if constraints:
+      annotation = Annotated[annotation, Field(**constraints)]
+    if kind in ("array", "object"):
+      annotation = Annotated[annotation, BeforeValidator(_json_string)]
+    return annotation
+
+  def fields(self, schema: dict) -> Dict[str, tuple]:
+    required = set(schema.get("required", []))
+    fields = {}
+    for name, prop in schema.get("properties", {}).items():
+      default = ... if name in required else prop.get("default")
+      fields[name] = (self.annotation(prop), Field(
+        default,
+        description=prop.get("description"),
+        json_schema_extra={"user_editable": prop.get("user_editable", False)},
+        # Defaults of nested settings are plain JSON in the schema
+        validate_default=isinstance(default, (dict, list)),
+      ))
+    return fields
+
+  def model(self, name: str, schema: dict, base: Type[BaseModel] = BaseModel) -> Type[BaseModel]:
+    return create_model(name, __base__=base, **self.fields(schema))
+
+def settings_model(job_name: str, build_venv: bool = True) -> Type[DefaultSettings]:
+  """The job's settings class as far as the host needs it, built from its manifest entry."""
+  entry = get_entry(job_name, build_venv=build_venv)
+  with _lock:
+    cached = _models.get(job_name)
+    if cached is not None and cached[0] == entry["fingerprint"]:
+      return cached[1]
+    model = _SchemaModels(entry["schema"]).model(entry["settings_class"], entry["schema"], DefaultSettings)
+    _models[job_name] = (entry["fingerprint"], model)
+    return model
+
+def main() -> None:
+  if len(sys.argv) != 2:
+    print("Usage: python -m core.registry <job_name>", file=sys.stderr)
+    sys.exit(1)
+  try:
+    entry = describe(sys.argv[1])
+  except ModuleNotFoundError as e:
+    print(f"Failed to import job '{sys.argv[1]}': {e}", file=sys.stderr)
+    sys.exit(MISSING_MODULE_EXIT)
+  print(json.dumps(entry))
+
+if __name__ == "__main__":
+  main()
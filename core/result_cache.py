@@ -0,0 +1,89 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, NamedTuple, Optional, Tuple
+from .default_settings import DefaultSettings
+
+# Results of acknowledged runs, kept in memory by each server worker for the
+# job's `cache_ttl`. Identical requests arriving while the job runs wait for
+# that run instead of starting their own
+
+class _Entry(NamedTuple):
+  result: Any
+  stored_at: float
+  # Results computed with another config are stale
+  config: DefaultSettings
+
+_entries: Dict[str, "OrderedDict[str, _Entry]"] = {}
+_inflight: Dict[Tuple[str, str], Future] = {}
+_lock = threading.Lock()
+
+def payload_key(payload: Dict[str, Any]) -> str:
+  """The payload as canonical JSON, key order doesn't matter."""
+  return json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+
+def lookup(job_name: str, key: str, config: DefaultSettings) -> Optional[Tuple[Any, float]]:
+  """Returns the cached result and its age in seconds, or None."""
+  with _lock:
+    entries = _entries.get(job_name)
+    entry = entries.get(key) if entries else None
+    if entry is None:
+      return None
+    age = time.monotonic() - entry.stored_at
+    if entry.config is not config or age >= config.cache_ttl:
+      del entries[key]
+      return None
+    entries.move_to_end(key)
+    return entry.result, age
+
+def _store(job_name: str, key: str, config: DefaultSettings, result: Any) -> None:
+  with _lock:
+    entries = _entries.setdefault(job_name, OrderedDict())
+    entries[key] = _Entry(result, time.monotonic(), config)
+    entries.move_to_end(key)
+    # Least recently used results go first
+    while len(entries) > config.cache_max_entries:
+      entries.popitem(last=False)
+
+def cached_run(job_name: str, payload: Dict[str, Any], config: DefaultSettings, run: Callable[[], Any], refresh: bool = False) -> Tuple[Any, Optional[float]]:
+  """
+  Returns the cached result of the job for this payload, or runs it.
+
+  Args:
+    refresh: Skip the cached result, the new one replaces it.
+
+  Returns:
+    The result and its age in seconds, None if `run` was called for it.
+  """
+  if not config.cache_ttl:
+    return run(), None
+
+  key = payload_key(payload)
+  if not refresh:
+    hit = lookup(job_name, key, config)
+    if hit is not None:
+      return hit
+
+  with _lock:
+    future = _inflight.get((job_name, key))
+    waiting = future is not None and not refresh
+    if not waiting:
+      future = _inflight[(job_name, key)] = Future()
+  if waiting:
+    return future.result(), 0.0
+
+  try:
+    result = run()
+  except BaseException as e:
+    future.set_exception(e)
+    raise
+  finally:
+    with _lock:
+      if _inflight.get((job_name, key)) is future:
+        del _inflight[(job_name, key)]
+
+  future.set_result(result)
+  _store(job_name, key, config, result)
+  return result, None
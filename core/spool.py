@@ -0,0 +1,314 @@
+import json
+import os
+import shutil
+import threading
+import time
+import traceback
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Union
+from . import dispatcher, queue
+from .payload import PayloadFile
+
+# Fire-and-forget triggers are appended here, and on disk, before the request
+# is answered, then moved to the queue (core/queue.py) in batches. Each server
+# worker appends to its own segment file, one fsync covers every request
+# waiting on it (group commit). Segments left behind by a worker that died are
+# replayed by the next one to start, a trigger may be queued twice but runs once
+SPOOL_DIR = Path(os.getenv("SPOOL_DIR", ".webhook/spool"))
+# Past this size a segment is replaced by a new one, and deleted once drained
+SEGMENT_BYTES = 4 * 1024 * 1024
+# Seconds between drains when no trigger wakes the drainer up
+DRAIN_INTERVAL = 0.5
+# Large bodies (core/payload.py) are on tmpfs, a spooled trigger's is copied
+# here so it outlives a reboot too. The run deletes it, see core/dispatcher.py
+BODIES_DIR = SPOOL_DIR / "bodies"
+# Bodies no trigger refers to, left by a crash before their trigger was
+# spooled, are deleted on startup once they're this old
+ORPHAN_BODY_SECONDS = 60 * 60
+
+_fsync = getattr(os, "fdatasync", os.fsync)
+
+def _try_lock(fd: int) -> bool:
+  """Locks the segment for this process, False if a live worker holds it."""
+  if os.name == "nt":
+    import msvcrt
+    try:
+      msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+    except OSError:
+      return False
+    return True
+
+  import fcntl
+  try:
+    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+  except BlockingIOError:
+    return False
+  return True
+
+def _sync_dir(directory: Path = SPOOL_DIR) -> None:
+  # Makes the new file's directory entry durable too
+  if os.name == "nt":
+    return
+  fd = os.open(directory, os.O_RDONLY)
+  try:
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+
+class _Segment:
+  """An append-only file of triggers, locked by the worker writing to it."""
+
+  def __init__(self):
+    SPOOL_DIR.mkdir(parents=True, exist_ok=True)
+    name = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    # Locked before it's named like a segment, a worker replaying the
+    # directory never takes it for a dead worker's
+    tmp_path = SPOOL_DIR / f"{name}.tmp"
+    self.path = SPOOL_DIR / f"{name}.log"
+    self.fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+    _try_lock(self.fd)
+    os.replace(tmp_path, self.path)
+    _sync_dir()
+    self.size = 0
+
+  def write(self, data: bytes) -> None:
+    view = memoryview(data)
+    while view:
+      view = view[os.write(self.fd, view):]
+    self.size += len(data)
+
+  def truncate(self) -> None:
+    os.ftruncate(self.fd, 0)
+    self.size = 0
+
+  def remove(self) -> None:
+    self.path.unlink(missing_ok=True)
+    os.close(self.fd)
+
+def _read(path: Path) -> List[Dict[str, Any]]:
+  entries = []
+  with path.open("rb") as f:
+    for line in f:
+      try:
+        entries.append(json.loads(line))
+      except ValueError:
+        # Torn by the crash, it was never fsynced so never acknowledged
+        continue
+  return entries
+
+class _Spool:
+  def __init__(self):
+    # Appends and the pending triggers
+    self.lock = threading.Lock()
+    # One fsync at a time, requests arriving meanwhile share the next one
+    self.sync_lock = threading.Lock()
+    self.segment: Optional[_Segment] = None
+    # Full segments, deleted once their triggers are queued
+    self.retired: List[_Segment] = []
+    # Spooled and not queued yet
+    self.pending: List[Dict[str, Any]] = []
+    # Taken from `pending` by the drain going on
+    self.draining = 0
+    self.written = 0
+    self.synced = 0
+    self.wakeup = threading.Event()
+
+  def append(self, entry: Dict[str, Any]) -> None:
+    line = (json.dumps(entry, separators=(",", ":")) + "\n").encode("utf-8")
+    with self.lock:
+      if self.segment is None:
+        self.segment = _Segment()
+      self.segment.write(line)
+      self.pending.append(entry)
+      self.written += 1
+      position = self.written
+    self._sync(position)
+    self.wakeup.set()
+
+  def _sync(self, position: int) -> None:
+    with self.sync_lock:
+      # The previous fsync covered this trigger
+      if self.synced >= position:
+        return
+      with self.lock:
+        target = self.written
+        fd = self.segment.fd
+      _fsync(fd)
+      self.synced = target
+
+  def _rotate(self) -> None:
+    with self.sync_lock:
+      with self.lock:
+        full = self.segment
+        self.segment = _Segment()
+        self.retired.append(full)
+        target = self.written
+      # Requests still waiting on the full segment are covered by this fsync
+      _fsync(full.fd)
+      self.synced = max(self.synced, target)
+
+  def drain(self) -> int:
+    """Moves the pending triggers to the queue, returns how many."""
+    if self.segment is not None and self.segment.size >= SEGMENT_BYTES:
+      self._rotate()
+    with self.lock:
+      batch, self.pending = self.pending, []
+      retired, self.retired = self.retired, []
+      self.draining = len(batch)
+    try:
+      if batch:
+        queue.enqueue_many(batch)
+    except BaseException:
+      with self.lock:
+        self.pending[:0] = batch
+        self.retired[:0] = retired
+      raise
+    finally:
+      with self.lock:
+        self.draining = 0
+
+    for segment in retired:
+      segment.remove()
+    with self.lock:
+      # Nothing was appended since the batch, the whole segment is queued
+      if not self.pending and self.segment is not None and self.segment.size:
+        self.segment.truncate()
+    return len(batch)
+
+  def close(self) -> None:
+    """Deletes the segment if it's drained, otherwise it's replayed on the next start."""
+    with self.lock:
+      if self.segment is None:
+        return
+      if self.pending:
+        os.close(self.segment.fd)
+      else:
+        self.segment.remove()
+      self.segment = None
+
+_spool = _Spool()
+
+def _persist_body(payload: PayloadFile, trigger_id: str) -> PayloadFile:
+  """Moves the body to `BODIES_DIR`, on disk before the trigger refers to it."""
+  BODIES_DIR.mkdir(parents=True, exist_ok=True)
+  path = BODIES_DIR.resolve() / trigger_id
+  try:
+    with payload.open() as source, path.open("wb") as target:
+      shutil.copyfileobj(source, target, 1024 * 1024)
+      target.flush()
+      _fsync(target.fileno())
+    _sync_dir(BODIES_DIR)
+  except BaseException:
+    path.unlink(missing_ok=True)
+    raise
+  payload.unlink()
+  return PayloadFile(path, payload.size, payload.content_type, payload.params)
+
+def append(job_name: str, payload: Union[Dict[str, Any], PayloadFile], exclusive: bool = False, traceparent: Optional[str] = None) -> str:
+  """Spools a fire-and-forget trigger, returns once it's on disk. Returns the trigger id."""
+  trigger_id = uuid.uuid4().hex
+  if isinstance(payload, PayloadFile):
+    payload = _persist_body(payload, trigger_id)
+    data, payload_file = {}, payload.to_dict()
+  else:
+    data, payload_file = payload, None
+  try:
+    _spool.append({
+      "trigger_id": trigger_id,
+      "job_name": job_name,
+      "payload": data,
+      "payload_file": payload_file,
+      "exclusive": exclusive,
+      "traceparent": traceparent,
+      "created_at": time.time(),
+    })
+  except BaseException:
+    # Not acknowledged, nothing will run it
+    if payload_file is not None:
+      payload.unlink()
+    raise
+  return trigger_id
+
+def backlog() -> int:
+  """Triggers spooled by this process and not queued yet."""
+  with _spool.lock:
+    return len(_spool.pending) + _spool.draining
+
+def _remove_orphan_bodies() -> None:
+  if not BODIES_DIR.is_dir():
+    return
+  cutoff = time.time() - ORPHAN_BODY_SECONDS
+  orphans = {}
+  for path in BODIES_DIR.iterdir():
+    try:
+      if path.stat().st_mtime < cutoff:
+        orphans[path.name] = path
+    except FileNotFoundError:
+      # Its run just finished
+      continue
+  if not orphans:
+    return
+  # Live workers' segments too, their triggers may not be queued yet
+  for segment in SPOOL_DIR.glob("*.log"):
+    try:
+      entries = _read(segment)
+    except FileNotFoundError:
+      continue
+    for entry in entries:
+      orphans.pop(entry["trigger_id"], None)
+  for trigger_id in queue.known_triggers(list(orphans)):
+    del orphans[trigger_id]
+  for path in orphans.values():
+    path.unlink(missing_ok=True)
+
+def replay() -> int:
+  """Queues the triggers of segments left behind by dead workers, returns how many."""
+  if not SPOOL_DIR.is_dir():
+    return 0
+  replayed = 0
+  for path in sorted(SPOOL_DIR.glob("*.log")):
+    try:
+      fd = os.open(path, os.O_RDWR)
+    except FileNotFoundError:
+      # Replayed by another worker starting at the same time
+      continue
+    try:
+      if not _try_lock(fd):
+        continue
+      entries = _read(path)
+      if entries:
+        queue.enqueue_many(entries)
+      replayed += len(entries)
+      path.unlink(missing_ok=True)
+    finally:
+      os.close(fd)
+  _remove_orphan_bodies()
+  return replayed
+
+def _drain_loop(stop: threading.Event) -> None:
+  while True:
+    stopping = stop.is_set()
+    _spool.wakeup.clear()
+    try:
+      if _spool.drain():
+        dispatcher.notify()
+    except Exception:
+      traceback.print_exc()
+    if stopping:
+      _spool.close()
+      return
+    _spool.wakeup.wait(DRAIN_INTERVAL)
+
+def notify() -> None:
+  """Wakes the drainer up, e.g. on shutdown."""
+  _spool.wakeup.set()
+
+def start(stop: threading.Event) -> threading.Thread:
+  """Replays the spool, then moves triggers to the queue until `stop` is set."""
+  replayed = replay()
+  if replayed:
+    print(f"Replayed {replayed} spooled trigger(s)")
+  thread = threading.Thread(target=_drain_loop, args=(stop,), name="spool-drainer", daemon=True)
+  thread.start()
+  return thread
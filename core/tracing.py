@@ -0,0 +1,212 @@
+import atexit
+import functools
+import json
+import secrets
+import sys
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, TypeVar
+
+# Minimal tracing without extra dependencies. Spans are exported in the OTLP
+# JSON shape, to a JSONL file (one span per line) or to an OTLP/HTTP
+# collector. The context crosses into job processes as a W3C `traceparent`
+# in the stdin envelope.
+#
+# TRACE_EXPORT=traces.jsonl                          -> file
+# TRACE_EXPORT=http://localhost:4318/v1/traces       -> collector
+# unset                                              -> tracing is off
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+class Span:
+  def __init__(self, name: str, trace_id: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+    self.name = name
+    self.trace_id = trace_id
+    self.span_id = secrets.token_hex(8)
+    self.parent_id = parent_id
+    self.attributes = attributes
+    self.start_ns = time.time_ns()
+    self.end_ns: Optional[int] = None
+    self.error: Optional[str] = None
+
+  def set_attribute(self, key: str, value: Any) -> None:
+    self.attributes[key] = value
+
+  def to_otlp(self) -> dict:
+    span = {
+      "traceId": self.trace_id,
+      "spanId": self.span_id,
+      "name": self.name,
+      "kind": 1,
+      "startTimeUnixNano": str(self.start_ns),
+      "endTimeUnixNano": str(self.end_ns),
+      "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in self.attributes.items()],
+      "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+    }
+    if self.parent_id:
+      span["parentSpanId"] = self.parent_id
+    return span
+
+class _NoopSpan:
+  def set_attribute(self, key: str, value: Any) -> None:
+    pass
+
+_NOOP = _NoopSpan()
+
+# (trace_id, span_id, remote), remote parents come from a traceparent
+_current: ContextVar[Optional[tuple[str, str, bool]]] = ContextVar("trace_parent", default=None)
+
+def _otlp_value(value: Any) -> dict:
+  if isinstance(value, bool):
+    return {"boolValue": value}
+  if isinstance(value, int):
+    return {"intValue": str(value)}
+  if isinstance(value, float):
+    return {"doubleValue": value}
+  return {"stringValue": str(value)}
+
+class _Exporter:
+  def __init__(self, target: str, service: str):
+    self.target = target
+    self.service = service
+    self._buffer: List[dict] = []
+    self._lock = threading.Lock()
+    atexit.register(self.flush)
+
+  def export(self, span: Span, root: bool) -> None:
+    with self._lock:
+      self._buffer.append(span.to_otlp())
+    # Sent per local root span, a trace's spans of one process go out together.
+    # Posting to a collector happens off the caller's thread (e.g. the event loop)
+    if root and self.target.startswith(("http://", "https://")):
+      threading.Thread(target=self.flush, daemon=True).start()
+    elif root:
+      self.flush()
+
+  def flush(self) -> None:
+    with self._lock:
+      spans, self._buffer = self._buffer, []
+    if not spans:
+      return
+    try:
+      if self.target.startswith(("http://", "https://")):
+        self._post(spans)
+      else:
+        self._append(spans)
+    except Exception as e:
+      # Tracing must never fail a run
+      print(f"Failed to export {len(spans)} span(s) to {self.target}: {e}", file=sys.stderr)
+
+  def _append(self, spans: List[dict]) -> None:
+    lines = "".join(json.dumps({"service": self.service, **span}) + "\n" for span in spans)
+    path = Path(self.target)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Single append per flush, lines of concurrent processes don't interleave
+    with path.open("a", encoding="utf-8") as f:
+      f.write(lines)
+
+  def _post(self, spans: List[dict]) -> None:
+    body = {
+      "resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service}}]},
+        "scopeSpans": [{"scope": {"name": "webhook"}, "spans": spans}],
+      }]
+    }
+    request = urllib.request.Request(
+      self.target,
+      data=json.dumps(body).encode(),
+      headers={"Content-Type": "application/json"},
+      method="POST",
+    )
+    with urllib.request.urlopen(request, timeout=5):
+      pass
+
+_exporter: Optional[_Exporter] = None
+_configured = False
+_service = "webhook"
+
+def configure(service: Optional[str] = None) -> None:
+  """Sets the service name of this process' spans, call before the first span."""
+  global _service, _configured
+  if service:
+    _service = service
+  _configured = False
+
+def _get_exporter() -> Optional[_Exporter]:
+  # Read on first use, from the environment or the root `.env`
+  global _exporter, _configured
+  if not _configured:
+    from .environment_manager import getenv
+
+    target = getenv("TRACE_EXPORT")
+    _exporter = _Exporter(target, _service) if target else None
+    _configured = True
+  return _exporter
+
+def traceparent() -> Optional[str]:
+  """W3C traceparent of the current span, to hand to another process."""
+  parent = _current.get()
+  if parent is None:
+    return None
+  return f"00-{parent[0]}-{parent[1]}-01"
+
+@contextmanager
+def remote_parent(header: Optional[str]) -> Iterator[None]:
+  """Makes spans opened inside children of the span `header` points to."""
+  parts = (header or "").split("-")
+  if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+    yield
+    return
+  token = _current.set((parts[1], parts[2], True))
+  try:
+    yield
+  finally:
+    _current.reset(token)
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Any]:
+  """Times the block as a span, child of the current one."""
+  exporter = _get_exporter()
+  if exporter is None:
+    yield _NOOP
+    return
+
+  parent = _current.get()
+  current = Span(name, parent[0] if parent else secrets.token_hex(16), parent[1] if parent else None, attributes)
+  token = _current.set((current.trace_id, current.span_id, False))
+  try:
+    yield current
+  except BaseException as e:
+    current.error = f"{type(e).__name__}: {e}"
+    raise
+  finally:
+    _current.reset(token)
+    current.end_ns = time.time_ns()
+    exporter.export(current, root=parent is None or parent[2])
+
+def record(name: str, start_ns: int, end_ns: int, **attributes: Any) -> None:
+  """Exports an already finished span, e.g. timed by HTTP client hooks."""
+  exporter = _get_exporter()
+  parent = _current.get()
+  if exporter is None or parent is None:
+    return
+  finished = Span(name, parent[0], parent[1], attributes)
+  finished.start_ns = start_ns
+  finished.end_ns = end_ns
+  if isinstance(attributes.get("http.status_code"), int) and attributes["http.status_code"] >= 400:
+    finished.error = f"HTTP {attributes['http.status_code']}"
+  exporter.export(finished, root=False)
+
+def traced(name: str) -> Callable[[F], F]:
+  """Decorator running the function inside a span."""
+  def decorator(func: F) -> F:
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      with span(name):
+        return func(*args, **kwargs)
+    return wrapper
+  return decorator
@@ -0,0 +1,141 @@
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from typing import Any, Optional
+from . import tracing
+from .payload import SPOOL_DIR, PayloadFile
+
+# Worker node: leases queued runs from a server's `/worker` endpoints and runs
+# them here, in this machine's venvs, with this checkout's config and .env.
+# Talking to the server only takes the standard library, running the jobs
+# needs the same dependencies as the server (see core/job_runner.py)
+
+# Seconds between lease attempts when the queue is empty
+POLL_INTERVAL = 1.0
+# Seconds a request to the server may take
+REQUEST_TIMEOUT = 30
+
+class LeaseLostError(RuntimeError):
+  """Raised when the server gave the run to another worker."""
+  pass
+
+class Worker:
+  """
+  Args:
+    server: Base URL of the API server, e.g. http://localhost:8000
+    token: Sent as a bearer token, must match the server's `WORKER_TOKEN`.
+  """
+
+  def __init__(self, server: str, token: Optional[str] = None):
+    self.server = server.rstrip("/")
+    self.token = token
+
+  def _request(self, method: str, path: str, body: Optional[dict] = None):
+    request = urllib.request.Request(
+      f"{self.server}/worker{path}",
+      data=None if body is None else json.dumps(body, default=str).encode(),
+      method=method,
+      headers={"Content-Type": "application/json"},
+    )
+    if self.token:
+      request.add_header("Authorization", f"Bearer {self.token}")
+    return urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT)
+
+  def _post(self, path: str, body: dict) -> Optional[Any]:
+    try:
+      with self._request("POST", path, body) as response:
+        data = response.read()
+    except urllib.error.HTTPError as e:
+      if e.code == 409:
+        raise LeaseLostError(e.read().decode(errors="replace")) from e
+      raise
+    return json.loads(data) if data else None
+
+  def lease(self, owner: str) -> Optional[dict]:
+    return self._post("/lease", {"worker": owner})
+
+  def _download_payload(self, run: dict, owner: str) -> PayloadFile:
+    SPOOL_DIR.mkdir(parents=True, exist_ok=True)
+    with self._request("GET", f"/payload/{run['id']}?worker={urllib.parse.quote(owner)}") as response:
+      with tempfile.NamedTemporaryFile(dir=SPOOL_DIR, prefix="payload-", delete=False) as spool:
+        shutil.copyfileobj(response, spool)
+    info = run["payload_file"]
+    return PayloadFile(spool.name, info["size"], info["content_type"], info["params"])
+
+  def _keep_lease(self, run: dict, owner: str, done: threading.Event) -> None:
+    while not done.wait(run["lease_seconds"] / 3):
+      try:
+        self._post(f"/heartbeat/{run['id']}", {"worker": owner})
+      except LeaseLostError:
+        print(f"Lost the lease on run {run['id']}")
+        return
+      except (urllib.error.URLError, OSError) as e:
+        # The server may be restarting, the lease has some slack
+        print(f"Heartbeat for run {run['id']} failed: {e}")
+
+  def execute(self, run: dict, owner: str) -> None:
+    from .job_runner import run_job
+
+    done = threading.Event()
+    heartbeat = threading.Thread(target=self._keep_lease, args=(run, owner, done), daemon=True)
+    heartbeat.start()
+    payload = run["payload"]
+    try:
+      if run["payload_file"]:
+        payload = self._download_payload(run, owner)
+      with tracing.remote_parent(run.get("traceparent")), tracing.span("worker.run", run_id=run["id"], job=run["job_name"], worker=owner):
+        outcome = {"worker": owner, "result": run_job(run["job_name"], payload=payload)}
+    except Exception as e:
+      print(f"Run {run['id']} of job '{run['job_name']}' failed: {e}")
+      outcome = {"worker": owner, "error": str(e)}
+    finally:
+      done.set()
+      heartbeat.join()
+      if isinstance(payload, PayloadFile):
+        payload.unlink()
+
+    try:
+      self._post(f"/result/{run['id']}", outcome)
+    except LeaseLostError:
+      print(f"Run {run['id']} was given to another worker, dropping its result")
+
+  def work(self, owner: str, stop: threading.Event) -> None:
+    while not stop.is_set():
+      try:
+        run = self.lease(owner)
+      except (urllib.error.URLError, OSError) as e:
+        print(f"Can't reach {self.server}: {e}")
+        run = None
+      if run is None:
+        stop.wait(POLL_INTERVAL)
+        continue
+      print(f"Running run {run['id']} of job '{run['job_name']}'")
+      self.execute(run, owner)
+
+  def run(self, threads: int, stop: Optional[threading.Event] = None) -> None:
+    """Runs leased jobs on `threads` threads until `stop` is set."""
+    stop = stop or threading.Event()
+    workers = []
+    for index in range(threads):
+      owner = f"{socket.gethostname()}:{os.getpid()}:{index}:{uuid.uuid4().hex[:8]}"
+      thread = threading.Thread(target=self.work, args=(owner, stop), name=f"worker-{index}", daemon=True)
+      thread.start()
+      workers.append(thread)
+    try:
+      for thread in workers:
+        while thread.is_alive():
+          thread.join(timeout=1)
+    except KeyboardInterrupt:
+      # Leased runs are finished before exiting, a second Ctrl+C abandons
+      # them and their leases run out
+      print("Finishing leased runs, Ctrl+C again to quit now")
+      stop.set()
+      for thread in workers:
+        thread.join()
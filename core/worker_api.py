@@ -0,0 +1,89 @@
+import secrets
+from typing import Any, Optional
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, Response
+from pydantic import BaseModel
+from . import queue
+from .environment_manager import getenv
+from .payload import PayloadFile
+
+# Remote workers (`python -m cli worker`) lease queued runs through these
+# endpoints and run them on their own machine, see core/worker.py
+
+def _authorize(request: Request) -> None:
+  # Shared secret workers send as a bearer token. Without one configured the
+  # endpoints stay closed, they hand out payloads and take results
+  expected = getenv("WORKER_TOKEN")
+  if not expected:
+    raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Remote workers are disabled, set WORKER_TOKEN on the server")
+  scheme, _, token = request.headers.get("authorization", "").partition(" ")
+  if scheme.lower() != "bearer" or not secrets.compare_digest(token, expected):
+    raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid worker token")
+
+class LeaseRequest(BaseModel):
+  worker: str
+
+class ResultRequest(BaseModel):
+  worker: str
+  result: Any = None
+  error: Optional[str] = None
+
+def _lost_lease(run_id: int) -> HTTPException:
+  return HTTPException(
+    status_code=status.HTTP_409_CONFLICT,
+    detail=f"Run {run_id} isn't leased by this worker anymore",
+  )
+
+router = APIRouter(prefix="/worker", tags=["workers"], dependencies=[Depends(_authorize)])
+
+@router.post("/lease")
+async def lease(body: LeaseRequest):
+  run = await run_in_threadpool(queue.claim, body.worker)
+  if run is None:
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+  leased = {
+    "id": run.id,
+    "job_name": run.job_name,
+    "attempts": run.attempts,
+    "lease_seconds": queue.LEASE_SECONDS,
+    "payload": run.payload,
+    "payload_file": None,
+    "traceparent": run.traceparent,
+  }
+  # The worker may be on another machine, it downloads spooled bodies itself
+  if isinstance(run.payload, PayloadFile):
+    leased["payload"] = {}
+    leased["payload_file"] = {
+      "size": run.payload.size,
+      "content_type": run.payload.content_type,
+      "params": run.payload.params,
+    }
+  return leased
+
+@router.get("/payload/{run_id}")
+async def payload(run_id: int, worker: str):
+  payload_file = await run_in_threadpool(queue.payload_file, run_id, worker)
+  if payload_file is None or not payload_file.path.exists():
+    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Run {run_id} has no spooled payload")
+  return FileResponse(payload_file.path, media_type="application/octet-stream")
+
+@router.post("/heartbeat/{run_id}")
+async def heartbeat(run_id: int, body: LeaseRequest):
+  if not await run_in_threadpool(queue.heartbeat, run_id, body.worker):
+    raise _lost_lease(run_id)
+  return {"lease_seconds": queue.LEASE_SECONDS}
+
+@router.post("/result/{run_id}")
+async def result(run_id: int, body: ResultRequest):
+  payload_file = await run_in_threadpool(queue.payload_file, run_id, body.worker)
+  if body.error is not None:
+    finished = await run_in_threadpool(queue.fail, run_id, body.worker, body.error)
+  else:
+    finished = await run_in_threadpool(queue.complete, run_id, body.worker, body.result)
+  if not finished:
+    raise _lost_lease(run_id)
+  if payload_file is not None:
+    payload_file.unlink()
+  return Response(status_code=status.HTTP_204_NO_CONTENT)
@@ -0,0 +1,12 @@
+# Does nothing, used by `python -m cli loadtest` to measure the webhook itself
+from core.default_settings import DefaultSettings, config_field
+from typing import Dict
+
+class NoopSettings(DefaultSettings):
+  name: str = config_field("No-op Job", description="Name of the job")
+  module: str = config_field("jobs/noop/job.py", pattern=r'^jobs/[a-zA-Z0-9_/]+\.py$', description="Module path of the job")
+
+JOB_SETTINGS_CLASS = NoopSettings
+
+def run(config: NoopSettings = None, payload: dict = None) -> Dict:
+  return {"ok": True, "payload_keys": len(payload) if isinstance(payload, dict) else 0}
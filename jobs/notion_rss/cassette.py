@@ -0,0 +1,143 @@
+import base64
+import hashlib
+import json
+import random
+import time
+import urllib.request
+from collections import defaultdict, deque
+from pathlib import Path
+from threading import Lock
+from typing import Any, Callable, Dict, Optional
+
+# Record/replay of feed responses and Notion calls, so runs can be measured
+# offline and reproduced exactly
+# record: goes to the network and stores every response in the cassette
+# replay: serves the cassette from a local stand-in, nothing leaves the machine
+
+_NAMESPACES = {"databases", "data_sources", "pages", "blocks", "children", "users", "comments"}
+# Notion endpoints used by this job, replay knows how to fake the writes
+_WRITE_ENDPOINTS = {"pages.create", "pages.update", "blocks.children.append", "blocks.delete"}
+
+class CassetteMissError(KeyError):
+  """Raised in replay mode when a read was never recorded."""
+  pass
+
+class ReplayRateLimitError(Exception):
+  """Injected in replay mode, mirrors Notion's 429 `rate_limited` error."""
+  status = 429
+  code = "rate_limited"
+
+def _key(endpoint: str, kwargs: Dict[str, Any]) -> str:
+  args = json.dumps(kwargs, sort_keys=True, default=str)
+  return f"{endpoint}:{hashlib.sha256(args.encode('utf-8')).hexdigest()}"
+
+class _Endpoint:
+  def __init__(self, cassette: "Cassette", notion, path: str):
+    self._cassette = cassette
+    self._notion = notion
+    self._path = path
+
+  def __getattr__(self, name: str):
+    path = f"{self._path}.{name}" if self._path else name
+    target = getattr(self._notion, name) if self._notion is not None else None
+    if name in _NAMESPACES:
+      return _Endpoint(self._cassette, target, path)
+    return lambda **kwargs: self._cassette.call(path, target, kwargs)
+
+class Cassette:
+  """
+  Recorded feed responses and Notion calls, stored as a JSON file.
+
+  Args:
+    path: Where the cassette is read from and written to.
+    mode: `record` or `replay`.
+    latency: Simulated seconds per call in replay mode.
+    rate_limit_ratio: Share of replayed Notion calls that fail with a 429.
+    seed: Seed for the 429 injection, same seed gives the same failures.
+  """
+
+  def __init__(self, path: str, mode: str, latency: float = 0.0, rate_limit_ratio: float = 0.0, seed: int = 0):
+    self.path = Path(path)
+    self.mode = mode
+    self.latency = latency
+    self.rate_limit_ratio = rate_limit_ratio
+    self.seed = seed
+    self._lock = Lock()
+    # Times each call was made, a retry draws again
+    self._occurrences: Dict[str, int] = defaultdict(int)
+
+    self.feeds: Dict[str, str] = {}
+    self.calls: Dict[str, list] = defaultdict(list)
+    if mode == "replay":
+      if not self.path.exists():
+        raise FileNotFoundError(f"Cassette not found: {self.path}, record one first")
+      with self.path.open("r", encoding="utf-8") as f:
+        data = json.load(f)
+      self.feeds = data.get("feeds", {})
+      self.calls.update(data.get("calls", {}))
+    # Identical calls are served in the order they were recorded
+    self._queues: Dict[str, deque] = {key: deque(responses) for key, responses in self.calls.items()}
+
+  def save(self) -> None:
+    if self.mode != "record":
+      return
+    self.path.parent.mkdir(parents=True, exist_ok=True)
+    with self.path.open("w", encoding="utf-8") as f:
+      json.dump({"feeds": self.feeds, "calls": self.calls}, f)
+
+  def _simulate(self, key: str, occurrence: int) -> None:
+    if self.latency > 0:
+      time.sleep(self.latency)
+    # Drawn from the call itself, not from a shared sequence: concurrent
+    # writers reach it in any order, the same calls still fail
+    if random.Random(f"{self.seed}:{key}:{occurrence}").random() < self.rate_limit_ratio:
+      raise ReplayRateLimitError("Injected 429: rate limited")
+
+  def fetch_feed(self, url: str) -> bytes:
+    """Returns the raw feed document for `url`, from the network or the cassette."""
+    if self.mode == "replay":
+      if url not in self.feeds:
+        raise CassetteMissError(f"Feed was not recorded: {url}")
+      if self.latency > 0:
+        time.sleep(self.latency)
+      return base64.b64decode(self.feeds[url])
+
+    request = urllib.request.Request(url, headers={"User-Agent": "feedparser"})
+    with urllib.request.urlopen(request) as response:
+      body = response.read()
+    with self._lock:
+      self.feeds[url] = base64.b64encode(body).decode("ascii")
+    return body
+
+  def notion(self, notion=None):
+    """Wraps a Notion client (record) or stands in for one (replay)."""
+    return _Endpoint(self, notion if self.mode == "record" else None, "")
+
+  def call(self, endpoint: str, target: Optional[Callable], kwargs: Dict[str, Any]) -> Dict:
+    key = _key(endpoint, kwargs)
+    if self.mode == "record":
+      response = target(**kwargs)
+      with self._lock:
+        self.calls[key].append(response)
+      return response
+
+    with self._lock:
+      occurrence = self._occurrences[key]
+      self._occurrences[key] += 1
+    self._simulate(key, occurrence)
+    with self._lock:
+      queue = self._queues.get(key)
+      if queue:
+        return queue.popleft() if len(queue) > 1 else queue[0]
+      # Writes may legitimately differ from the recording (e.g. another
+      # batching strategy), answer them like Notion would
+      if endpoint in _WRITE_ENDPOINTS:
+        # Named after the call, later calls on the page are keyed the same
+        # whatever order the writes were made in
+        write_id = f"replay-{key.rsplit(':', 1)[-1][:16]}-{occurrence}"
+        # Appended blocks get ids too, their own children may follow
+        created = [{"object": "block", "id": f"{write_id}-{index}"} for index in range(len(kwargs.get("children", [])))]
+        return {"object": "page", "id": write_id, "results": created}
+      if endpoint == "blocks.children.list":
+        return {"object": "list", "results": [], "has_more": False, "next_cursor": None}
+    raise CassetteMissError(f"Call was not recorded: {endpoint} {kwargs}")
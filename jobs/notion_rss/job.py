@@ -3,98 +3,269 @@
 
 # TODO: Think a bit if it's worth deleting the page during an update instead of individual blocks,
 # for performace
-from .settings import NotionRSSSettings
-from .models import FeedSource, FeedReference, FeedView, UpdateFeed
-from .utils import get_links, get_feed_references, generate_feeds, update_page_content, create_page
+from .cassette import Cassette
+from .settings import NotionRSSSettings, Workspace
+from .models import FeedSource, FeedReference, FeedView, FeedWatermark
+from .stages import Stage
+from .utils import create_client, get_links, get_feed_references, fetch_feed, convert_feed, update_page_content, create_page
+from .watermarks import WatermarkStore, oldest
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextvars import copy_context
+from core.job_context import JobContext
+from feedparser import FeedParserDict
 from notion_client import Client
-from typing import List, Dict
+from threading import Lock
+from typing import List, Dict, Optional, Set, Tuple
 
-import json
+import time
 
 JOB_SETTINGS_CLASS = NotionRSSSettings
 
-def run(config: NotionRSSSettings = None, payload: dict = None):
-  # In some cases where payload is required
-  # We could validate here and raise an error
+class _WorkspaceSync:
+  """Writes of one workspace, fed page by page by the convert stage."""
+
+  def __init__(self, notion: Client, target: Workspace, sources: List[FeedSource], references: Future, config: NotionRSSSettings):
+    self.notion = notion
+    self.target = target
+    self.sources = sources
+    # Queried while the feeds are fetched
+    self.references = references
+    self.config = config
+    self.summary = {"sources": len(sources), "entries": 0, "created": 0, "updated": 0, "unchanged": 0, "failed": 0}
+    self.failed_sources: Set[str] = set()
+    self.error: Optional[str] = None
+    self._lock = Lock()
 
-  notion = Client(auth=config.defaults.notion_token)
-
-  links: List[FeedSource] = get_links(
-    notion=notion,
-    database_id=config.defaults.origin_database_id,
-    url_property=config.defaults.origin_url_title,
-    status_property=config.defaults.origin_status_title,
-    subscribed_value=config.defaults.origin_status_subscribed
-  )
-
-  pages: List[FeedView] = []
-  for link in links:
-    pages.extend(generate_feeds(
-      feed_source=link,
-      default_status=config.defaults.view_status_not_read
-    ))
-
-  feed_references: Dict[str, FeedReference] = get_feed_references(
-    notion=notion,
-    database_id=config.defaults.view_database_id,
-    id_property=config.defaults.view_id_title,
-    hash_property=config.defaults.view_hash_title
-  )
-
-  update_pages: List[UpdateFeed] = []
-
-  for page in pages:
+  def count(self, key: str, source: Optional[str] = None) -> None:
+    with self._lock:
+      self.summary[key] += 1
+      if source is not None:
+        self.failed_sources.add(source)
+
+  def priority(self, page: FeedView) -> int:
+    # Deleting existing blocks takes an awfully long time, new pages go first
+    # when the references are already known
+    if self.references.done() and self.references.exception() is None and page.id in self.references.result():
+      return 1
+    return 0
+
+  def write(self, page: FeedView) -> None:
+    try:
+      feed_references: Dict[str, FeedReference] = self.references.result()
+    except Exception as e:
+      with self._lock:
+        if self.error is None:
+          print(f"Failed to sync workspace '{self.target.name}': {e}")
+          self.error = str(e)
+      return
+
+    defaults = self.config.defaults
     if page.id in feed_references:
-      if page.hash != feed_references[page.id].hash:
-        page_id = feed_references[page.id].page_id
-        update_pages.append(UpdateFeed.model_construct(page_id=page_id, page=page))
-      else:
-        continue
-    else:
-      page_id = create_page(
-        notion=notion,
-        database_id=config.defaults.view_database_id,
-        feed_view=page,
-        title_placeholder=config.defaults.view_name_title,
-        description_placeholder=config.defaults.view_description_title,
-        status_placeholder=config.defaults.view_status_title,
-        pub_date_placeholder=config.defaults.view_pub_date_title,
-        feed_id_placeholder=config.defaults.view_id_title,
-        source_placeholder=config.defaults.view_source_title,
-        hash_placeholder=config.defaults.view_hash_title,
-        href_placeholder=config.defaults.view_href_title
-      )
-      # Fail silently
+      if page.hash == feed_references[page.id].hash:
+        self.count("unchanged")
+        return
       try:
         update_page_content(
-          notion=notion,
-          page_id=page_id,
+          notion=self.notion,
+          page_id=feed_references[page.id].page_id,
           feed_view=page,
-          status_placeholder=config.defaults.view_status_title,
-          hash_placeholder=config.defaults.view_hash_title,
-          default_status=config.defaults.view_status_not_read
+          status_placeholder=defaults.view_status_title,
+          hash_placeholder=defaults.view_hash_title,
+          default_status=defaults.view_status_not_read
         )
-        print(f"Created '{page.name}' in Notion")
+        self.count("updated")
+        print(f"Updated '{page.name}' in Notion ({self.target.name})")
       except Exception as e:
-        print(f"Failed to create '{page.name}' in Notion: {e}")
-        continue
+        self.count("failed", page.source)
+        print(f"Failed to update '{page.name}' in Notion ({self.target.name}): {e}")
+      return
 
-  # Deleting existing blocks takes an awfully long time
-  # So I decided to create new feeds before updating old ones 
-  for page in update_pages:
     try:
+      page_id = create_page(
+        notion=self.notion,
+        database_id=self.target.view_database_id,
+        feed_view=page,
+        title_placeholder=defaults.view_name_title,
+        description_placeholder=defaults.view_description_title,
+        status_placeholder=defaults.view_status_title,
+        pub_date_placeholder=defaults.view_pub_date_title,
+        feed_id_placeholder=defaults.view_id_title,
+        source_placeholder=defaults.view_source_title,
+        hash_placeholder=defaults.view_hash_title,
+        href_placeholder=defaults.view_href_title
+      )
       update_page_content(
-        notion=notion,
-        page_id=page.page_id,
-        feed_view=page.page,
-        status_placeholder=config.defaults.view_status_title,
-        hash_placeholder=config.defaults.view_hash_title,
-        default_status=config.defaults.view_status_not_read
+        notion=self.notion,
+        page_id=page_id,
+        feed_view=page,
+        status_placeholder=defaults.view_status_title,
+        hash_placeholder=defaults.view_hash_title,
+        default_status=defaults.view_status_not_read
       )
-      print(f"Updated '{page.page.name}' in Notion")
+      self.count("created")
+      print(f"Created '{page.name}' in Notion ({self.target.name})")
     except Exception as e:
-      print(f"Failed to update '{page.page.name}' in Notion: {e}")
+      self.count("failed", page.source)
+      print(f"Failed to create '{page.name}' in Notion ({self.target.name}): {e}")
+
+def run(config: NotionRSSSettings = None, payload: dict = None, context: Optional[JobContext] = None) -> Dict:
+  # In some cases where payload is required
+  # We could validate here and raise an error
+
+  started = time.perf_counter()
+  defaults = config.defaults
+  targets = defaults.targets()
+
+  cassette = None
+  if defaults.cassette.mode:
+    cassette = Cassette(
+      path=defaults.cassette.path,
+      mode=defaults.cassette.mode,
+      latency=defaults.cassette.latency,
+      rate_limit_ratio=defaults.cassette.rate_limit_ratio,
+      seed=defaults.cassette.seed
+    )
+
+  # Every workspace gets its own client, so its own rate limit budget
+  clients: Dict[str, Client] = {}
+  for target in targets:
+    if cassette and cassette.mode == "replay":
+      clients[target.name] = cassette.notion()
       continue
+    clients[target.name] = create_client(
+      notion_token=target.notion_token,
+      requests_per_second=target.requests_per_second or defaults.requests_per_second
+    )
+    if cassette:
+      clients[target.name] = cassette.notion(clients[target.name])
+
+  # One broken workspace shouldn't stop the others from syncing
+  summaries: Dict[str, Dict] = {}
+
+  # Sources and references of every workspace are queried at once, the
+  # references keep loading while the feeds are fetched and converted
+  queries = ThreadPoolExecutor(max_workers=max(1, 2 * len(targets)), thread_name_prefix="notion-query")
+  references: Dict[str, Future] = {}
+  links: Dict[str, Future] = {}
+  for target in targets:
+    references[target.name] = queries.submit(copy_context().run, get_feed_references,
+      notion=clients[target.name],
+      database_id=target.view_database_id,
+      id_property=defaults.view_id_title,
+      hash_property=defaults.view_hash_title
+    )
+    links[target.name] = queries.submit(copy_context().run, get_links,
+      notion=clients[target.name],
+      database_id=target.origin_database_id,
+      url_property=defaults.origin_url_title,
+      status_property=defaults.origin_status_title,
+      subscribed_value=defaults.origin_status_subscribed
+    )
+
+  syncs: Dict[str, _WorkspaceSync] = {}
+  for target in targets:
+    try:
+      sources = links[target.name].result()
+    except Exception as e:
+      print(f"Failed to fetch sources for workspace '{target.name}': {e}")
+      summaries[target.name] = {"error": str(e)}
+      continue
+    syncs[target.name] = _WorkspaceSync(clients[target.name], target, sources, references[target.name], config)
+
+  watermarks = WatermarkStore(defaults.watermark_path)
+  # Replays handle every entry and leave the watermarks alone, so they stay
+  # comparable with each other
+  replay = cassette is not None and cassette.mode == "replay"
+  full_rescan = replay or defaults.full_rescan or (isinstance(payload, dict) and bool(payload.get("full_rescan")))
+  # Converted content and feed ETags from earlier runs, replays convert everything
+  cache = context.cache if context is not None and not replay else None
+
+  # Feeds subscribed in several workspaces are fetched and converted once,
+  # skipping only the entries every subscribing source already has
+  subscribers: Dict[str, List[Tuple[_WorkspaceSync, FeedSource]]] = {}
+  for sync in syncs.values():
+    for source in sync.sources:
+      subscribers.setdefault(source.url, []).append((sync, source))
+  feed_watermarks: Dict[str, FeedWatermark] = {}
+  start_watermarks = {
+    url: None if full_rescan else oldest([watermarks.get(source.id) for _, source in url_subscribers])
+    for url, url_subscribers in subscribers.items()
+  }
+
+  # fetch -> convert -> write, each stage with its own workers. Watermarks
+  # are per URL, every worker writes its own key
+  def write(item: Tuple[_WorkspaceSync, FeedView]) -> None:
+    item[0].write(item[1])
+
+  def convert(item: Tuple[str, FeedParserDict]) -> None:
+    url, feed = item
+    url_subscribers = subscribers[url]
+    try:
+      views, feed_watermarks[url] = convert_feed(
+        feed_source=url_subscribers[0][1],
+        feed=feed,
+        default_status=defaults.view_status_not_read,
+        watermark=start_watermarks[url],
+        cache=cache,
+        fetched=cassette is None
+      )
+    except Exception as e:
+      print(f"Failed to convert feed {url}: {e}")
+      # Nothing was written, the sources keep their watermark
+      for sync, source in url_subscribers:
+        sync.count("failed", source.id)
+      return
+    # Feed views are shared between workspaces, only the source relation differs
+    for sync, source in url_subscribers:
+      for view in views:
+        page = view.model_copy(update={"source": source.id})
+        sync.count("entries")
+        writes.put((sync, page), sync.priority(page))
+
+  def fetch(url: str) -> None:
+    feed = fetch_feed(
+      feed_source=subscribers[url][0][1],
+      fetch=cassette.fetch_feed if cassette else None,
+      watermark=start_watermarks[url],
+      cache=cache
+    )
+    if feed is None:
+      feed_watermarks[url] = start_watermarks[url] or FeedWatermark()
+      return
+    converts.put((url, feed))
+
+  capacity = defaults.stage_queue_size
+  writes = Stage("notion-write", write, defaults.write_concurrency, capacity)
+  converts = Stage("feed-convert", convert, defaults.convert_concurrency, capacity)
+  fetches = Stage("feed-fetch", fetch, defaults.fetch_concurrency, capacity)
+  for url in subscribers:
+    fetches.put(url)
+  fetches.close()
+  converts.close()
+  writes.close()
+  queries.shutdown()
+
+  for name, sync in syncs.items():
+    if sync.error is not None:
+      summaries[name] = {"error": sync.error}
+      continue
+    summaries[name] = sync.summary
+    # Sources with a failed write keep their watermark, the entries are retried next run
+    for source in sync.sources:
+      if source.id not in sync.failed_sources and source.url in feed_watermarks:
+        watermarks.set(source.id, feed_watermarks[source.url].merge(watermarks.get(source.id)))
+
+  if not replay:
+    watermarks.save()
+
+  if cassette:
+    cassette.save()
+
+  return {
+    "feeds": len(subscribers),
+    "workspaces": {target.name: summaries[target.name] for target in targets if target.name in summaries},
+    "elapsed_seconds": round(time.perf_counter() - started, 3)
+  }
 
 # TODO: Check out other implementations of markdown to notion for inspiration
 # e.g:
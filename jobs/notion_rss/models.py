@@ -189,3 +189,31 @@ class FeedContent(BaseModel):
 class UpdateFeed(BaseModel):
   page_id: str = Field(..., description="The unique identifier for the feed page")
   page: FeedView = Field(..., description="The metadata for the feed page")
+
+
+# Bounds the IDs kept per feed, feeds rarely carry more than a few hundred entries
+MAX_SEEN_IDS = 1000
+
+class FeedWatermark(BaseModel):
+  latest: Optional[datetime] = Field(None, description="The latest published/updated time of the feed's handled entries")
+  seen_ids: List[str] = Field(default_factory=list, description="IDs of the most recently handled entries, newest first")
+
+  def covers(self, entry_id: str, timestamp: Optional[datetime], seen_ids: set) -> bool:
+    """Whether the entry was handled by a previous run. `seen_ids` is `self.seen_ids` as a set."""
+    if timestamp is not None and self.latest is not None:
+      if timestamp < self.latest:
+        return True
+      if timestamp > self.latest:
+        return False
+    # Same time as the watermark, or no time at all
+    return entry_id in seen_ids
+
+  def merge(self, other: Optional["FeedWatermark"]) -> "FeedWatermark":
+    """The furthest of both watermarks, this one's IDs first."""
+    if other is None:
+      return self
+    latest = [value for value in (self.latest, other.latest) if value is not None]
+    return FeedWatermark(
+      latest=max(latest) if latest else None,
+      seen_ids=list(dict.fromkeys(self.seen_ids + other.seen_ids))[:MAX_SEEN_IDS]
+    )
@@ -0,0 +1,353 @@
+import copy
+import json
+import unicodedata
+from typing import Callable, Dict, Iterator, List, Tuple
+
+# Notion request limits
+# Reference: https://developers.notion.com/reference/request-limits
+# Lengths are measured by Notion in UTF-16 code units (JavaScript string length),
+# so an emoji counts as 2 characters
+MAX_TEXT_LENGTH = 2000
+MAX_URL_LENGTH = 2000
+MAX_RICH_TEXT_ITEMS = 100
+MAX_BLOCKS_PER_REQUEST = 100
+MAX_BLOCK_ELEMENTS = 1000
+MAX_PAYLOAD_BYTES = 500_000
+MAX_NESTING_DEPTH = 2
+
+# Leave room for the rest of the request body (block_id, wrapping object...)
+_PAYLOAD_HEADROOM = 1_000
+
+# Rich text blocks that read fine when continued with a block of the same type.
+# Anything else (headings, list items, to-dos...) continues as a paragraph
+_CONTINUABLE_TYPES = {"paragraph", "quote", "code", "callout"}
+
+_ZERO_WIDTH_JOINER = "\u200d"
+
+class NotionLimitError(ValueError):
+  """Raised when a block can't be made to fit a single Notion request."""
+  pass
+
+def _utf16_len(text: str) -> int:
+  return len(text.encode("utf-16-le")) // 2
+
+def _json_size(value) -> int:
+  return len(json.dumps(value, ensure_ascii=False).encode("utf-8"))
+
+def _is_glued(text: str, index: int) -> bool:
+  """
+  Whether cutting `text` right before `index` would break a grapheme,
+  e.g. separate an accent, a variation selector or a ZWJ emoji sequence.
+  """
+  char = text[index]
+  return (
+    unicodedata.combining(char) != 0
+    or unicodedata.category(char) == "Mn"
+    or "\ufe00" <= char <= "\ufe0f"
+    or char == _ZERO_WIDTH_JOINER
+    or text[index - 1] == _ZERO_WIDTH_JOINER
+  )
+
+def split_text(content: str, limit: int = MAX_TEXT_LENGTH) -> List[str]:
+  """
+  Splits text into pieces of at most `limit` UTF-16 code units.
+
+  Cuts after a newline when possible, then after whitespace, and never inside
+  a grapheme. Joining the pieces gives back the original text.
+
+  Args:
+    content: The text to split.
+    limit: The maximum length of each piece, in UTF-16 code units.
+
+  Returns:
+    A list of text pieces.
+  """
+  if _utf16_len(content) <= limit:
+    return [content]
+
+  pieces = []
+  start = 0
+  while start < len(content):
+    # Furthest code point boundary that fits the limit
+    end = start
+    width = 0
+    while end < len(content):
+      char_width = 2 if ord(content[end]) > 0xFFFF else 1
+      if width + char_width > limit:
+        break
+      width += char_width
+      end += 1
+
+    if end < len(content):
+      # Don't bother looking for a nicer boundary too far back, tiny pieces
+      # eat into the rich_text item limit
+      floor = start + (end - start) // 2
+      newline = content.rfind("\n", floor, end)
+      if newline != -1:
+        cut = newline + 1
+      else:
+        cut = max(content.rfind(" ", floor, end), content.rfind("\t", floor, end)) + 1
+        if cut <= floor:
+          cut = end
+          while cut > start + 1 and _is_glued(content, cut):
+            cut -= 1
+      end = cut
+
+    pieces.append(content[start:end])
+    start = end
+
+  return pieces
+
+def _same_style(a: Dict, b: Dict) -> bool:
+  return (
+    a.get("type") == b.get("type") == "text"
+    and a.get("annotations") == b.get("annotations")
+    and a["text"].get("link") == b["text"].get("link")
+  )
+
+def _coalesce_rich_text(rich_texts: List[Dict]) -> List[Dict]:
+  """Merges neighbouring text items with the same annotations and link."""
+  merged: List[Dict] = []
+  for rich_text in rich_texts:
+    if merged and _same_style(merged[-1], rich_text):
+      previous = merged[-1]
+      content = previous["text"]["content"] + rich_text["text"]["content"]
+      if _utf16_len(content) <= MAX_TEXT_LENGTH:
+        previous["text"]["content"] = content
+        if "plain_text" in previous:
+          previous["plain_text"] = content
+        continue
+    merged.append(copy.deepcopy(rich_text))
+  return merged
+
+def split_rich_text(rich_texts: List[Dict]) -> List[Dict]:
+  """
+  Splits rich text items whose content is over Notion's length limit.
+
+  Every piece keeps the annotations and link of the item it was cut from.
+  Links over the URL limit are dropped since Notion would reject the item.
+
+  Args:
+    rich_texts: A list of Notion rich text items.
+
+  Returns:
+    A list of rich text items that individually fit Notion's limits.
+  """
+  split: List[Dict] = []
+  for rich_text in rich_texts:
+    if rich_text.get("type", "text") != "text" or "text" not in rich_text:
+      split.append(rich_text)
+      continue
+
+    link = rich_text["text"].get("link")
+    if link and _utf16_len(link.get("url") or "") > MAX_URL_LENGTH:
+      rich_text = copy.deepcopy(rich_text)
+      rich_text["text"]["link"] = None
+
+    content = rich_text["text"]["content"]
+    pieces = split_text(content)
+    if len(pieces) == 1:
+      split.append(rich_text)
+      continue
+
+    for piece in pieces:
+      piece_rich_text = copy.deepcopy(rich_text)
+      piece_rich_text["text"]["content"] = piece
+      if "plain_text" in piece_rich_text:
+        piece_rich_text["plain_text"] = piece
+      split.append(piece_rich_text)
+
+  return split
+
+def _chunk_rich_text(rich_texts: List[Dict], max_bytes: int) -> List[List[Dict]]:
+  chunks: List[List[Dict]] = [[]]
+  size = 0
+  for rich_text in rich_texts:
+    item_size = _json_size(rich_text)
+    chunk = chunks[-1]
+    if chunk and (len(chunk) >= MAX_RICH_TEXT_ITEMS or size + item_size > max_bytes):
+      chunks.append([])
+      size = 0
+    chunks[-1].append(rich_text)
+    size += item_size
+  return chunks
+
+def _count_elements(block: Dict) -> int:
+  body = block.get(block.get("type"), {})
+  children = body.get("children", []) if isinstance(body, dict) else []
+  return 1 + sum(_count_elements(child) for child in children)
+
+def _pack_block(block: Dict, depth: int) -> List[Dict]:
+  block_type = block.get("type")
+  body = block.get(block_type)
+  if not isinstance(body, dict):
+    return [block]
+
+  block = copy.copy(block)
+  body = copy.copy(body)
+  block[block_type] = body
+
+  url_holder = body.get(body.get("type")) if body.get("type") in ("external", "file") else None
+  if isinstance(url_holder, dict) and _utf16_len(url_holder.get("url") or "") > MAX_URL_LENGTH:
+    # Nothing sensible to split here, and Notion rejects the whole request
+    print(f"Skipping {block_type} block, URL is over {MAX_URL_LENGTH} characters")
+    return []
+
+  if "caption" in body:
+    body["caption"] = split_rich_text(body["caption"])[:MAX_RICH_TEXT_ITEMS]
+
+  # Blocks nested deeper than Notion accepts in a single request, or past the
+  # children limit, are moved up as siblings right after their parent
+  children = body.pop("children", None) or []
+  overflow: List[Dict] = []
+  if depth > MAX_NESTING_DEPTH:
+    overflow = children
+    children = []
+  packed_children: List[Dict] = []
+  for child in children:
+    packed_children.extend(_pack_block(child, depth + 1))
+  if len(packed_children) > MAX_BLOCKS_PER_REQUEST:
+    overflow = packed_children[MAX_BLOCKS_PER_REQUEST:] + overflow
+    packed_children = packed_children[:MAX_BLOCKS_PER_REQUEST]
+  if packed_children:
+    body["children"] = packed_children
+
+  packed = [block]
+  if "rich_text" in body:
+    rich_texts = _coalesce_rich_text(split_rich_text(body["rich_text"]))
+    chunks = _chunk_rich_text(rich_texts, MAX_PAYLOAD_BYTES // 2)
+    body["rich_text"] = chunks[0]
+
+    continuation_type = block_type if block_type in _CONTINUABLE_TYPES else "paragraph"
+    for chunk in chunks[1:]:
+      if continuation_type == block_type:
+        continuation_body = {key: value for key, value in body.items() if key not in ("rich_text", "children", "caption")}
+      else:
+        continuation_body = {}
+      continuation_body["rich_text"] = chunk
+      packed.append({"object": "block", "type": continuation_type, continuation_type: continuation_body})
+
+    # Children belong after the last piece of their parent's text
+    if len(packed) > 1 and "children" in body:
+      packed[-1][packed[-1]["type"]]["children"] = body.pop("children")
+
+  for child in overflow:
+    packed.extend(_pack_block(child, depth))
+
+  return packed
+
+def pack_blocks(blocks: List[Dict]) -> List[Dict]:
+  """
+  Validates blocks against Notion's request limits and splits the ones that
+  go over them.
+
+  Text is cut on safe boundaries and keeps its annotations and links, rich
+  text arrays over the item limit continue in new blocks, and children
+  nested too deep are moved up a level.
+
+  Args:
+    blocks: A list of Notion blocks.
+
+  Returns:
+    A list of blocks that individually fit in a Notion request.
+  """
+  packed: List[Dict] = []
+  for block in blocks:
+    packed.extend(_pack_block(block, 1))
+  return packed
+
+def _split_children(block: Dict, max_elements: int, max_bytes: int) -> Tuple[Dict, List[Dict]]:
+  """
+  Cuts a block's children after the last one that still fits a request with
+  the block. Returns the block with the children that fit, and the others.
+  """
+  block_type = block.get("type")
+  body = block[block_type]
+  children = body["children"]
+  head = {**block, block_type: {key: value for key, value in body.items() if key != "children"}}
+  elements = 1
+  size = _json_size(head) + 1
+  kept = 0
+  for child in children:
+    child_elements = _count_elements(child)
+    child_size = _json_size(child) + 1
+    if elements + child_elements > max_elements or size + child_size > max_bytes:
+      break
+    elements += child_elements
+    size += child_size
+    kept += 1
+  if kept:
+    head[block_type]["children"] = children[:kept]
+  return head, children[kept:]
+
+def batch_children(blocks: List[Dict]) -> Iterator[Tuple[List[Dict], Dict[int, List[Dict]]]]:
+  """
+  Groups packed blocks into `blocks.children.append` requests.
+
+  Each batch stays under the children count, total element count and
+  payload size limits. A block whose children don't fit in a request with
+  it keeps the ones that do, the others are left to follow-up requests on
+  the block once it's created.
+
+  Args:
+    blocks: A list of blocks returned by `pack_blocks`.
+
+  Returns:
+    An iterator over `(batch, deferred)` pairs, one per request: the blocks
+    to send, and the children to append afterwards by index in the batch.
+
+  Raises:
+    NotionLimitError: If a block doesn't fit in a request even without its children.
+  """
+  max_bytes = MAX_PAYLOAD_BYTES - _PAYLOAD_HEADROOM
+  batch: List[Dict] = []
+  deferred: Dict[int, List[Dict]] = {}
+  elements = 0
+  size = 0
+  for block in blocks:
+    block_elements = _count_elements(block)
+    block_size = _json_size(block) + 1
+    rest: List[Dict] = []
+    if block_elements > MAX_BLOCK_ELEMENTS or block_size > max_bytes:
+      body = block.get(block.get("type"))
+      if isinstance(body, dict) and body.get("children"):
+        block, rest = _split_children(block, MAX_BLOCK_ELEMENTS, max_bytes)
+        block_elements = _count_elements(block)
+        block_size = _json_size(block) + 1
+      if block_elements > MAX_BLOCK_ELEMENTS or block_size > max_bytes:
+        raise NotionLimitError(
+          f"'{block.get('type')}' block doesn't fit in a Notion request "
+          f"({block_elements} elements, {block_size} bytes)"
+        )
+    if batch and (
+      len(batch) >= MAX_BLOCKS_PER_REQUEST
+      or elements + block_elements > MAX_BLOCK_ELEMENTS
+      or size + block_size > max_bytes
+    ):
+      yield batch, deferred
+      batch = []
+      deferred = {}
+      elements = 0
+      size = 0
+    if rest:
+      deferred[len(batch)] = rest
+    batch.append(block)
+    elements += block_elements
+    size += block_size
+  if batch:
+    yield batch, deferred
+
+def append_blocks(append: Callable[[str, List[Dict]], List[Dict]], block_id: str, blocks: List[Dict]) -> None:
+  """
+  Appends packed blocks to `block_id` in as many requests as Notion's limits
+  take, children that didn't fit with their parent included.
+
+  Args:
+    append: Sends one `blocks.children.append` request, returns the created blocks.
+    block_id: The page or block to append to.
+    blocks: A list of blocks returned by `pack_blocks`.
+  """
+  for batch, deferred in batch_children(blocks):
+    created = append(block_id, batch)
+    for index, children in deferred.items():
+      append_blocks(append, created[index]["id"], children)
@@ -1,11 +1,31 @@
 from core.default_settings import DefaultSettings, config_field
-from pydantic import BaseModel
+from pydantic import BaseModel, field_validator, model_validator
+from typing import List, Literal, Optional
+import json
 
-class Defaults(BaseModel):
-  # Notion secrets
+class Workspace(BaseModel):
+  name: str = config_field("default", description="Name of the workspace, used in the run summary")
   notion_token: str = config_field(..., description="Notion integration token")
   origin_database_id: str = config_field(..., description="Origin Feed Notion database ID")
   view_database_id: str = config_field(..., description="View Feed Notion database ID")
+  requests_per_second: Optional[float] = config_field(None, gt=0, description="Notion request budget for this workspace, falls back to `requests_per_second`")
+
+class CassetteSettings(BaseModel):
+  mode: Optional[Literal["record", "replay"]] = config_field(None, True, description="Record feed and Notion responses, or replay them offline")
+  path: str = config_field("jobs/notion_rss/cassettes/default.json", True, description="Cassette file to record to or replay from")
+  latency: float = config_field(0.0, True, ge=0, description="Simulated seconds per call when replaying")
+  rate_limit_ratio: float = config_field(0.0, True, ge=0, le=1, description="Share of replayed Notion calls that fail with a 429")
+  seed: int = config_field(0, True, description="Seed for the replayed 429s")
+
+class Defaults(BaseModel):
+  # Notion secrets
+  # Either the single workspace fields or `workspaces` have to be set
+  notion_token: Optional[str] = config_field(None, description="Notion integration token")
+  origin_database_id: Optional[str] = config_field(None, description="Origin Feed Notion database ID")
+  view_database_id: Optional[str] = config_field(None, description="View Feed Notion database ID")
+  workspaces: List[Workspace] = config_field([], description="Extra Notion workspaces to sync, as a JSON list")
+
+  requests_per_second: float = config_field(3.0, True, gt=0, description="Notion request budget per workspace")
 
   # Origin Feed
   origin_name_title: str = config_field(..., True, description="The property name of the `name` of the origin feed")
@@ -24,6 +44,52 @@ class Defaults(BaseModel):
   view_href_title: str = config_field(..., True, description="The property name of the `href` of the view feed")
   view_status_not_read: str = config_field(..., True, description="The status value for not read feeds")
 
+  # Entries handled by previous runs are skipped before they're converted
+  watermark_path: str = config_field(".webhook/notion_rss/watermarks.json", True, description="File keeping each source's latest handled entries")
+  full_rescan: bool = config_field(False, True, description="Ignore the watermarks and handle every entry, also set per run with the `full_rescan` payload key")
+
+  # Stages of a sync run concurrently, see stages.py
+  fetch_concurrency: int = config_field(8, True, gt=0, description="Feeds downloaded at once")
+  convert_concurrency: int = config_field(2, True, gt=0, description="Feeds converted to Notion blocks at once, CPU bound")
+  write_concurrency: int = config_field(4, True, gt=0, description="Pages written to Notion at once, across workspaces")
+  stage_queue_size: int = config_field(64, True, gt=0, description="Items waiting between two stages before the earlier one waits")
+
+  # Offline performance runs
+  cassette: CassetteSettings = config_field(CassetteSettings(), description="Record/replay of feed and Notion responses")
+
+  @field_validator("workspaces", mode="before")
+  def parse_workspaces(cls, value):
+    # Comes in as a JSON string from NOTION_RSS_WORKSPACES
+    if isinstance(value, str):
+      try:
+        return json.loads(value)
+      except json.JSONDecodeError:
+        raise ValueError("workspaces has to be a JSON list of workspaces")
+    return value
+
+  @model_validator(mode="after")
+  def check_workspaces(self):
+    single = [self.notion_token, self.origin_database_id, self.view_database_id]
+    if any(single) and not all(single):
+      raise ValueError("notion_token, origin_database_id and view_database_id have to be set together")
+    if not any(single) and not self.workspaces:
+      raise ValueError("Set notion_token, origin_database_id and view_database_id, or workspaces")
+    names = [target.name for target in self.targets()]
+    if len(names) != len(set(names)):
+      raise ValueError(f"Workspace names have to be unique, got {names}")
+    return self
+
+  def targets(self) -> List[Workspace]:
+    targets = []
+    if self.notion_token:
+      targets.append(Workspace(
+        notion_token=self.notion_token,
+        origin_database_id=self.origin_database_id,
+        view_database_id=self.view_database_id
+      ))
+    targets.extend(self.workspaces)
+    return targets
+
 
 class NotionRSSSettings(DefaultSettings[Defaults]):
   name: str = config_field("Notion RSS Job", description="Name of the job")
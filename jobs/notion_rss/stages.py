@@ -0,0 +1,56 @@
+from contextvars import copy_context
+from itertools import count
+from queue import PriorityQueue
+from threading import Thread
+from typing import Any, Callable
+
+# Producer/consumer stages of a sync. Each stage has its own workers and a
+# bounded queue: a full queue makes the stage before it wait, so a slow stage
+# holds back the others instead of piling up memory
+
+_DONE = float("inf")
+
+class Stage:
+  """
+  Workers calling `handle` on every item put in the stage.
+
+  Args:
+    name: Name of the worker threads.
+    handle: Called with each item, errors are the handler's to deal with.
+    concurrency: Number of workers.
+    capacity: Items waiting in the queue before `put` blocks.
+  """
+
+  def __init__(self, name: str, handle: Callable[[Any], None], concurrency: int, capacity: int):
+    self.handle = handle
+    # Lowest priority first, items of the same priority in order
+    self._queue: PriorityQueue = PriorityQueue(maxsize=capacity)
+    self._order = count()
+    # Every worker gets a copy of the context, so its spans keep their parent
+    self._workers = [
+      Thread(target=copy_context().run, args=(self._work,), name=f"{name}-{index}", daemon=True)
+      for index in range(concurrency)
+    ]
+    for worker in self._workers:
+      worker.start()
+
+  def _work(self) -> None:
+    while True:
+      priority, _, item = self._queue.get()
+      if priority == _DONE:
+        return
+      try:
+        self.handle(item)
+      except Exception as e:
+        # One item shouldn't stop the stage
+        print(f"Unhandled error in {self.handle.__name__}: {type(e).__name__}: {e}")
+
+  def put(self, item: Any, priority: int = 0) -> None:
+    self._queue.put((priority, next(self._order), item))
+
+  def close(self) -> None:
+    """Waits for every item put so far to be handled, then stops the workers."""
+    for _ in self._workers:
+      self._queue.put((_DONE, next(self._order), None))
+    for worker in self._workers:
+      worker.join()
@@ -1,17 +1,79 @@
 from bs4.element import Tag
+from core import tracing
+from core.job_cache import JobCache
 from feedparser import parse as feedparse, FeedParserDict
 from hashlib import md5
 from html_to_markdown import convert_to_markdown
 from mistune import create_markdown
-from .models import FeedContent, FeedReference, FeedSource, FeedView, NotionLanguage
+from .models import MAX_SEEN_IDS, FeedContent, FeedReference, FeedSource, FeedView, FeedWatermark, NotionLanguage
+from .packer import MAX_RICH_TEXT_ITEMS, append_blocks, pack_blocks, split_rich_text
 from notion_client import Client
-from typing import List, Dict
+from threading import Lock
+from datetime import datetime, timezone
+from typing import Callable, List, Dict, Optional, Tuple
+import httpx
+import time
 
 # TODO: Look into creating github workflows for your webhooks too
 # Make it opt in automation - research about that
 
 # TODO: Check if there's a way to lock notion pages
 
+# Namespaces of the job's cache, see core/job_cache.py
+BLOCKS_NAMESPACE = "blocks"
+FEED_STATE_NAMESPACE = "feed_state"
+# Bump when the conversion to blocks changes, cached blocks are ignored
+CONVERTER_VERSION = 1
+BLOCKS_TTL = 30 * 24 * 60 * 60
+FEED_STATE_TTL = 7 * 24 * 60 * 60
+
+class RateLimiter:
+  """Spaces out requests so they stay under `rate` requests per second."""
+
+  def __init__(self, rate: float):
+    self.interval = 1 / rate
+    self._next = 0.0
+    self._lock = Lock()
+
+  def wait(self, *_) -> None:
+    with self._lock:
+      now = time.monotonic()
+      delay = self._next - now
+      self._next = max(now, self._next) + self.interval
+    if delay > 0:
+      time.sleep(delay)
+
+def create_client(notion_token: str, requests_per_second: float) -> Client:
+  """
+  Creates a Notion client with its own request budget.
+
+  Args:
+    notion_token: The Notion integration token.
+    requests_per_second: The maximum request rate for this client.
+
+  Returns:
+    A Notion client that waits for its budget before every request.
+  """
+  limiter = RateLimiter(requests_per_second)
+  return Client(auth=notion_token, client=httpx.Client(event_hooks={
+    "request": [limiter.wait, _start_span],
+    "response": [_end_span]
+  }))
+
+# Every Notion call is a span, timed from after the rate limiter let it through
+def _start_span(request: httpx.Request) -> None:
+  request.extensions["trace_start_ns"] = time.time_ns()
+
+def _end_span(response: httpx.Response) -> None:
+  request = response.request
+  tracing.record(
+    f"notion {request.method} {request.url.path}",
+    request.extensions.get("trace_start_ns", time.time_ns()),
+    time.time_ns(),
+    **{"http.method": request.method, "http.status_code": response.status_code}
+  )
+
+@tracing.traced("notion_rss.get_links")
 def get_links(notion: Client, database_id: str, url_property: str, status_property: str, subscribed_value: str) -> List[FeedSource]:
   """
   Fetches all links from a Notion database.
@@ -43,6 +105,7 @@ def get_links(notion: Client, database_id: str, url_property: str, status_proper
   
   return links
 
+@tracing.traced("notion_rss.get_feed_references")
 def get_feed_references(notion: Client, database_id: str, id_property: str, hash_property: str) -> Dict[str, FeedReference]:
   """
   Fetches all feeds from a Notion database.
@@ -75,9 +138,6 @@ def get_feed_references(notion: Client, database_id: str, id_property: str, hash
       )
   return feeds
 
-# TODO: Check the rate limit(len) of each block to ensure you don't get errors
-# when uploading to notion
-
 # Legacy, will delete in the future
 def _generate_block(line: str) -> Dict:
   block = {
@@ -101,40 +161,98 @@ def generate_blocks(feed_content: FeedContent) -> List[Dict]:
   ast = ast_parser(content)
 
   if isinstance(ast, str):
-    return [_generate_block(line.strip()) for line in content.splitlines()]
+    blocks = [_generate_block(line.strip()) for line in content.splitlines()]
   else:
-    return walk(ast)
+    blocks = walk(ast)
 
+  # Validate against Notion's request limits now, so writes don't fail halfway
+  # through a page
+  return pack_blocks(blocks)
 
-def generate_feeds(feed_source: FeedSource, default_status: str) -> List[FeedView]:
-  feed_views: List[FeedView] = []
-  mime_type_rank = {
-    "text/markdown": 1,
-    "text/html": 2,
-    "text/plain": 3,
-  }
 
-  feed: FeedParserDict = feedparse(feed_source.url)
+def _entry_timestamp(entry: FeedParserDict) -> Optional[datetime]:
+  # Already parsed by feedparser, as UTC
+  parsed = entry.get("updated_parsed") or entry.get("published_parsed")
+  if not parsed:
+    return None
+  return datetime(*parsed[:6], tzinfo=timezone.utc)
+
+@tracing.traced("notion_rss.fetch_feed")
+def fetch_feed(feed_source: FeedSource, fetch: Optional[Callable[[str], bytes]] = None, watermark: Optional[FeedWatermark] = None, cache: Optional[JobCache] = None) -> Optional[FeedParserDict]:
+  """
+  Downloads and parses a feed.
+
+  Args:
+    cache: The job's cache, the feed is only downloaded again if it changed
+      since the last run (ETag/Last-Modified).
+
+  Returns:
+    The parsed feed, None if it failed or has nothing new.
+  """
+  # A conditional request is only safe if the watermark is where the request
+  # that stored the state left it, otherwise entries of a source whose writes
+  # failed would be skipped until the feed changes
+  state_cache = cache.namespace(FEED_STATE_NAMESPACE) if cache is not None and fetch is None else None
+  state = state_cache.get(feed_source.url) if state_cache is not None and watermark else None
+  if state and state["watermark"] != watermark.model_dump(mode="json"):
+    state = None
+
+  # `fetch` lets the feed document come from somewhere else, e.g. a cassette
+  try:
+    with tracing.span("feed.fetch", url=feed_source.url) as span:
+      if fetch:
+        feed: FeedParserDict = feedparse(fetch(feed_source.url))
+      else:
+        feed = feedparse(feed_source.url, etag=state and state["etag"], modified=state and state["modified"])
+      span.set_attribute("http.status_code", feed.get("status", 0))
+  except Exception as e:
+    print("Error fetching feed:", feed_source.url, e)
+    return None
+
+  if feed.get("status") == 304:
+    # Nothing new since the last run
+    return None
 
   if feed.bozo:
     # TODO: Use logging instead of print
     print("Error parsing feed:", feed.bozo_exception)
-    return []
+    return None
+  return feed
+
+@tracing.traced("notion_rss.convert_feed")
+def convert_feed(feed_source: FeedSource, feed: FeedParserDict, default_status: str, watermark: Optional[FeedWatermark] = None, cache: Optional[JobCache] = None, fetched: bool = True) -> Tuple[List[FeedView], FeedWatermark]:
+  """
+  Converts the entries of a fetched feed, skipping the ones `watermark`
+  covers before any hashing or conversion.
 
+  Args:
+    cache: The job's cache, converted content is reused across runs.
+    fetched: Whether `feed` came from the network, its ETag is kept then.
+
+  Returns:
+    The converted entries, and `watermark` moved past them.
+  """
+  feed_views: List[FeedView] = []
+  handled_ids: List[str] = []
+  handled_latest: Optional[datetime] = None
+  seen_ids = set(watermark.seen_ids) if watermark else set()
+  mime_type_rank = {
+    "text/markdown": 1,
+    "text/html": 2,
+    "text/plain": 3,
+  }
 
-  content_list = []
-  # Print entries
+  entries: List[Tuple[Dict, FeedContent]] = []
   if feed.entries and isinstance(feed.entries, list):
     for entry in feed.entries:
-      name = entry["title"] or "No Title"
-      description = entry["description"] or "No Description"
-      status = default_status
-      pub_date = entry["published"]
-      href = entry["link"] or entry["url"] or entry["permalink"]
-      id = entry["id"] or href
-      source = feed_source.id
-      hash = None
-      blocks = []
+      entry_id = entry.get("id") or entry.get("link")
+      timestamp = _entry_timestamp(entry)
+      if watermark and entry_id and watermark.covers(entry_id, timestamp, seen_ids):
+        continue
+      if entry_id:
+        handled_ids.append(entry_id)
+      if timestamp and (handled_latest is None or timestamp > handled_latest):
+        handled_latest = timestamp
 
       content: FeedContent = FeedContent()
       for feed_content in entry.get("content", []):
@@ -143,28 +261,64 @@ def generate_feeds(feed_source: FeedSource, default_status: str) -> List[FeedVie
         if content.type is None or mime_type_rank[type] < mime_type_rank[content.type]:
           content.type = type
           content.value = value
-      if content.value is not None:
-        hash = md5(content.value.encode('utf-8')).hexdigest()
-        content_list.append(convert_to_markdown(content.value, code_language_callback=_detect_lang))
-      else:
-        hash = "No Content"
-
+      entries.append((entry, content))
+
+  # Converting is the expensive part, content seen by an earlier run (or
+  # another feed) is looked up in one go
+  hashes = [md5(content.value.encode('utf-8')).hexdigest() if content.value is not None else None for _, content in entries]
+  blocks_cache = cache.namespace(BLOCKS_NAMESPACE) if cache is not None else None
+  keys = [f"{CONVERTER_VERSION}:{content.type}:{hash}" if hash else None for (_, content), hash in zip(entries, hashes)]
+  converted = blocks_cache.get_many(key for key in keys if key) if blocks_cache is not None else {}
+  new_blocks: Dict[str, List[Dict]] = {}
+
+  for (entry, content), hash, key in zip(entries, hashes, keys):
+    name = entry["title"] or "No Title"
+    description = entry["description"] or "No Description"
+    status = default_status
+    pub_date = entry["published"]
+    href = entry["link"] or entry["url"] or entry["permalink"]
+    id = entry["id"] or href
+    source = feed_source.id
+
+    if key is None:
       blocks = generate_blocks(content)
+    elif key in converted:
+      blocks = converted[key]
+    else:
+      blocks = converted[key] = new_blocks[key] = generate_blocks(content)
+
+    feed_view = FeedView(
+      name=name,
+      description=description,
+      status=status,
+      pub_date=pub_date,
+      id=id,
+      source=source,
+      hash=hash or "No Content",
+      href=href,
+      blocks=blocks
+    )
 
-      feed_view = FeedView(
-        name=name,
-        description=description,
-        status=status,
-        pub_date=pub_date,
-        id=id,
-        source=source,
-        hash=hash,
-        href=href,
-        blocks=blocks
-      )
-
-      feed_views.append(feed_view)
-  return feed_views
+    feed_views.append(feed_view)
+
+  handled = FeedWatermark(latest=handled_latest, seen_ids=handled_ids[:MAX_SEEN_IDS]).merge(watermark)
+  if blocks_cache is not None:
+    blocks_cache.set_many(new_blocks, ttl=BLOCKS_TTL)
+  if cache is not None and fetched and (feed.get("etag") or feed.get("modified")):
+    cache.namespace(FEED_STATE_NAMESPACE).set(feed_source.url, {
+      "etag": feed.get("etag"),
+      "modified": feed.get("modified"),
+      "watermark": handled.model_dump(mode="json")
+    }, ttl=FEED_STATE_TTL)
+  return feed_views, handled
+
+@tracing.traced("notion_rss.generate_feeds")
+def generate_feeds(feed_source: FeedSource, default_status: str, fetch: Optional[Callable[[str], bytes]] = None, watermark: Optional[FeedWatermark] = None, cache: Optional[JobCache] = None) -> Tuple[List[FeedView], FeedWatermark]:
+  """Fetches a feed and converts its entries, see `fetch_feed` and `convert_feed`."""
+  feed = fetch_feed(feed_source, fetch=fetch, watermark=watermark, cache=cache)
+  if feed is None:
+    return [], watermark or FeedWatermark()
+  return convert_feed(feed_source, feed, default_status, watermark=watermark, cache=cache, fetched=fetch is None)
 
 def _clear_page_content(notion: Client, page_id: str) -> None:
   blocks = []
@@ -186,13 +340,14 @@ def _clear_page_content(notion: Client, page_id: str) -> None:
     block_id = block["id"]
     notion.blocks.delete(block_id=block_id)
 
+@tracing.traced("notion_rss.create_page")
 def create_page(notion: Client, database_id: str, feed_view: FeedView, title_placeholder: str, description_placeholder: str, status_placeholder: str, pub_date_placeholder: str, feed_id_placeholder: str, source_placeholder: str, hash_placeholder: str, href_placeholder: str) -> str:
   properties = {}
   properties[title_placeholder] = {
-    "title": [{"text": {"content": feed_view.name}}]
+    "title": split_rich_text([{"type": "text", "text": {"content": feed_view.name}}])[:MAX_RICH_TEXT_ITEMS]
   }
   properties[description_placeholder] = {
-    "rich_text": [{"text": {"content": feed_view.description}}]
+    "rich_text": split_rich_text([{"type": "text", "text": {"content": feed_view.description}}])[:MAX_RICH_TEXT_ITEMS]
   }
   properties[status_placeholder] = {
     "status": {"name": feed_view.status}
@@ -222,11 +377,14 @@ def create_page(notion: Client, database_id: str, feed_view: FeedView, title_pla
   )
   return new_page["id"]
 
+@tracing.traced("notion_rss.update_page_content")
 def update_page_content(notion: Client, page_id: str, feed_view: FeedView, status_placeholder: str, hash_placeholder: str, default_status: str) -> None:
   _clear_page_content(notion=notion, page_id=page_id)
-  for i in range(0, len(feed_view.blocks), 100):
-    # Notion rate limits block creation -> 100/rq
-    notion.blocks.children.append(block_id=page_id, children=feed_view.blocks[i:i+100])
+  # Notion limits block creation -> 100 blocks, 1000 elements and 500KB per request
+  append_blocks(
+    lambda block_id, children: notion.blocks.children.append(block_id=block_id, children=children)["results"],
+    page_id, feed_view.blocks,
+  )
   notion.pages.update(page_id=page_id,
     properties={
       status_placeholder: {
@@ -293,20 +451,6 @@ def _detect_lang(tag: Tag) -> str | None:
       return NotionLanguage.get(language).value
   return None
 
-# Notion has a limit of 2000 characters for each rich_text block
-# Error: notion_client.errors.APIResponseError: body failed validation:... should be ≤ `2000`, instead was `2422`.
-def _rate_limit_rich_txt(rich_texts: list[dict]) -> list[dict]:
-  rated_rich_texts = []
-  for rich_text in rich_texts:
-    
-    if "text" in rich_text and len(rich_text["text"]["content"]) > 2000:
-      for i in range(0, len(rich_text["text"]["content"]), 2000):
-        rated_rich_texts.append({"type": "text", "text": {"content": rich_text["text"]["content"][i:i+2000]}})
-    else:
-      rated_rich_texts.append(rich_text)
-
-  return rated_rich_texts
-
 def _txt(content:str, annotations:Dict=None)->Dict:
   return {
     "type":"text",
@@ -318,7 +462,6 @@ def _txt(content:str, annotations:Dict=None)->Dict:
   }
 
 def _create_rich_block(blocks: list[dict], block_type:str, rich_text:List[Dict]):
-  rich_text = _rate_limit_rich_txt(rich_text)
   # mistune creates images as inline blocks instead of top level blocks
   # So I have parse through it to get the images out
   rich_text_chunk = []
@@ -414,7 +557,7 @@ def _walk_blocks(nodes: list, blocks: list[dict], curr_list: list[str] = None) -
         "object":"block",
         "type": "code",
         "code": {
-          "rich_text":_rate_limit_rich_txt([{"type": "text", "text": {"content": node["raw"]}}]),
+          "rich_text":[{"type": "text", "text": {"content": node["raw"]}}],
           "language": node.get("attrs",{}).get("info", "plain text")
         }
       })
@@ -0,0 +1,49 @@
+from core.locks import atomic_write
+from .models import FeedWatermark
+from pathlib import Path
+from typing import Dict, List, Optional
+import json
+
+class WatermarkStore:
+  """
+  Watermarks of every feed source, persisted as JSON between runs.
+
+  Args:
+    path: JSON file holding the watermarks, keyed by source ID.
+  """
+
+  def __init__(self, path: str):
+    self.path = Path(path)
+    self._watermarks: Dict[str, FeedWatermark] = {}
+    if self.path.exists():
+      try:
+        data = json.loads(self.path.read_text(encoding="utf-8"))
+        self._watermarks = {key: FeedWatermark(**value) for key, value in data.items()}
+      except (json.JSONDecodeError, TypeError, ValueError) as e:
+        # Worst case is a full rescan, not a failed run
+        print(f"Ignoring unreadable watermarks in {self.path}: {e}")
+
+  def get(self, source_id: str) -> Optional[FeedWatermark]:
+    return self._watermarks.get(source_id)
+
+  def set(self, source_id: str, watermark: FeedWatermark) -> None:
+    self._watermarks[source_id] = watermark
+
+  def save(self) -> None:
+    self.path.parent.mkdir(parents=True, exist_ok=True)
+    data = {key: watermark.model_dump(mode="json") for key, watermark in self._watermarks.items()}
+    atomic_write(self.path, json.dumps(data, indent=2).encode("utf-8"))
+
+def oldest(watermarks: List[Optional[FeedWatermark]]) -> Optional[FeedWatermark]:
+  """
+  The watermark covering only what every one of `watermarks` covers, for a
+  feed shared by several sources. None if any source has no watermark yet.
+  """
+  if not watermarks or any(watermark is None for watermark in watermarks):
+    return None
+  latest = [watermark.latest for watermark in watermarks]
+  seen_ids = set.intersection(*(set(watermark.seen_ids) for watermark in watermarks))
+  return FeedWatermark(
+    latest=None if None in latest else min(latest),
+    seen_ids=[entry_id for entry_id in watermarks[0].seen_ids if entry_id in seen_ids]
+  )